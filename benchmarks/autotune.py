@@ -0,0 +1,118 @@
+"""
+Finds the fastest CPU inference topology of a model on this host and stores it in a host
+profile, which run_ner.py applies at inference with --host_profile:
+
+    python -m benchmarks.autotune --model_dir ./models/$MODEL_ID --seq_lengths 300 \
+        --batch_sizes 8 16 32 --profile ./models/host_profile.json
+
+For every max_seq_length, every combination of worker processes x threads per worker
+(by default the splits that use all usable CPUs: 1 x N, 2 x N/2, ..., N x 1) and batch
+size is measured with benchmarks/scaling.py, with every worker pinned to its own cores
+(unless --no_pin). The combination with the most examples/s, among those within
+--max_p95_ms if given, is stored under this host, the model config and the precision.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+
+from pytorch_transformers import BertConfig
+
+from benchmarks.pipeline import make_model
+from benchmarks.scaling import measure
+from tools.topology import HostProfile, host_key, usable_cpus
+
+
+def candidate_topologies(num_cpus, num_workers=None, num_threads=None):
+    """[(workers, threads per worker)]: the given grid up to num_cpus cores, else the splits of all num_cpus."""
+    if num_workers or num_threads:
+        return [(w, t) for w, t in itertools.product(num_workers or [1], num_threads or [1]) if w * t <= num_cpus]
+    return [(w, num_cpus // w) for w in range(1, num_cpus + 1) if num_cpus % w == 0]
+
+
+def best_topology(results, max_p95_ms=None):
+    """The result with the most examples/s (within max_p95_ms), or None."""
+    candidates = [r for r in results if max_p95_ms is None or r['p95_ms'] <= max_p95_ms]
+    return max(candidates, key=lambda r: r['examples_per_s']) if candidates else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Autotunes the CPU inference topology into a host profile.')
+
+    parser.add_argument("--model_dir", type=str,
+                        help="Directory of a trained model (base_dir/model_id); a random model if not given.")
+    parser.add_argument("--hidden_size", type=int, default=1024,
+                        help="Hidden size of the random model (bert-large: 1024).")
+    parser.add_argument("--num_layers", type=int, default=24,
+                        help="Number of layers of the random model (bert-large: 24).")
+    parser.add_argument("--vocab_size", type=int, default=30522)
+    parser.add_argument("--seq_lengths", type=int, nargs='+', default=[300],
+                        help="The max_seq_length(s) used at inference.")
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument("--num_workers", type=int, nargs='*',
+                        help="Worker counts to try (default: the divisors of the number of CPUs).")
+    parser.add_argument("--num_threads", type=int, nargs='*',
+                        help="Threads per worker to try (default: CPUs / workers).")
+    parser.add_argument("--num_requests", type=int, default=20,
+                        help="Timed requests per worker and candidate.")
+    parser.add_argument("--max_p95_ms", type=float, default=None,
+                        help="Only consider topologies whose p95 request latency is within this.")
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16'])
+    parser.add_argument("--no_pin", action='store_true',
+                        help="Do not pin the workers to cores.")
+    parser.add_argument("--profile", type=str, default='host_profile.json',
+                        help="Host profile json file (updated).")
+    parser.add_argument("--output_file", type=str,
+                        help="Optional json file for all measurements.")
+
+    args = parser.parse_args()
+
+    model_spec = {'model_dir': args.model_dir, 'hidden_size': args.hidden_size, 'num_layers': args.num_layers,
+                  'vocab_size': args.vocab_size, 'max_seq_length': max(args.seq_lengths)}
+    if args.model_dir:
+        config = BertConfig.from_pretrained(args.model_dir)
+    else:
+        config = make_model(args.vocab_size, 5, args.hidden_size, args.num_layers, max(args.seq_lengths),
+                            seed=42).config
+
+    num_cpus = len(usable_cpus())
+    topologies = candidate_topologies(num_cpus, args.num_workers, args.num_threads)
+    print('Host {}: {} topologies x {} batch sizes'.format(host_key(), len(topologies), len(args.batch_sizes)))
+    print('{:>7s} {:>6s} {:>8s} {:>8s} {:>9s} {:>11s}'.format(
+        'seq_len', 'batch', 'threads', 'workers', 'p95_ms', 'examples/s'))
+
+    profile = HostProfile(args.profile)
+    all_results = []
+    for seq_length in args.seq_lengths:
+        results = []
+        for (num_workers, num_threads), batch_size in itertools.product(topologies, args.batch_sizes):
+            result = measure(model_spec, None, seq_length, batch_size, num_threads, num_workers, args.num_requests,
+                             precision=args.precision, pin=not args.no_pin)
+            results.append(result)
+            print('{:>7d} {:>6d} {:>8d} {:>8d} {:>9.1f} {:>11.1f}'.format(
+                seq_length, batch_size, num_threads, num_workers, result['p95_ms'], result['examples_per_s']))
+        all_results.extend(results)
+
+        best = best_topology(results, args.max_p95_ms)
+        if best is None:
+            print('seq_len={}: no topology within p95 {} ms'.format(seq_length, args.max_p95_ms))
+            continue
+        profile.put(config, seq_length, args.precision,
+                    {'num_workers': best['num_workers'], 'num_threads': best['num_threads'],
+                     'batch_size': best['batch_size'], 'pin': not args.no_pin,
+                     'examples_per_s': best['examples_per_s'], 'p95_ms': best['p95_ms']})
+        print('seq_len={}: {} workers x {} threads, batch size {} ({:.1f} examples/s) -> {}'.format(
+            seq_length, best['num_workers'], best['num_threads'], best['batch_size'], best['examples_per_s'],
+            args.profile))
+
+    if args.output_file:
+        json.dump({'settings': vars(args), 'host': host_key(), 'results': all_results},
+                  open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Speed/quality table of a teacher and its distilled students (run_ner.py
+--teacher_model_id) on one split, e.g.:
+
+    python -m benchmarks.distillation --model_dirs ./models/$TEACHER_ID ./models/$STUDENT_ID \
+        --data_dir ./data/trec_cast_2019/token_classification/ --dev_on test_oracle_rewrite
+
+The first model is the reference for speedup and F1 delta. Throughput covers the
+forward passes of the whole split on CPU, after a warm-up batch.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+
+import torch
+from pytorch_transformers import BertTokenizer
+
+from run_ner import ConvSearchProcessor, _model_class, _predict, convert_examples_to_features
+from tools import eval_seq_labeling
+
+
+def benchmark_model(model_dir, processor, data_dir, batch_size):
+    model_config = json.load(open(os.path.join(model_dir, "model_config.json")))
+    tokenizer = BertTokenizer.from_pretrained(model_dir, do_lower_case=model_config['do_lower'])
+    model = _model_class(model_dir).from_pretrained(model_dir)
+    model.eval()
+
+    label_list = processor.get_labels()
+    label_map = {i: label for i, label in enumerate(label_list, 1)}
+    sep_label_id = label_list.index('[SEP]') + 1
+    rel_label_id = label_list.index('REL') + 1
+
+    examples = processor.get_dev_examples(data_dir, uppercase=not model_config['do_lower'])
+    features = convert_examples_to_features(examples, label_list, model_config['max_seq_length'], tokenizer)
+    y_true = [[label_map[l] for l in f.label_id[1:f.label_id.index(sep_label_id)]] for f in features]
+
+    # warm up
+    _predict(model, features[:batch_size], torch.device('cpu'), batch_size, rel_label_id)
+    s_time = time.perf_counter()
+    preds, _ = _predict(model, features, torch.device('cpu'), batch_size, rel_label_id)
+    elapsed = time.perf_counter() - s_time
+
+    y_pred = [[label_map.get(p, 'O') for p in pred[1:len(labels) + 1]] for pred, labels in zip(preds, y_true)]
+    return {
+        'model_dir': model_dir,
+        'num_layers': model.config.num_hidden_layers,
+        'hidden_size': model.config.hidden_size,
+        'num_parameters': sum(p.numel() for p in model.parameters()),
+        'examples_per_s': len(features) / elapsed,
+        'f1_token': eval_seq_labeling.f1_score(y_true, y_pred),
+        'precision_token': eval_seq_labeling.precision_score(y_true, y_pred),
+        'recall_token': eval_seq_labeling.recall_score(y_true, y_pred),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed/quality of a teacher and its students.')
+
+    parser.add_argument("--model_dirs", type=str, nargs='+', required=True,
+                        help="Model directories (base_dir/model_id); the first one is the teacher.")
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--dev_on", type=str, default='test_oracle_rewrite',
+                        help="Split to evaluate (data_dir/<split>.json).")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_threads", type=int, default=1,
+                        help="Number of torch threads.")
+    parser.add_argument("--output_file", type=str,
+                        help="Optional json file for the results.")
+
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    processor = ConvSearchProcessor(dev_on=args.dev_on)
+    results = [benchmark_model(model_dir, processor, args.data_dir, args.batch_size) for model_dir in args.model_dirs]
+
+    teacher = results[0]
+    print('| model | layers | hidden | params (M) | examples/s | speedup | P | R | F1 | dF1 |')
+    print('|---|---|---|---|---|---|---|---|---|---|')
+    for result in results:
+        result['speedup'] = result['examples_per_s'] / teacher['examples_per_s']
+        result['f1_delta'] = result['f1_token'] - teacher['f1_token']
+        print('| {} | {} | {} | {:.1f} | {:.1f} | {:.2f} | {:.1f} | {:.1f} | {:.1f} | {:+.1f} |'.format(
+            os.path.basename(os.path.normpath(result['model_dir'])), result['num_layers'], result['hidden_size'],
+            result['num_parameters'] / 1e6, result['examples_per_s'], result['speedup'],
+            100 * result['precision_token'], 100 * result['recall_token'], 100 * result['f1_token'],
+            100 * result['f1_delta']))
+
+    if args.output_file:
+        json.dump(results, open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
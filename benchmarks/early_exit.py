@@ -0,0 +1,103 @@
+"""
+Average layers executed, speedup and token F1 of an early-exit model (run_ner.py
+--early_exit) at several exit thresholds, e.g. on the CAsT test set:
+
+    python -m benchmarks.early_exit --model_dir ./models/$MODEL_ID \
+        --data_dir ./data/trec_cast_2019/token_classification/ --dev_on test_oracle_rewrite
+
+The baseline ('none') runs all layers and uses the final classifier. Speedup and
+F1 delta are relative to it; times cover the forward passes of the whole split.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+
+import torch
+from pytorch_transformers import BertTokenizer
+
+from run_ner import ConvSearchProcessor, EarlyExitNer, _predict, convert_examples_to_features
+from tools import eval_seq_labeling
+
+DEFAULT_THRESHOLDS = ['none', '0.5', '0.6', '0.7', '0.8', '0.9', '0.95', '0.99']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed and quality of early exit at several thresholds.')
+
+    parser.add_argument("--model_dir", type=str, required=True,
+                        help="Directory of a model trained with --early_exit (base_dir/model_id).")
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--dev_on", type=str, default='test_oracle_rewrite',
+                        help="Split to evaluate (data_dir/<split>.json).")
+    parser.add_argument("--thresholds", type=str, nargs='+', default=DEFAULT_THRESHOLDS,
+                        help="Exit thresholds ('none' runs all layers).")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="A batch exits only when all its examples are confident.")
+    parser.add_argument("--num_threads", type=int, default=1,
+                        help="Number of torch threads.")
+    parser.add_argument("--output_file", type=str,
+                        help="Optional json file for the results.")
+
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    model_config = json.load(open(os.path.join(args.model_dir, "model_config.json")))
+    tokenizer = BertTokenizer.from_pretrained(args.model_dir, do_lower_case=model_config['do_lower'])
+    model = EarlyExitNer.from_pretrained(args.model_dir)
+    model.eval()
+    num_layers = len(model.bert.encoder.layer)
+
+    processor = ConvSearchProcessor(dev_on=args.dev_on)
+    label_list = processor.get_labels()
+    label_map = {i: label for i, label in enumerate(label_list, 1)}
+    rel_label_id = label_list.index('REL') + 1
+    sep_label_id = label_list.index('[SEP]') + 1
+
+    examples = processor.get_dev_examples(args.data_dir, uppercase=not model_config['do_lower'])
+    features = convert_examples_to_features(examples, label_list, model_config['max_seq_length'], tokenizer)
+    y_true = [[label_map[l] for l in f.label_id[1:f.label_id.index(sep_label_id)]] for f in features]
+
+    # warm up
+    _predict(model, features[:args.batch_size], torch.device('cpu'), args.batch_size, rel_label_id)
+
+    results = []
+    baseline = None
+    print('{:<10s} {:>8s} {:>10s} {:>8s} {:>8s} {:>8s}'.format('threshold', 'layers', 'time_s', 'speedup', 'F1',
+                                                             'dF1'))
+    for threshold in args.thresholds:
+        model.exit_threshold = None if threshold == 'none' else float(threshold)
+        model.reset_exit_stats()
+
+        s_time = time.perf_counter()
+        preds, _ = _predict(model, features, torch.device('cpu'), args.batch_size, rel_label_id)
+        elapsed = time.perf_counter() - s_time
+
+        y_pred = [[label_map.get(p, 'O') for p in pred[1:len(labels) + 1]] for pred, labels in zip(preds, y_true)]
+        result = {
+            'threshold': threshold,
+            'average_layers': model.average_layers_executed(),
+            'num_layers': num_layers,
+            'time_s': elapsed,
+            'f1_token': eval_seq_labeling.f1_score(y_true, y_pred),
+        }
+        if baseline is None:
+            baseline = result
+        result['speedup'] = baseline['time_s'] / elapsed
+        result['f1_delta'] = result['f1_token'] - baseline['f1_token']
+        results.append(result)
+        print('{:<10s} {:>8.2f} {:>10.2f} {:>8.2f} {:>8.1f} {:>+8.1f}'.format(
+            threshold, result['average_layers'], elapsed, result['speedup'], 100 * result['f1_token'],
+            100 * result['f1_delta']))
+
+    if args.output_file:
+        json.dump(results, open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
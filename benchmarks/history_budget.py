@@ -0,0 +1,154 @@
+"""
+Token F1 and CPU latency of a trained model under different history budgets
+(see tools/history_budget.py), e.g.:
+
+    python -m benchmarks.history_budget --model_dir ./models/191790_50 \
+        --data_dir ./data/trec_cast_2019/token_classification/ --dev_on dev_cast dev_quac \
+        --turns_files cast_dev_raw.tsv quac_dev_raw.tsv
+
+Every example is run on its own (batch size 1, as in the online setting) and its
+latency covers tokenization, feature conversion and the forward pass. F1 is computed
+on the full history: history terms dropped by the budget count as predicted O, so
+the quality cost of a budget includes the relevant terms it removes.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from pytorch_transformers import BertTokenizer
+
+from run_ner import ConvSearchProcessor, InputExample, Ner, convert_example_to_feature
+from tools import eval_seq_labeling
+from tools.history_budget import apply_history_budget, parse_history_budget, read_turn_lengths
+
+DEFAULT_BUDGETS = ['none', 'last_turns:1', 'last_turns:2', 'last_turns:3', 'first_and_last_turns:1',
+                   'first_and_last_turns:2', 'tokens:32', 'tokens:64', 'tokens:128']
+
+
+def run_budget(model, tokenizer, lines, budget, label_list, max_seq_length, qid2turn_lengths, turn_delimiters,
+               warmup=5):
+    """Returns (y_true, y_pred, input lengths, latencies in seconds) for the examples in lines."""
+    label_map = {label: i for i, label in enumerate(label_list, 1)}
+    id2label = {i: label for label, i in label_map.items()}
+
+    y_true, y_pred, input_lengths, latencies = [], [], [], []
+    for n, (_id, tokens, labels) in enumerate(lines):
+        # words without wordpieces are not labelled (as in run_ner)
+        has_tokens = [bool(tokenizer.tokenize(w)) for w in tokens]
+        num_history = tokens.index('[SEP]') if '[SEP]' in tokens else len(tokens)
+
+        s_time = time.perf_counter()
+        budget_tokens, budget_labels, kept = apply_history_budget(tokens, labels, budget,
+                                                                  turn_lengths=qid2turn_lengths.get(_id),
+                                                                  delimiters=turn_delimiters)
+        example = InputExample(guid=_id, text_a=' '.join(budget_tokens), label=budget_labels)
+        feature = convert_example_to_feature(example, label_map, max_seq_length, tokenizer)[0]
+        with torch.no_grad():
+            logits = model(torch.tensor([feature.input_ids]), torch.tensor([feature.segment_ids]),
+                           torch.tensor([feature.input_mask]), valid_ids=torch.tensor([feature.valid_ids]))
+        preds = torch.argmax(logits, dim=2)[0].numpy()
+        latency = time.perf_counter() - s_time
+
+        # predictions of the kept history words, in order
+        kept_history = [i for i in kept if i < num_history and has_tokens[i]]
+        num_predicted = feature.label_id.index(label_map['[SEP]']) - 1
+        position2pred = {i: id2label.get(int(preds[j + 1]), 'O')
+                         for j, i in enumerate(kept_history[:num_predicted])}
+
+        history = [i for i in range(num_history) if has_tokens[i]]
+        y_true.append([labels[i] for i in history])
+        y_pred.append([position2pred.get(i, 'O') for i in history])
+        input_lengths.append(sum(feature.input_mask))
+        if n >= warmup:
+            latencies.append(latency)
+
+    return y_true, y_pred, input_lengths, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Token F1 and CPU latency under history budgets.')
+
+    parser.add_argument("--model_dir", type=str, required=True,
+                        help="Directory of a trained model (base_dir/model_id).")
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--dev_on", type=str, nargs='+', required=True,
+                        help="Splits to evaluate (data_dir/<split>.json).")
+    parser.add_argument("--turns_files", type=str, nargs='*', default=[],
+                        help="Raw query files of the splits, used to find the turn boundaries.")
+    parser.add_argument("--turn_delimiters", type=str, default='?',
+                        help="Space-separated words that end a turn, if the turn boundaries are not known.")
+    parser.add_argument("--budgets", type=str, nargs='+', default=DEFAULT_BUDGETS,
+                        help="History budgets to compare ('none' keeps the full history).")
+    parser.add_argument("--num_threads", type=int, default=1,
+                        help="Number of torch threads.")
+    parser.add_argument("--max_examples", type=int, default=None,
+                        help="Use at most this many examples per split.")
+    parser.add_argument("--warmup", type=int, default=5,
+                        help="Number of examples excluded from the latency statistics.")
+    parser.add_argument("--output_file", type=str,
+                        help="Optional json file for the results.")
+
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    model_config = json.load(open(os.path.join(args.model_dir, "model_config.json")))
+    max_seq_length = model_config['max_seq_length']
+    tokenizer = BertTokenizer.from_pretrained(args.model_dir, do_lower_case=model_config['do_lower'])
+    model = Ner.from_pretrained(args.model_dir)
+    model.eval()
+
+    qid2turn_lengths = dict()
+    for turns_file in args.turns_files:
+        qid2turn_lengths.update(read_turn_lengths(turns_file))
+    turn_delimiters = args.turn_delimiters.split()
+
+    processor = ConvSearchProcessor()
+    label_list = processor.get_labels()
+
+    results = []
+    print('{:<24s} {:<24s} {:>6s} {:>6s} {:>6s} {:>8s} {:>8s} {:>8s} {:>8s} {:>8s}'.format(
+        'split', 'budget', 'P', 'R', 'F1', 'tokens', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'))
+    for split in args.dev_on:
+        lines = processor.read_json_file(os.path.join(args.data_dir, "{}.json".format(split)))
+        if args.max_examples:
+            lines = lines[:args.max_examples]
+
+        for budget_spec in args.budgets:
+            budget = None if budget_spec == 'none' else parse_history_budget(budget_spec)
+            y_true, y_pred, input_lengths, latencies = run_budget(model, tokenizer, lines, budget, label_list,
+                                                                  max_seq_length, qid2turn_lengths,
+                                                                  turn_delimiters, warmup=args.warmup)
+            latencies_ms = 1000 * np.asarray(latencies if latencies else [np.nan])
+            result = {
+                'split': split,
+                'budget': budget_spec,
+                'num_examples': len(lines),
+                'precision_token': eval_seq_labeling.precision_score(y_true, y_pred),
+                'recall_token': eval_seq_labeling.recall_score(y_true, y_pred),
+                'f1_token': eval_seq_labeling.f1_score(y_true, y_pred),
+                'mean_input_tokens': float(np.mean(input_lengths)),
+                'mean_ms': float(np.mean(latencies_ms)),
+                'p50_ms': float(np.percentile(latencies_ms, 50)),
+                'p95_ms': float(np.percentile(latencies_ms, 95)),
+                'p99_ms': float(np.percentile(latencies_ms, 99)),
+            }
+            results.append(result)
+            print('{:<24s} {:<24s} {:>6.1f} {:>6.1f} {:>6.1f} {:>8.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+                split, budget_spec, 100 * result['precision_token'], 100 * result['recall_token'],
+                100 * result['f1_token'], result['mean_input_tokens'], result['mean_ms'], result['p50_ms'],
+                result['p95_ms'], result['p99_ms']))
+
+    if args.output_file:
+        json.dump(results, open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Load time and memory of N inference processes per weight format:
+
+    python -m benchmarks.model_loading --model_dir ./models/$MODEL_ID --num_workers 1 8 --cold
+
+Formats:
+
+    bin          Ner.from_pretrained (pytorch_model.bin read into private memory)
+    mmap         the memory-mapped weights of tools/mmap_weights.py
+    mmap_fp16    the same, stored in fp16 (converted back when loaded)
+
+The mmap files are exported to a temporary directory. Every worker is a separate process
+that loads the model and runs one forward pass (which faults in the mapped weights),
+then waits while its memory is read. total_rss_mb adds up the RSS of the workers, so
+shared pages are counted once per worker. total_pss_mb shares every page among the
+processes that map it, so it is the physical memory the workers use together. With
+--cold, the weight files are dropped from the page cache before every run.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+FORMATS = ['bin', 'mmap', 'mmap_fp16']
+
+
+def _memory_kb(pid, field):
+    # Rss or Pss of a process, from /proc/<pid>/smaps_rollup (Linux >= 4.14)
+    with open('/proc/{}/smaps_rollup'.format(pid)) as fin:
+        for line in fin:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise ValueError('{} not found for process {}'.format(field, pid))
+
+
+def _drop_from_page_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _worker(model_dir, weights_dir, fmt, seq_length, results, done):
+    import torch
+    from run_ner import _model_class
+    from tools.mmap_weights import load_mmap_model
+
+    torch.set_num_threads(1)
+    s_time = time.perf_counter()
+    if fmt == 'bin':
+        model = _model_class(model_dir).from_pretrained(model_dir)
+    else:
+        model = load_mmap_model(_model_class(model_dir), model_dir, path=os.path.join(weights_dir, fmt))
+    model.eval()
+    load_s = time.perf_counter() - s_time
+
+    s_time = time.perf_counter()
+    input_ids = torch.randint(1, model.config.vocab_size, (1, seq_length))
+    ones = torch.ones_like(input_ids)
+    with torch.no_grad():
+        model(input_ids, torch.zeros_like(input_ids), ones, valid_ids=ones)
+    results.put({'pid': os.getpid(), 'load_s': load_s, 'first_forward_s': time.perf_counter() - s_time})
+    # keep the model mapped while the parent reads the memory
+    done.wait()
+
+
+def measure(model_dir, weights_dir, fmt, num_workers, seq_length, cold=False):
+    if cold:
+        for path in [os.path.join(model_dir, 'pytorch_model.bin')] + \
+                [os.path.join(weights_dir, f) for f in os.listdir(weights_dir)]:
+            _drop_from_page_cache(path)
+
+    context = multiprocessing.get_context('spawn')
+    results, done = context.Queue(), context.Event()
+    workers = [context.Process(target=_worker, args=(model_dir, weights_dir, fmt, seq_length, results, done))
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        worker_results = []
+        while len(worker_results) < num_workers:
+            try:
+                worker_results.append(results.get(timeout=1))
+            except queue.Empty:
+                if any(worker.exitcode for worker in workers):
+                    raise RuntimeError('A worker failed ({} with {} workers)'.format(fmt, num_workers))
+        total_rss = sum(_memory_kb(r['pid'], 'Rss') for r in worker_results)
+        total_pss = sum(_memory_kb(r['pid'], 'Pss') for r in worker_results)
+    finally:
+        done.set()
+        for worker in workers:
+            worker.join()
+
+    load_times = [r['load_s'] for r in worker_results]
+    return {
+        'format': fmt,
+        'num_workers': num_workers,
+        'load_s_mean': float(np.mean(load_times)),
+        'load_s_max': float(np.max(load_times)),
+        'first_forward_s_mean': float(np.mean([r['first_forward_s'] for r in worker_results])),
+        'total_rss_mb': total_rss / 1024,
+        'total_pss_mb': total_pss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load time and memory of inference processes per weight format.')
+
+    parser.add_argument("--model_dir", type=str, required=True,
+                        help="Directory of a trained model (base_dir/model_id).")
+    parser.add_argument("--num_workers", type=int, nargs='+', default=[1, 8])
+    parser.add_argument("--formats", type=str, nargs='+', default=FORMATS, choices=FORMATS)
+    parser.add_argument("--seq_length", type=int, default=128,
+                        help="Sequence length of the forward pass of every worker.")
+    parser.add_argument("--cold", action='store_true',
+                        help="Drop the weight files from the page cache before every run.")
+    parser.add_argument("--output_file", type=str,
+                        help="Optional json file for the results.")
+
+    args = parser.parse_args()
+
+    from run_ner import _model_class
+    from tools.mmap_weights import export_mmap_weights
+
+    weights_dir = tempfile.mkdtemp(prefix='quretec_weights_')
+    try:
+        state_dict = _model_class(args.model_dir).from_pretrained(args.model_dir).state_dict()
+        export_mmap_weights(state_dict, os.path.join(weights_dir, 'mmap'))
+        export_mmap_weights(state_dict, os.path.join(weights_dir, 'mmap_fp16'), fp16=True)
+        del state_dict
+
+        print('{:>10s} {:>8s} {:>12s} {:>11s} {:>14s} {:>13s} {:>13s}'.format(
+            'format', 'workers', 'load_s_mean', 'load_s_max', 'first_forward_s', 'total_rss_mb', 'total_pss_mb'))
+        results = []
+        for num_workers in args.num_workers:
+            for fmt in args.formats:
+                result = measure(args.model_dir, weights_dir, fmt, num_workers, args.seq_length, cold=args.cold)
+                results.append(result)
+                print('{:>10s} {:>8d} {:>12.3f} {:>11.3f} {:>14.3f} {:>13.1f} {:>13.1f}'.format(
+                    fmt, num_workers, result['load_s_mean'], result['load_s_max'], result['first_forward_s_mean'],
+                    result['total_rss_mb'], result['total_pss_mb']))
+    finally:
+        shutil.rmtree(weights_dir)
+
+    if args.output_file:
+        json.dump({'settings': vars(args), 'results': results}, open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
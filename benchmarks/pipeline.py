@@ -0,0 +1,239 @@
+"""
+Micro-benchmarks of the stages of the QuReTeC pipeline on synthetic conversations,
+with a tiny randomly initialized model, so no data or checkpoint is needed:
+
+    python -m benchmarks.pipeline --num_conversations 200 --turns 8 --words_per_turn 10 \
+        --output_file pipeline_$(git rev-parse --short HEAD).json
+
+Stages (each timed separately, best and median of --repeats runs):
+
+    read_json_file              ConvSearchProcessor.read_json_file
+    create_examples             ConvSearchProcessor._create_examples
+    convert_examples_to_features
+    build_tensors               the input tensors of run_ner._predict
+    forward                     Ner.forward over all batches
+    decode_predictions          the decoding of run_ner._do_eval
+    metrics                     token P/R/F1 (tools/eval_seq_labeling.py)
+    generate_query_file         generate_single_model_query_file
+
+The results (with the settings and versions) are written as json for comparison
+between commits.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import torch
+from pytorch_transformers import BertConfig, BertTokenizer
+
+from generate_query_files_for_trained_model import generate_single_model_query_file
+from run_ner import ConvSearchProcessor, Ner, _predict, convert_examples_to_features, decode_predictions
+from tools import eval_seq_labeling
+from tools.wordpiece import TrieWordPieceTokenizer
+
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+
+
+def make_vocab(vocab_size, rng):
+    """Synthetic word pieces: whole words and '##' continuations."""
+    words = ['w{}'.format(i) for i in range(vocab_size // 2)]
+    continuations = ['##s{}'.format(i) for i in range(vocab_size - len(words))]
+    return SPECIAL_TOKENS + words + continuations
+
+
+def make_conversations(num_conversations, turns, words_per_turn, vocab, rng, rel_rate=0.2):
+    """Synthetic data in the ConvSearchProcessor json format, and the turns as {qid: question}.
+
+    Every turn after the first becomes an example with the previous turns as history, as
+    in the real data (CAsT qids: topic_turn). Some words consist of two word pieces.
+    """
+    words = [w for w in vocab if w.startswith('w')]
+    continuations = [w[2:] for w in vocab if w.startswith('##')]
+
+    def word():
+        w = rng.choice(words)
+        return w + rng.choice(continuations) if rng.random() < 0.3 else w
+
+    data = []
+    qid2question = dict()
+    for topic in range(1, num_conversations + 1):
+        history = []
+        for turn in range(1, turns + 1):
+            qid = '{}_{}'.format(topic, turn)
+            question = [word() for _ in range(words_per_turn)]
+            qid2question[qid] = ' '.join(question)
+            if history:
+                tokens = history + ['[SEP]'] + question
+                labels = ['REL' if rng.random() < rel_rate else 'O' for _ in history] + ['[SEP]'] + \
+                         ['O'] * len(question)
+                data.append({'id': qid, 'bert_ner_overlap': [tokens, labels]})
+            history = history + question
+    return data, qid2question
+
+
+def make_model(vocab_size, num_labels, hidden_size, num_layers, max_seq_length, seed):
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size_or_config_json_file=vocab_size, hidden_size=hidden_size,
+                        num_hidden_layers=num_layers, num_attention_heads=max(1, hidden_size // 32),
+                        intermediate_size=4 * hidden_size, max_position_embeddings=max(512, max_seq_length),
+                        num_labels=num_labels)
+    model = Ner(config)
+    model.eval()
+    return model
+
+
+def _time(func, repeats):
+    times = []
+    result = None
+    for _ in range(repeats):
+        s_time = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - s_time)
+    return result, times
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, work_dir):
+    rng = random.Random(args.seed)
+    vocab = make_vocab(args.vocab_size, rng)
+    vocab_file = os.path.join(work_dir, 'vocab.txt')
+    with open(vocab_file, 'w') as fout:
+        fout.write('\n'.join(vocab) + '\n')
+    tokenizer = BertTokenizer(vocab_file, do_lower_case=True)
+
+    data, qid2question = make_conversations(args.num_conversations, args.turns, args.words_per_turn, vocab, rng)
+    data_file = os.path.join(work_dir, 'synthetic.json')
+    json.dump(data, open(data_file, 'w'))
+
+    processor = ConvSearchProcessor(dev_on='synthetic')
+    label_list = processor.get_labels()
+    rel_label_id = label_list.index('REL') + 1
+    model = make_model(len(vocab), len(label_list) + 1, args.hidden_size, args.num_layers, args.max_seq_length,
+                       args.seed)
+    device = torch.device('cpu')
+
+    stages = []
+
+    def stage(name, func, num_items):
+        result, times = _time(func, args.repeats)
+        stages.append({'stage': name, 'num_items': num_items, 'best_s': min(times),
+                       'median_s': float(np.median(times)), 'items_per_s': num_items / max(min(times), 1e-12)})
+        print('{:<30s} {:>8d} {:>12.4f} {:>12.4f} {:>14.1f}'.format(name, num_items, min(times),
+                                                                   float(np.median(times)),
+                                                                   stages[-1]['items_per_s']))
+        return result
+
+    print('{:<30s} {:>8s} {:>12s} {:>12s} {:>14s}'.format('stage', 'items', 'best_s', 'median_s', 'items/s'))
+    lines = stage('read_json_file', lambda: processor.read_json_file(data_file), len(data))
+    examples = stage('create_examples', lambda: processor._create_examples(lines, 'dev'), len(lines))
+    # a new trie tokenizer per run, so that its word cache starts empty as in run_ner.py
+    features = stage('convert_examples_to_features',
+                     lambda: convert_examples_to_features(
+                         examples, label_list, args.max_seq_length,
+                         tokenizer if args.no_fast_tokenizer else TrieWordPieceTokenizer(tokenizer)),
+                     len(examples))
+
+    def build_tensors():
+        return [torch.tensor([getattr(f, name) for f in features], dtype=torch.long)
+                for name in ['input_ids', 'input_mask', 'segment_ids', 'valid_ids', 'label_mask']]
+
+    input_ids, input_mask, segment_ids, valid_ids, _ = stage('build_tensors', build_tensors, len(features))
+
+    def forward():
+        with torch.no_grad():
+            for i in range(0, len(features), args.batch_size):
+                batch = slice(i, i + args.batch_size)
+                model(input_ids[batch], segment_ids[batch], input_mask[batch], valid_ids=valid_ids[batch])
+
+    stage('forward', forward, len(features))
+
+    all_preds, all_rel_probs = _predict(model, features, device, args.batch_size, rel_label_id)
+    _ids, x_input, y_true, y_pred, y_prob = stage(
+        'decode_predictions', lambda: decode_predictions(features, all_preds, all_rel_probs, label_list, tokenizer),
+        len(features))
+
+    def metrics():
+        return (eval_seq_labeling.f1_score(y_true, y_pred), eval_seq_labeling.precision_score(y_true, y_pred),
+                eval_seq_labeling.recall_score(y_true, y_pred))
+
+    stage('metrics', metrics, len(y_true))
+
+    model_output_file = os.path.join(work_dir, 'eval_results_synthetic_epoch0.json')
+    json.dump({'ids': _ids, 'x_input': x_input, 'y_true': y_true, 'y_pred': y_pred, 'y_prob': y_prob},
+              open(model_output_file, 'w'))
+    def generate_query_file():
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_single_model_query_file('cast', list(qid2question), model_output_file, qid2question,
+                                             os.path.join(work_dir, 'queries.tsv'))
+
+    stage('generate_query_file', generate_query_file, len(qid2question))
+
+    return {
+        'settings': vars(args),
+        'num_examples': len(data),
+        'num_features': len(features),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'num_threads': torch.get_num_threads(),
+        'stages': stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stage micro-benchmarks on synthetic conversations.')
+
+    parser.add_argument("--num_conversations", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=8,
+                        help="Turns per conversation (every turn after the first is an example).")
+    parser.add_argument("--words_per_turn", type=int, default=10)
+    parser.add_argument("--vocab_size", type=int, default=2000)
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no_fast_tokenizer", action='store_true',
+                        help="Convert examples with BertTokenizer instead of the trie-based tokenizer (as run_ner.py).")
+    parser.add_argument("--num_threads", type=int, default=1,
+                        help="Number of torch threads.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output_file", type=str,
+                        help="Optional json file for the results.")
+
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    work_dir = tempfile.mkdtemp(prefix='quretec_bench_')
+    try:
+        results = run(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output_file:
+        json.dump(results, open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
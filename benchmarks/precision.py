@@ -0,0 +1,189 @@
+"""
+Parity, throughput and peak memory of bf16 (run_ner.py --precision bf16) vs fp32
+training and evaluation on CPU, e.g.:
+
+    python -m benchmarks.precision --model_dir ./models/$MODEL_ID --data_dir $DATA_DIR \
+        --dev_on dev_cast --train_on train_quac
+
+Every (phase, precision) pair runs in a fresh process, so its peak RSS is its own.
+Parity is checked on the dev split: token F1, label agreement and the largest
+difference in REL probability between fp32 and bf16.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _load(model_dir):
+    from pytorch_transformers import BertTokenizer
+    from run_ner import _model_class
+
+    model_config = json.load(open(os.path.join(model_dir, "model_config.json")))
+    tokenizer = BertTokenizer.from_pretrained(model_dir, do_lower_case=model_config['do_lower'])
+    model = _model_class(model_dir).from_pretrained(model_dir)
+    return model, tokenizer, model_config
+
+
+def _eval_job(model_dir, data_dir, dev_on, precision, batch_size, num_threads):
+    import torch
+    from run_ner import ConvSearchProcessor, _predict, convert_examples_to_features
+    from tools import eval_seq_labeling
+
+    torch.set_num_threads(num_threads)
+    model, tokenizer, model_config = _load(model_dir)
+    model.eval()
+    processor = ConvSearchProcessor(dev_on=dev_on)
+    label_list = processor.get_labels()
+    label_map = {i: label for i, label in enumerate(label_list, 1)}
+    sep_label_id = label_list.index('[SEP]') + 1
+    rel_label_id = label_list.index('REL') + 1
+
+    examples = processor.get_dev_examples(data_dir, uppercase=not model_config['do_lower'])
+    features = convert_examples_to_features(examples, label_list, model_config['max_seq_length'], tokenizer)
+    y_true = [[label_map[l] for l in f.label_id[1:f.label_id.index(sep_label_id)]] for f in features]
+
+    device = torch.device('cpu')
+    _predict(model, features[:batch_size], device, batch_size, rel_label_id, precision=precision)
+    s_time = time.perf_counter()
+    preds, rel_probs = _predict(model, features, device, batch_size, rel_label_id, precision=precision)
+    elapsed = time.perf_counter() - s_time
+
+    y_pred = [[label_map.get(p, 'O') for p in pred[1:len(labels) + 1]] for pred, labels in zip(preds, y_true)]
+    return {
+        'examples_per_s': len(features) / elapsed,
+        'peak_rss_mb': _peak_rss_mb(),
+        'f1_token': eval_seq_labeling.f1_score(y_true, y_pred),
+        'y_pred': y_pred,
+        'y_prob': [[float(p) for p in probs[1:len(labels) + 1]] for probs, labels in zip(rel_probs, y_true)],
+    }
+
+
+def _train_job(model_dir, data_dir, train_on, precision, batch_size, num_steps, num_threads):
+    import torch
+    from pytorch_transformers import AdamW
+    from torch.utils.data import DataLoader, RandomSampler, TensorDataset
+    from run_ner import ConvSearchProcessor, autocast, convert_examples_to_features
+
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(42)
+    model, tokenizer, model_config = _load(model_dir)
+    model.train()
+    processor = ConvSearchProcessor(train_on=train_on)
+    label_list = processor.get_labels()
+
+    examples = processor.get_train_examples(data_dir, uppercase=not model_config['do_lower'])
+    examples = examples[:batch_size * (num_steps + 1)]
+    features = convert_examples_to_features(examples, label_list, model_config['max_seq_length'], tokenizer)
+    data = TensorDataset(*[torch.tensor([getattr(f, name) for f in features], dtype=torch.long)
+                           for name in ['input_ids', 'input_mask', 'segment_ids', 'label_id', 'valid_ids',
+                                        'label_mask']])
+    dataloader = DataLoader(data, sampler=RandomSampler(data), batch_size=batch_size)
+    optimizer = AdamW(model.parameters(), lr=1e-5)
+    device = torch.device('cpu')
+
+    num_examples = 0
+    s_time = None
+    for step, (input_ids, input_mask, segment_ids, label_ids, valid_ids, l_mask) in enumerate(dataloader):
+        if step == 1:
+            # the first step is a warm-up
+            s_time = time.perf_counter()
+            num_examples = 0
+        with autocast(device, precision):
+            loss = model(input_ids, segment_ids, input_mask, label_ids, valid_ids, l_mask)
+        loss.backward()
+        optimizer.step()
+        model.zero_grad()
+        num_examples += input_ids.size(0)
+    elapsed = time.perf_counter() - s_time if s_time is not None else float('nan')
+
+    return {
+        'examples_per_s': num_examples / elapsed,
+        'peak_rss_mb': _peak_rss_mb(),
+        'last_loss': loss.item(),
+    }
+
+
+def _run_in_fresh_process(func, *args):
+    pool = multiprocessing.get_context('spawn').Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bf16 vs fp32 parity, throughput and memory.')
+
+    parser.add_argument("--model_dir", type=str, required=True,
+                        help="Directory of a trained model (base_dir/model_id).")
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--dev_on", type=str, required=True,
+                        help="Split for the evaluation (data_dir/<split>.json).")
+    parser.add_argument("--train_on", type=str,
+                        help="Split for the training steps (data_dir/<split>.json); skipped if not given.")
+    parser.add_argument("--eval_batch_size", type=int, default=8)
+    parser.add_argument("--train_batch_size", type=int, default=32)
+    parser.add_argument("--train_steps", type=int, default=20,
+                        help="Number of timed training steps.")
+    parser.add_argument("--num_threads", type=int, default=os.cpu_count(),
+                        help="Number of torch threads.")
+    parser.add_argument("--output_file", type=str,
+                        help="Optional json file for the results.")
+
+    args = parser.parse_args()
+
+    results = dict()
+    for precision in ['fp32', 'bf16']:
+        results['eval_' + precision] = _run_in_fresh_process(_eval_job, args.model_dir, args.data_dir, args.dev_on,
+                                                             precision, args.eval_batch_size, args.num_threads)
+        if args.train_on:
+            results['train_' + precision] = _run_in_fresh_process(_train_job, args.model_dir, args.data_dir,
+                                                                  args.train_on, precision, args.train_batch_size,
+                                                                  args.train_steps, args.num_threads)
+
+    fp32, bf16 = results['eval_fp32'], results['eval_bf16']
+    labels_fp32 = [l for labels in fp32.pop('y_pred') for l in labels]
+    labels_bf16 = [l for labels in bf16.pop('y_pred') for l in labels]
+    probs_fp32 = [p for probs in fp32.pop('y_prob') for p in probs]
+    probs_bf16 = [p for probs in bf16.pop('y_prob') for p in probs]
+    parity = {
+        'f1_fp32': fp32['f1_token'],
+        'f1_bf16': bf16['f1_token'],
+        'f1_delta': bf16['f1_token'] - fp32['f1_token'],
+        'label_agreement': sum(a == b for a, b in zip(labels_fp32, labels_bf16)) / max(len(labels_fp32), 1),
+        'max_rel_prob_diff': max([abs(a - b) for a, b in zip(probs_fp32, probs_bf16)] or [0.]),
+    }
+    results['parity'] = parity
+
+    print('Parity on {}: F1 fp32={:.2f} bf16={:.2f} (delta {:+.2f}), label agreement {:.4f}, '
+          'max |dP(REL)| {:.4f}'.format(args.dev_on, 100 * parity['f1_fp32'], 100 * parity['f1_bf16'],
+                                        100 * parity['f1_delta'], parity['label_agreement'],
+                                        parity['max_rel_prob_diff']))
+    print('{:<8s} {:<6s} {:>12s} {:>14s}'.format('phase', 'prec', 'examples/s', 'peak_rss_mb'))
+    for phase in ['eval', 'train']:
+        for precision in ['fp32', 'bf16']:
+            key = '{}_{}'.format(phase, precision)
+            if key in results:
+                print('{:<8s} {:<6s} {:>12.1f} {:>14.1f}'.format(phase, precision, results[key]['examples_per_s'],
+                                                              results[key]['peak_rss_mb']))
+
+    if args.output_file:
+        json.dump(results, open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+CPU inference scaling of QuReTeC: request latency (p50/p95/p99) and throughput over
+a grid of batch size, sequence length, torch intra-op threads and worker processes,
+e.g. for a trained model:
+
+    python -m benchmarks.scaling --model_dir ./models/$MODEL_ID --batch_sizes 1 8 32 \
+        --seq_lengths 128 300 --num_threads 1 2 4 --num_workers 1 2 4 --output_file scaling.json
+
+or, without a checkpoint, for a randomly initialized model of a given size:
+
+    python -m benchmarks.scaling --hidden_size 1024 --num_layers 24 --seq_lengths 300
+
+Every request is one call of run_ner._predict (the forward path of _do_eval) on
+batch_size inputs of seq_length tokens. The inputs come from --data_dir/--dev_on if
+given, else they are random token ids filling the whole sequence (the worst case).
+Every worker is a separate process with its own copy of the model, and all workers send
+requests at the same time; examples/s is the throughput of all workers together.
+The saturation curve lists the throughput of every (seq_length, batch_size) by the number
+of cores used (workers x threads).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+
+def _load_model(model_spec):
+    import torch
+    from run_ner import _model_class
+    from benchmarks.pipeline import make_model
+
+    if model_spec.get('model_dir'):
+        model = _model_class(model_spec['model_dir']).from_pretrained(model_spec['model_dir'])
+    else:
+        model = make_model(model_spec['vocab_size'], 5, model_spec['hidden_size'], model_spec['num_layers'],
+                           model_spec['max_seq_length'], seed=42)
+    model.eval()
+    model.to(torch.device('cpu'))
+    return model
+
+
+def make_features(num_features, seq_length, vocab_size, cls_id=101, sep_id=102, seed=42):
+    """Random inputs of seq_length tokens: [CLS] history [SEP] current turn [SEP]."""
+    from run_ner import InputFeatures
+
+    rng = random.Random(seed)
+    features = []
+    history_length = (seq_length - 3) * 3 // 4
+    for _ in range(num_features):
+        input_ids = [cls_id] + [rng.randrange(min(1000, vocab_size // 2), vocab_size)
+                                for _ in range(seq_length - 2)] + [sep_id]
+        # labels: O (1) for the history, [SEP] (4), O for the current turn, as in the real data
+        label_id = [3] + [1] * history_length + [4] + [1] * (seq_length - history_length - 3)
+        features.append(InputFeatures(input_ids=input_ids, input_mask=[1] * seq_length, segment_ids=[0] * seq_length,
+                                      label_id=label_id + [0] * (seq_length - len(label_id)),
+                                      valid_ids=[1] * seq_length, label_mask=[1] * seq_length))
+    return features
+
+
+def _data_features(data_spec, seq_length, num_features):
+    from pytorch_transformers import BertTokenizer
+    from run_ner import ConvSearchProcessor, convert_examples_to_features
+
+    processor = ConvSearchProcessor(dev_on=data_spec['dev_on'])
+    tokenizer = BertTokenizer.from_pretrained(data_spec['model_dir'], do_lower_case=data_spec['do_lower_case'])
+    examples = processor.get_dev_examples(data_spec['data_dir'])
+    features = convert_examples_to_features(examples, processor.get_labels(), seq_length, tokenizer)
+    return [features[i % len(features)] for i in range(num_features)]
+
+
+def _worker(model_spec, data_spec, seq_length, batch_size, num_threads, num_requests, precision, barrier,
+            cpu_queue=None):
+    # runs in a fresh process: returns the latencies of its requests and when it ran them
+    import torch
+    from run_ner import _predict
+    from tools.topology import apply_topology
+
+    apply_topology(num_threads, cpu_queue.get() if cpu_queue is not None else None)
+    model = _load_model(model_spec)
+    num_features = batch_size * num_requests
+    if data_spec:
+        features = _data_features(data_spec, seq_length, num_features)
+    elif model_spec.get('model_dir'):
+        from pytorch_transformers import BertTokenizer
+        cls_id, sep_id = BertTokenizer.from_pretrained(model_spec['model_dir']).convert_tokens_to_ids(
+            ['[CLS]', '[SEP]'])
+        features = make_features(num_features, seq_length, model.config.vocab_size, cls_id=cls_id, sep_id=sep_id)
+    else:
+        features = make_features(num_features, seq_length, model.config.vocab_size)
+    device = torch.device('cpu')
+
+    # warm up
+    _predict(model, features[:batch_size], device, batch_size, 2, precision=precision)
+    barrier.wait()
+
+    latencies = []
+    s_time = time.time()
+    for i in range(num_requests):
+        t = time.perf_counter()
+        _predict(model, features[i * batch_size:(i + 1) * batch_size], device, batch_size, 2, precision=precision)
+        latencies.append(time.perf_counter() - t)
+    return {'latencies': latencies, 'num_examples': num_features, 'start': s_time, 'end': time.time()}
+
+
+def _silence_progress():
+    # _predict shows a tqdm progress bar per request
+    import sys
+    sys.stderr = open(os.devnull, 'w')
+
+
+def measure(model_spec, data_spec, seq_length, batch_size, num_threads, num_workers, num_requests,
+            precision='fp32', pin=False):
+    """Latency percentiles and throughput of num_workers processes with num_threads threads each
+    (pinned to their own cores with pin)."""
+    from tools.topology import worker_cpus
+
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    # the workers start sending requests together, once all of them have loaded the model
+    barrier = manager.Barrier(num_workers)
+    cpu_queue = None
+    if pin:
+        cpu_queue = manager.Queue()
+        for cpus in worker_cpus(num_workers, num_threads):
+            cpu_queue.put(cpus)
+    pool = context.Pool(num_workers, initializer=_silence_progress)
+    try:
+        pending = [pool.apply_async(_worker, (model_spec, data_spec, seq_length, batch_size, num_threads,
+                                              num_requests, precision, barrier, cpu_queue))
+                   for _ in range(num_workers)]
+        results = [r.get() for r in pending]
+    finally:
+        pool.close()
+        pool.join()
+        manager.shutdown()
+
+    latencies = np.asarray([l for r in results for l in r['latencies']]) * 1000
+    elapsed = max(r['end'] for r in results) - min(r['start'] for r in results)
+    return {
+        'seq_length': seq_length,
+        'batch_size': batch_size,
+        'num_threads': num_threads,
+        'num_workers': num_workers,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'examples_per_s': sum(r['num_examples'] for r in results) / elapsed,
+    }
+
+
+def saturation_curves(results):
+    """{(seq_length, batch_size): [(cores, best examples/s with that many cores)]}."""
+    curves = dict()
+    for result in results:
+        key = (result['seq_length'], result['batch_size'])
+        cores = result['num_threads'] * result['num_workers']
+        curve = curves.setdefault(key, dict())
+        curve[cores] = max(curve.get(cores, 0.), result['examples_per_s'])
+    return {key: sorted(curve.items()) for key, curve in curves.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU inference latency and throughput scaling.')
+
+    parser.add_argument("--model_dir", type=str,
+                        help="Directory of a trained model (base_dir/model_id); a random model if not given.")
+    parser.add_argument("--hidden_size", type=int, default=1024,
+                        help="Hidden size of the random model (bert-large: 1024).")
+    parser.add_argument("--num_layers", type=int, default=24,
+                        help="Number of layers of the random model (bert-large: 24).")
+    parser.add_argument("--vocab_size", type=int, default=30522)
+    parser.add_argument("--data_dir", type=str,
+                        help="Use the inputs of data_dir/<dev_on>.json (requires --model_dir) instead of random ones.")
+    parser.add_argument("--dev_on", type=str, default='test_oracle_rewrite')
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument("--seq_lengths", type=int, nargs='+', default=[64, 128, 300])
+    parser.add_argument("--num_threads", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--num_workers", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--num_requests", type=int, default=50,
+                        help="Timed requests per worker and grid point.")
+    parser.add_argument("--max_cores", type=int, default=os.cpu_count(),
+                        help="Skip the grid points with more than this many workers x threads.")
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16'])
+    parser.add_argument("--pin", action='store_true',
+                        help="Pin every worker to its own cores.")
+    parser.add_argument("--output_file", type=str,
+                        help="Optional json file for the results.")
+
+    args = parser.parse_args()
+
+    if args.data_dir and not args.model_dir:
+        parser.error('--data_dir requires --model_dir')
+
+    model_spec = {'model_dir': args.model_dir, 'hidden_size': args.hidden_size, 'num_layers': args.num_layers,
+                  'vocab_size': args.vocab_size, 'max_seq_length': max(args.seq_lengths)}
+    data_spec = None
+    if args.data_dir:
+        model_config = json.load(open(os.path.join(args.model_dir, "model_config.json")))
+        data_spec = {'data_dir': args.data_dir, 'dev_on': args.dev_on, 'model_dir': args.model_dir,
+                     'do_lower_case': model_config['do_lower']}
+
+    print('{:>7s} {:>6s} {:>8s} {:>8s} {:>9s} {:>9s} {:>9s} {:>11s}'.format(
+        'seq_len', 'batch', 'threads', 'workers', 'p50_ms', 'p95_ms', 'p99_ms', 'examples/s'))
+    results = []
+    for seq_length, batch_size, num_threads, num_workers in itertools.product(
+            args.seq_lengths, args.batch_sizes, args.num_threads, args.num_workers):
+        if num_threads * num_workers > args.max_cores:
+            continue
+        result = measure(model_spec, data_spec, seq_length, batch_size, num_threads, num_workers,
+                         args.num_requests, precision=args.precision, pin=args.pin)
+        results.append(result)
+        print('{:>7d} {:>6d} {:>8d} {:>8d} {:>9.1f} {:>9.1f} {:>9.1f} {:>11.1f}'.format(
+            seq_length, batch_size, num_threads, num_workers, result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], result['examples_per_s']))
+
+    curves = saturation_curves(results)
+    print('\nSaturation (examples/s by cores = workers x threads):')
+    for (seq_length, batch_size), curve in sorted(curves.items()):
+        print('  seq_len={} batch={}: {}'.format(seq_length, batch_size, ', '.join(
+            '{}: {:.1f}'.format(cores, examples_per_s) for cores, examples_per_s in curve)))
+
+    if args.output_file:
+        json.dump({'settings': vars(args), 'results': results,
+                   'saturation': [{'seq_length': seq_length, 'batch_size': batch_size,
+                                   'curve': [{'cores': cores, 'examples_per_s': examples_per_s}
+                                             for cores, examples_per_s in curve]}
+                                  for (seq_length, batch_size), curve in sorted(curves.items())]},
+                  open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import argparse
-import json
 import os
+from itertools import zip_longest
+
+from tools.json_stream import iter_json_array, iter_jsonl
 
 
 def _is_first_turn(qid, dataset_name):
@@ -8,18 +10,166 @@ def _is_first_turn(qid, dataset_name):
            or (dataset_name.startswith('cast') and qid.endswith('_1'))
 
 
-def generate_single_model_query_file(dataset_name, qrels, model_output_file, qid2curquestion, output_file):
-
-    model_output_dct = json.load(open(model_output_file))
-
-    id2model_output = dict()
-    for qid, x_input, y_pred in zip(model_output_dct['ids'], model_output_dct['x_input'],
-                                    model_output_dct['y_pred']):
-        id2model_output[qid] = {'x_input': x_input,
-                                'y_pred': y_pred}
+def _get_topic_id(qid, dataset_name):
+    separator = '#' if dataset_name == 'quac' else '_'
+    return qid[:qid.index(separator)]
+
+
+def _unique_in_order(tokens):
+    seen = set()
+    return [w for w in tokens if not (w in seen or seen.add(w))]
+
+
+_END = object()
+
+
+def _iter_json_model_output(model_output_file, keys):
+    # reads the parallel arrays of an eval_results_*.json file in lockstep
+    arrays = [iter_json_array(model_output_file, key) for key in keys]
+    try:
+        for values in zip_longest(*arrays, fillvalue=_END):
+            if any(value is _END for value in values):
+                raise ValueError('The {} arrays of {} have different lengths.'.format(
+                    ', '.join(keys), model_output_file))
+            yield dict(zip(['id'] + keys[1:], values))
+    except KeyError as e:
+        raise ValueError('{} has no {} array.'.format(model_output_file, e))
+
+
+def iter_model_output(model_output_files, threshold=None, with_probs=False):
+    """Yields {'id', 'x_input', 'y_pred'} records of one or more model output files, one at a time.
+
+    Supported formats: the eval_results_*.json files written by run_ner.py and json lines files
+    (.jsonl) with one record per line. If threshold is given, y_pred is derived from the REL
+    probabilities (y_prob) instead of the argmax labels. If with_probs is set, records also
+    contain y_prob.
+    """
+    if isinstance(model_output_files, str):
+        model_output_files = [model_output_files]
+
+    for model_output_file in model_output_files:
+        if model_output_file.endswith('.jsonl'):
+            records = iter_jsonl(model_output_file)
+        else:
+            keys = ['ids', 'x_input']
+            if threshold is None:
+                keys.append('y_pred')
+            if threshold is not None or with_probs:
+                keys.append('y_prob')
+            records = _iter_json_model_output(model_output_file, keys)
+
+        for record in records:
+            if threshold is not None or with_probs:
+                if 'y_prob' not in record:
+                    raise ValueError('{} has no REL probabilities (y_prob); re-run the evaluation with run_ner.py.'
+                                     .format(model_output_file))
+            if threshold is not None:
+                record['y_pred'] = ['REL' if p >= threshold else 'O' for p in record['y_prob']]
+            yield record
+
+
+def _lookup(qid, records, pending, max_lookahead=None):
+    """Returns the record of qid, reading ahead in the stream until it is found (or at most
+    max_lookahead records), or None if it is not in the stream.
+
+    Records read ahead are kept in `pending`. Memory stays bounded when both sides are in the
+    same order; otherwise up to the whole stream is kept, as with a dict join.
+    """
+    if qid in pending:
+        return pending.pop(qid)
+    num_read = 0
+    while max_lookahead is None or num_read < max_lookahead:
+        record = next(records, None)
+        if record is None:
+            break
+        num_read += 1
+        if record['id'] == qid:
+            return record
+        pending[record['id']] = record
+    return None
+
+
+class _QueryFileWriter(object):
+    """Writes queries to one file, or to one file per topic (<output_file root>.<topic id><ext>)."""
+
+    def __init__(self, output_file, dataset_name, shard_by_topic=False):
+        self.output_file = output_file
+        self.dataset_name = dataset_name
+        self.shard_by_topic = shard_by_topic
+        self.written_files = []
+        self._fw = None
+        self._topic_id = None
+
+    def _open(self, path):
+        if self._fw is not None:
+            self._fw.close()
+        # topics are normally contiguous; append if a topic shows up again
+        self._fw = open(path, 'a' if path in self.written_files else 'w')
+        if path not in self.written_files:
+            self.written_files.append(path)
+
+    def write(self, qid, query):
+        if self.shard_by_topic:
+            topic_id = _get_topic_id(qid, self.dataset_name)
+            if topic_id != self._topic_id:
+                root, ext = os.path.splitext(self.output_file)
+                self._open('{}.{}{}'.format(root, topic_id, ext))
+                self._topic_id = topic_id
+        elif self._fw is None:
+            self._open(self.output_file)
+        self._fw.write('{}\t{}\n'.format(qid, query))
+
+    def close(self):
+        if self._fw is not None:
+            self._fw.close()
+            self._fw = None
+
+
+def _report_missing(missing_model_output, missing_raw_queries):
+    if missing_model_output:
+        print('Warning: {} qids are missing from (at least one) model output, e.g. {}'
+              .format(len(missing_model_output), missing_model_output[:5]))
+    if missing_raw_queries:
+        print('Warning: {} qids of the model output are not in the raw query file, e.g. {}'
+              .format(len(missing_raw_queries), missing_raw_queries[:5]))
+
+
+ENSEMBLE_METHODS = ['majority', 'union', 'intersection', 'mean_prob']
+
+
+def _combine_predictions(records, method, threshold=0.5, num_models=None):
+    """Returns the REL terms of one query given the records of one or more models.
+
+    num_models: the size of the ensemble (default: len(records)). Models without a record count
+    as predicting no REL term (a REL probability of 0).
+    """
+    num_models = num_models or len(records)
+    if method == 'mean_prob':
+        length = min(len(record['y_prob']) for record in records)
+        is_rel = [sum(record['y_prob'][j] for record in records) / num_models >= threshold
+                  for j in range(length)]
+    else:
+        min_votes = {'majority': num_models // 2 + 1,
+                     'union': 1,
+                     'intersection': num_models}[method]
+        length = min(len(record['y_pred']) for record in records)
+        is_rel = [sum(record['y_pred'][j] == 'REL' for record in records) >= min_votes
+                  for j in range(length)]
+    return [w for w, rel in zip(records[0]['x_input'], is_rel) if rel]
+
+
+def _write_query_file(dataset_name, qrels, qid2curquestion, output_file, streams, method, threshold,
+                      shard_by_topic, allow_missing):
+    # Joins the model output streams with qrels in one pass. Records read ahead of their qid are kept
+    # in one pending dict per stream. A qid (other than a first turn) that is not in a model output
+    # raises a ValueError, unless allow_missing. Returns the qids missing on either side.
+
+    pendings = [dict() for _ in streams]
+    missing_model_output = []
     num_queries = 0
 
-    with open(output_file, 'w') as fw:
+    writer = _QueryFileWriter(output_file, dataset_name, shard_by_topic=shard_by_topic)
+    try:
         for qid in qrels:
 
             num_queries += 1
@@ -27,17 +177,75 @@ def generate_single_model_query_file(dataset_name, qrels, model_output_file, qid
             cur_question_expansion = str(cur_question)
 
             if _is_first_turn(qid, dataset_name):
+                # consume the (empty) model output of the first turn if it is next in the stream
+                for records, pending in zip(streams, pendings):
+                    _lookup(qid, records, pending, max_lookahead=1)
                 predicted_tokens = None
             else:
-                x_input = id2model_output[qid]['x_input']
-                y_pred = id2model_output[qid]['y_pred']
-                predicted_tokens = set([w for w, l in zip(x_input, y_pred) if l == 'REL'])
+                found = [_lookup(qid, records, pending) for records, pending in zip(streams, pendings)]
+                found = [record for record in found if record is not None]
+                if len(found) < len(streams):
+                    if not allow_missing:
+                        raise ValueError('{} is missing from {} of {} model output(s); use '
+                                         '--allow_missing_model_output to write such queries anyway'.format(
+                                             qid, len(streams) - len(found), len(streams)))
+                    missing_model_output.append(qid)
+                predicted_tokens = _unique_in_order(_combine_predictions(found, method, threshold,
+                                                                         num_models=len(streams))) \
+                    if found else None
 
             if predicted_tokens:
                 cur_question_expansion += ' ' + ' '.join(predicted_tokens)
-            fw.write('{}\t{}\n'.format(qid, cur_question_expansion))
+            writer.write(qid, cur_question_expansion)
+    finally:
+        writer.close()
+
+    qrels = set(qrels)
+    missing_raw_queries = set()
+    for records, pending in zip(streams, pendings):
+        missing_raw_queries.update(qid for qid in pending if qid not in qrels)
+        missing_raw_queries.update(record['id'] for record in records if record['id'] not in qrels)
+    missing_raw_queries = sorted(missing_raw_queries)
 
     print('Written {} queries.'.format(num_queries))
+    _report_missing(missing_model_output, missing_raw_queries)
+
+    return {'missing_model_output': missing_model_output,
+            'missing_raw_queries': missing_raw_queries}
+
+
+def generate_single_model_query_file(dataset_name, qrels, model_output_file, qid2curquestion, output_file,
+                                     threshold=None, shard_by_topic=False, allow_missing=False):
+    # threshold: if given, a term is REL when its REL probability is >= threshold (instead of the argmax label)
+    # The model output is streamed and joined with qrels in one pass. REL terms are added in order of
+    # first occurrence. allow_missing: write queries missing from the model output without expansion
+    # (with a warning) instead of raising a ValueError. Returns the qids missing on either side.
+
+    streams = [iter_model_output(model_output_file, threshold=threshold)]
+    return _write_query_file(dataset_name, qrels, qid2curquestion, output_file, streams, 'union', None,
+                             shard_by_topic, allow_missing)
+
+
+def generate_ensemble_query_file(dataset_name, qrels, model_output_files, qid2curquestion, output_file,
+                                 method='majority', threshold=None, shard_by_topic=False, allow_missing=False):
+    # model_output_files: one entry (a file or a list of shards) per model.
+    # method: majority / union / intersection of the per-model REL decisions, or mean_prob, where a term
+    # is REL if its REL probability averaged over the models is >= threshold (default 0.5).
+    # The model outputs are streamed in lockstep by qid, so memory does not grow with the number of models
+    # (when they are in the order of the raw queries). With allow_missing, a model without the output
+    # of a qid counts as predicting no REL term for it.
+
+    if method not in ENSEMBLE_METHODS:
+        raise ValueError('Unknown ensemble method: {}'.format(method))
+
+    if method == 'mean_prob':
+        streams = [iter_model_output(f, with_probs=True) for f in model_output_files]
+        threshold = 0.5 if threshold is None else threshold
+    else:
+        streams = [iter_model_output(f, threshold=threshold) for f in model_output_files]
+
+    return _write_query_file(dataset_name, qrels, qid2curquestion, output_file, streams, method, threshold,
+                             shard_by_topic, allow_missing)
 
 
 def read_qid2curquestion(input_filename):
@@ -63,7 +271,9 @@ def _get_qrel_file(dataset_name, split, data_dir='/ivi/ilps/projects/Trec_CAST_2
     return path
 
 
-def generate_query_file(raw_query_filename, model_output_file, output_file, dataset_name):
+def generate_query_file(raw_query_filename, model_output_file, output_file, dataset_name, threshold=None,
+                        shard_by_topic=False, ensemble_method=None, allow_missing=False):
+    # ensemble_method: if given, model_output_file is a list with the output of each model of the ensemble
     qid2curquestion = read_qid2curquestion(raw_query_filename)
 
     # print(len(qid2curquestion))
@@ -71,7 +281,14 @@ def generate_query_file(raw_query_filename, model_output_file, output_file, data
     qrels = list(qid2curquestion.keys())
     # print(qrels[:5])
 
-    generate_single_model_query_file(dataset_name, qrels, model_output_file, qid2curquestion, output_file)
+    if ensemble_method is None:
+        generate_single_model_query_file(dataset_name, qrels, model_output_file, qid2curquestion, output_file,
+                                         threshold=threshold, shard_by_topic=shard_by_topic,
+                                         allow_missing=allow_missing)
+    else:
+        generate_ensemble_query_file(dataset_name, qrels, model_output_file, qid2curquestion, output_file,
+                                     method=ensemble_method, threshold=threshold, shard_by_topic=shard_by_topic,
+                                     allow_missing=allow_missing)
 
     print('Done.')
 
@@ -81,7 +298,11 @@ def main():
 
     parser.add_argument("--model_output_file",
                         type=str,
-                        required=True)
+                        nargs='+',
+                        action='append',
+                        required=True,
+                        help="Model output file(s) (.json or .jsonl). Multiple files are read as consecutive shards. "
+                             "Repeat the argument (once per model) to build an ensemble.")
 
     parser.add_argument("--raw_query_file",
                         type=str,
@@ -97,12 +318,41 @@ def main():
                         required=True,
                         )
 
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=None,
+                        help="REL probability threshold. Defaults to the argmax predictions of the model.")
+
+    parser.add_argument("--shard_by_topic",
+                        action='store_true',
+                        help="Write one query file per topic (<output_file root>.<topic id><ext>).")
+
+    parser.add_argument("--allow_missing_model_output",
+                        action='store_true',
+                        help="Write queries that are missing from the model output without expansion (with a "
+                             "warning) instead of failing.")
+
+    parser.add_argument("--ensemble_method",
+                        default='majority',
+                        choices=ENSEMBLE_METHODS,
+                        help="How to combine the REL decisions when more than one model is given. "
+                             "mean_prob uses --threshold (default 0.5) on the mean REL probability.")
+
     args = parser.parse_args()
 
+    if len(args.model_output_file) == 1:
+        model_output_file, ensemble_method = args.model_output_file[0], None
+    else:
+        model_output_file, ensemble_method = args.model_output_file, args.ensemble_method
+
     generate_query_file(args.raw_query_file,
-                        args.model_output_file,
+                        model_output_file,
                         args.output_file,
-                        args.dataset_name)
+                        args.dataset_name,
+                        threshold=args.threshold,
+                        shard_by_topic=args.shard_by_topic,
+                        ensemble_method=ensemble_method,
+                        allow_missing=args.allow_missing_model_output)
 
 
 if __name__ == '__main__':
@@ -8,9 +8,12 @@ Developed for the SIGIR 2020 paper: Query Resolution for Conversational Search w
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 import argparse
+import contextlib
+import copy
 import glob
 import json
 import logging
+import multiprocessing
 import os
 import random
 import time
@@ -25,12 +28,25 @@ from pytorch_transformers import (WEIGHTS_NAME, AdamW, BertConfig,
                                   BertForTokenClassification, BertTokenizer,
                                   WarmupLinearSchedule)
 from torch import nn
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+from torch.utils.data import (DataLoader, IterableDataset, RandomSampler, SequentialSampler,
+                              Subset, TensorDataset, get_worker_info)
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
 from tools import eval_seq_labeling as eval_seq_labeling_token
+from tools.json_stream import iter_json_array, iter_jsonl
+from tools.history_budget import apply_history_budget, parse_history_budget, read_turn_lengths
+from tools.batch_size import BatchSizeCache, accumulation_for, cache_key, find_batch_size
+from tools.experiment_registry import ExperimentRegistry
+from tools.features_cache import FEATURE_ARRAYS, features_cache_key, load_features, save_features
+from tools.prediction_cache import PredictionCache, model_fingerprint
+from tools.profiling import Profiler, StepRangeProfiler, parse_step_range
+from tools.mmap_weights import has_mmap_weights, load_mmap_model
+from tools.memory import MemoryTracker, tensors_nbytes, training_state_nbytes
+from tools.telemetry import Telemetry
+from tools.topology import HostProfile, apply_topology, worker_cpus
+from tools.wordpiece import TrieWordPieceTokenizer
+from tools.soft_labels import feature_key, load_soft_labels, save_soft_labels
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -43,33 +59,136 @@ class Ner(BertForTokenClassification):
     def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None,valid_ids=None,
                 attention_mask_label=None):
         sequence_output = self.bert(input_ids, token_type_ids, attention_mask,head_mask=None)[0]
-        batch_size,max_len,feat_dim = sequence_output.shape
-        valid_output = torch.zeros(batch_size,max_len,feat_dim,dtype=torch.float32)  # ,device='cuda')
-
-        for i in range(batch_size):
-            jj = -1
-            for j in range(max_len):
-                    if valid_ids[i][j].item() == 1:
-                        jj += 1
-                        valid_output[i][jj] = sequence_output[i][j]
+        valid_output = gather_valid_output(sequence_output, valid_ids)
         sequence_output = self.dropout(valid_output)
         logits = self.classifier(sequence_output)
 
         if labels is not None:
-            loss_fct = nn.CrossEntropyLoss(ignore_index=0)
-            # Only keep active parts of the loss
-            #attention_mask_label = None
-            if attention_mask_label is not None:
-                active_loss = attention_mask_label.view(-1) == 1
-                active_logits = logits.view(-1, self.num_labels)[active_loss]
-                active_labels = labels.view(-1)[active_loss]
-                loss = loss_fct(active_logits, active_labels)
-            else:
-                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
-            return loss
+            return self._loss(logits, labels, attention_mask_label)
         else:
             return logits
 
+    def _loss(self, logits, labels, attention_mask_label=None):
+        loss_fct = nn.CrossEntropyLoss(ignore_index=0)
+        logits = logits.float()  # in case of reduced precision
+        # Only keep active parts of the loss
+        #attention_mask_label = None
+        if attention_mask_label is not None:
+            active_loss = attention_mask_label.view(-1) == 1
+            active_logits = logits.view(-1, self.num_labels)[active_loss]
+            active_labels = labels.view(-1)[active_loss]
+            loss = loss_fct(active_logits, active_labels)
+        else:
+            loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+        return loss
+
+
+def gather_valid_output(sequence_output, valid_ids):
+    """Moves the outputs of the valid positions (first wordpiece of every word) of each
+    sequence to the front, in order, and fills the rest with zeros."""
+    batch_size, max_len, feat_dim = sequence_output.shape
+    valid = valid_ids == 1
+    # target position of every valid position; the others go to an extra slot that is dropped
+    target = torch.where(valid, valid.long().cumsum(1) - 1, torch.full_like(valid_ids, max_len))
+    valid_output = sequence_output.new_zeros(batch_size, max_len + 1, feat_dim)
+    valid_output.scatter_(1, target.unsqueeze(2).expand(-1, -1, feat_dim), sequence_output)
+    return valid_output[:, :max_len]
+
+
+class EarlyExitNer(Ner):
+    """Ner with extra token classifiers on intermediate layers (config.exit_layers, 1-based).
+
+    Training (config.exit_loss):
+        joint: the cross entropy of every exit classifier is added to that of the final one.
+        distill: BERT and the final classifier are frozen and every exit classifier is
+            trained to match the (softmax of the) final classifier.
+
+    At inference with exit_threshold set, a batch stops at the first exit layer at
+    which the highest label probability of every active position (attention_mask_label)
+    is at least exit_threshold, and the logits of that layer are returned.
+    """
+
+    def __init__(self, config):
+        super(EarlyExitNer, self).__init__(config)
+        self.exit_layers = sorted(getattr(config, 'exit_layers', range(1, config.num_hidden_layers)))
+        self.exit_loss = getattr(config, 'exit_loss', 'joint')
+        self.exit_classifiers = nn.ModuleList([nn.Linear(config.hidden_size, config.num_labels)
+                                               for _ in self.exit_layers])
+        self.exit_threshold = None
+        self.init_weights()
+        self.reset_exit_stats()
+
+    def reset_exit_stats(self):
+        self.num_examples = 0
+        self.num_layers_executed = 0
+
+    def average_layers_executed(self):
+        return self.num_layers_executed / self.num_examples if self.num_examples else 0.
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None,valid_ids=None,
+                attention_mask_label=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+
+        if labels is not None:
+            return self._train_loss(input_ids, token_type_ids, extended_attention_mask, labels, valid_ids,
+                                    attention_mask_label)
+
+        if attention_mask_label is not None:
+            active = attention_mask_label == 1
+        else:
+            active = torch.ones_like(valid_ids) == 1
+        layer2exit = dict(zip(self.exit_layers, self.exit_classifiers))
+
+        hidden_states = self.bert.embeddings(input_ids, token_type_ids=token_type_ids)
+        num_layers = len(self.bert.encoder.layer)
+        for i, layer in enumerate(self.bert.encoder.layer, 1):
+            hidden_states = layer(hidden_states, extended_attention_mask)[0]
+            if i < num_layers and self.exit_threshold is not None and i in layer2exit:
+                logits = layer2exit[i](self.dropout(gather_valid_output(hidden_states, valid_ids)))
+                confidence = F.softmax(logits, dim=2).max(dim=2)[0]
+                if bool((confidence[active] >= self.exit_threshold).all()):
+                    break
+        else:
+            logits = self.classifier(self.dropout(gather_valid_output(hidden_states, valid_ids)))
+
+        self.num_examples += input_ids.size(0)
+        self.num_layers_executed += i * input_ids.size(0)
+        return logits
+
+    def _train_loss(self, input_ids, token_type_ids, extended_attention_mask, labels, valid_ids,
+                    attention_mask_label):
+        with torch.set_grad_enabled(self.exit_loss == 'joint' and torch.is_grad_enabled()):
+            hidden_states = self.bert.embeddings(input_ids, token_type_ids=token_type_ids)
+            all_hidden_states = []
+            for layer in self.bert.encoder.layer:
+                hidden_states = layer(hidden_states, extended_attention_mask)[0]
+                all_hidden_states.append(hidden_states)
+            final_logits = self.classifier(self.dropout(gather_valid_output(hidden_states, valid_ids)))
+
+        exit_logits = [exit_classifier(self.dropout(gather_valid_output(all_hidden_states[layer - 1], valid_ids)))
+                       for layer, exit_classifier in zip(self.exit_layers, self.exit_classifiers)]
+
+        if self.exit_loss == 'joint':
+            return sum(self._loss(logits, labels, attention_mask_label) for logits in [final_logits] + exit_logits)
+
+        # distill: match the final classifier on the labelled positions
+        if attention_mask_label is not None:
+            active = attention_mask_label.view(-1) == 1
+        else:
+            active = labels.view(-1) > 0
+        targets = F.softmax(final_logits.view(-1, self.num_labels)[active].detach(), dim=1)
+        loss = 0.
+        for logits in exit_logits:
+            log_probs = F.log_softmax(logits.view(-1, self.num_labels)[active], dim=1)
+            loss = loss + F.kl_div(log_probs, targets, reduction='batchmean')
+        return loss
+
 
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
@@ -95,7 +214,8 @@ class InputExample(object):
 class InputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_id, valid_ids=None, label_mask=None, _id=None):
+    def __init__(self, input_ids, input_mask, segment_ids, label_id, valid_ids=None, label_mask=None, _id=None,
+                 window_start=0):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
@@ -103,6 +223,8 @@ class InputFeatures(object):
         self.valid_ids = valid_ids
         self.label_mask = label_mask
         self._id = _id
+        # index of the first history word of this window (see convert_example_to_feature)
+        self.window_start = window_start
 
 
 def readfile(filename):
@@ -188,17 +310,22 @@ class ConvSearchProcessor(NerProcessor):
     """Processor for Conversational Search datasets.
     """
 
-    def __init__(self, add_sep=True, part='bert_ner_overlap', train_on='train_quac', dev_on='train_cast'):
+    def __init__(self, add_sep=True, part='bert_ner_overlap', train_on='train_quac', dev_on='train_cast',
+                 history_budget=None, qid2turn_lengths=None, turn_delimiters=('?',)):
         # add_sep: whether to add a separator token before the last query
         logger.debug('add_sep', add_sep)
         # self.add_sep = add_sep
         self.part = part
         self.train_on = train_on
         self.dev_on = dev_on
+        # history_budget: (policy, K) (see tools/history_budget.py), or None to keep the full history
+        self.history_budget = history_budget
+        self.qid2turn_lengths = qid2turn_lengths if qid2turn_lengths is not None else dict()
+        self.turn_delimiters = turn_delimiters
 
     def read_json_file(self, path, uppercase=False):
         data = [self._get_line(line, uppercase)
-                for line in json.load(open(path))]
+                for line in (iter_jsonl(path) if path.endswith('.jsonl') else json.load(open(path)))]
         return data
 
     def _get_line(self, line, uppercase):
@@ -206,6 +333,45 @@ class ConvSearchProcessor(NerProcessor):
         tokens, labels = line[self.part]
         return _id, tokens, labels
 
+    def get_data_files(self, data_dir, name):
+        """Files of a split: <name>.json, <name>.jsonl, the .json/.jsonl shards in the directory
+        <name>, or the files matching the glob pattern <name> (e.g. train_ws-*.jsonl)."""
+        path = os.path.join(data_dir, name)
+        for ext in ['.json', '.jsonl']:
+            if os.path.isfile(path + ext):
+                return [path + ext]
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, '*.json')) + glob.glob(os.path.join(path, '*.jsonl')))
+        else:
+            files = sorted(glob.glob(path))
+        if not files:
+            raise ValueError('No data files found for {} in {}'.format(name, data_dir))
+        return files
+
+    def read_split(self, data_dir, name, uppercase=False):
+        data = []
+        for path in self.get_data_files(data_dir, name):
+            data.extend(self.read_json_file(path, uppercase=uppercase))
+        return data
+
+    def iter_split(self, files, uppercase=False):
+        """Yields the lines of the given data files one at a time."""
+        for path in files:
+            records = iter_jsonl(path) if path.endswith('.jsonl') else iter_json_array(path)
+            for line in records:
+                yield self._get_line(line, uppercase)
+
+    def get_topic_id(self, qid):
+        separator = '#' if 'quac' in self.train_on else '_'
+        return qid[:qid.index(separator)]
+
+    def sample_topics(self, topic_ids, portion):
+        """Samples a portion of the conversations (topics)."""
+        num_topics_to_sample = int(portion * len(topic_ids))
+        sampled_topic_ids = set(random.sample(sorted(topic_ids), num_topics_to_sample))
+        logger.info('Sampled {} / {} conversations'.format(len(sampled_topic_ids), len(topic_ids)))
+        return sampled_topic_ids
+
     def get_train_examples(self, data_dir, portion=1.0, uppercase=False):
         """See base class.
         Portion is used for sampling a part of the training dataset (0, 1)
@@ -213,44 +379,72 @@ class ConvSearchProcessor(NerProcessor):
 
         assert 0 < portion <= 1.0
 
-        file_content = self.read_json_file(os.path.join(data_dir, "{}.json".format(self.train_on)),
-                                           uppercase=uppercase)
+        file_content = self.read_split(data_dir, self.train_on, uppercase=uppercase)
         if portion < 1.0:
             # sample by conversation id
 
             num_qids = len(file_content)
 
-            separator = '#' if 'quac' in self.train_on else '_'
-            topic_ids = set()
-            qid2topicid = dict()
-            for qid, _, _ in file_content:
-                topic_id = qid[:qid.index(separator)]
-                topic_ids.add(topic_id)
-                qid2topicid[qid] = topic_id
-
-            num_topics_to_sample = int(portion * len(topic_ids))
-            sampled_topic_ids = random.sample(topic_ids, num_topics_to_sample)
-
-            logger.info('Sampled {} / {} conversations'.format(len(sampled_topic_ids), len(topic_ids)))
+            sampled_topic_ids = self.sample_topics({self.get_topic_id(qid) for qid, _, _ in file_content}, portion)
 
             file_content = [(qid, tokens, labels) for qid, tokens, labels in file_content
-                            if qid2topicid[qid] in sampled_topic_ids]
+                            if self.get_topic_id(qid) in sampled_topic_ids]
 
             logger.info('Sampled {} / {} qids'.format(len(file_content), num_qids))
 
         return self._create_examples(file_content, "train")
 
+    def get_streaming_train_dataset(self, data_dir, label_list, max_seq_length, tokenizer, portion=1.0,
+                                    uppercase=False, **kwargs):
+        """A `StreamingFeatureDataset` over the training split, its number of examples and its number of
+        features.
+
+        A first pass over the data only counts the examples of every conversation, so that a
+        portion of the conversations can be sampled as in `get_train_examples`. With a
+        window_stride, it also converts every example to count its windows.
+        """
+        assert 0 < portion <= 1.0
+
+        window_stride = kwargs.get('window_stride')
+        label_map = {label : i for i, label in enumerate(label_list,1)}
+        files = self.get_data_files(data_dir, self.train_on)
+        topic2count = dict()
+        topic2num_features = dict()
+        for line in self.iter_split(files, uppercase=uppercase):
+            topic_id = self.get_topic_id(line[0])
+            topic2count[topic_id] = topic2count.get(topic_id, 0) + 1
+            num_features = 1
+            if window_stride is not None:
+                example = self._create_examples([line], "train")[0]
+                num_features = len(convert_example_to_feature(example, label_map, max_seq_length, tokenizer,
+                                                              window_stride=window_stride))
+            topic2num_features[topic_id] = topic2num_features.get(topic_id, 0) + num_features
+        num_examples = sum(topic2count.values())
+        num_features = sum(topic2num_features.values())
+        logger.info('Streaming {} examples ({} features) from {} file(s)'.format(num_examples, num_features,
+                                                                                 len(files)))
+
+        sampled_topic_ids = None
+        if portion < 1.0:
+            sampled_topic_ids = self.sample_topics(set(topic2count), portion)
+            sampled_num_examples = sum(topic2count[topic_id] for topic_id in sampled_topic_ids)
+            logger.info('Sampled {} / {} qids'.format(sampled_num_examples, num_examples))
+            num_examples = sampled_num_examples
+            num_features = sum(topic2num_features[topic_id] for topic_id in sampled_topic_ids)
+
+        dataset = StreamingFeatureDataset(self, files, label_list, max_seq_length, tokenizer,
+                                          topic_ids=sampled_topic_ids, uppercase=uppercase, **kwargs)
+        return dataset, num_examples, num_features
+
     def get_dev_examples(self, data_dir, uppercase=False):
         """See base class."""
         return self._create_examples(
-            self.read_json_file(os.path.join(data_dir, "{}.json".format(self.dev_on)),
-                                uppercase=uppercase), "dev")
+            self.read_split(data_dir, self.dev_on, uppercase=uppercase), "dev")
 
     def get_test_examples(self, data_dir, uppercase=False):
         """See base class."""
         return self._create_examples(
-            self.read_json_file(os.path.join(data_dir, "test.json"),
-                                uppercase=uppercase), "test")
+            self.read_split(data_dir, "test", uppercase=uppercase), "test")
 
     def get_labels(self):
         return ["O", "REL", "[CLS]", "[SEP]"]
@@ -258,6 +452,10 @@ class ConvSearchProcessor(NerProcessor):
     def _create_examples(self,lines,set_type):
         examples = []
         for i,(_id, sentence, label) in enumerate(lines):
+            if self.history_budget is not None:
+                sentence, label, _ = apply_history_budget(sentence, label, self.history_budget,
+                                                          turn_lengths=self.qid2turn_lengths.get(_id),
+                                                          delimiters=self.turn_delimiters)
             text_a = ' '.join(sentence)
             text_b = None
             label = label
@@ -265,8 +463,81 @@ class ConvSearchProcessor(NerProcessor):
         return examples
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer):
-    """Loads a data file into a list of `InputBatch`s."""
+class StreamingFeatureDataset(IterableDataset):
+    """Streams training features from data files without loading them into memory.
+
+    Lines are read one at a time, converted to examples (`ConvSearchProcessor._create_examples`)
+    and features, and shuffled through a buffer of shuffle_buffer_size features. Every
+    DataLoader worker reads its own shard: whole files if there are at least as many files
+    as workers, else every n-th line. Call `set_epoch` before every epoch to reshuffle.
+    Shards can differ in size, so distributed processes (which need the same number of
+    batches each) cannot share it.
+    """
+
+    def __init__(self, processor, files, label_list, max_seq_length, tokenizer, topic_ids=None, window_stride=None,
+                 shuffle_buffer_size=10000, seed=42, uppercase=False):
+        self.processor = processor
+        self.files = files
+        self.label_map = {label : i for i, label in enumerate(label_list,1)}
+        self.max_seq_length = max_seq_length
+        self.tokenizer = tokenizer
+        self.topic_ids = topic_ids
+        self.window_stride = window_stride
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.uppercase = uppercase
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shard(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        return worker_id, num_workers
+
+    def _iter_lines(self, shard_id, num_shards):
+        if len(self.files) >= num_shards:
+            for line in self.processor.iter_split(self.files[shard_id::num_shards], uppercase=self.uppercase):
+                yield line
+        else:
+            for i, line in enumerate(self.processor.iter_split(self.files, uppercase=self.uppercase)):
+                if i % num_shards == shard_id:
+                    yield line
+
+    def _iter_features(self, shard_id, num_shards):
+        for line in self._iter_lines(shard_id, num_shards):
+            if self.topic_ids is not None and self.processor.get_topic_id(line[0]) not in self.topic_ids:
+                continue
+            example = self.processor._create_examples([line], "train")[0]
+            for f in convert_example_to_feature(example, self.label_map, self.max_seq_length, self.tokenizer,
+                                                window_stride=self.window_stride):
+                yield tuple(torch.tensor(x, dtype=torch.long) for x in
+                            [f.input_ids, f.input_mask, f.segment_ids, f.label_id, f.valid_ids, f.label_mask])
+
+    def __iter__(self):
+        shard_id, num_shards = self._shard()
+        rng = random.Random(self.seed + 1000003 * self.epoch + shard_id)
+        buffer = []
+        for tensors in self._iter_features(shard_id, num_shards):
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(tensors)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = tensors
+        rng.shuffle(buffer)
+        for tensors in buffer:
+            yield tensors
+
+
+def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, window_stride=None):
+    """Loads a data file into a list of `InputBatch`s.
+
+    Without window_stride, sequences longer than max_seq_length are truncated. With
+    window_stride, long histories are split into overlapping windows instead (see
+    `convert_example_to_feature`), so an example may give several consecutive features.
+    """
 
     label_map = {label : i for i, label in enumerate(label_list,1)}
 
@@ -274,108 +545,444 @@ def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer
     s_time = time.time()
 
     features = []
+    num_windowed = 0
     for (ex_index,example) in enumerate(examples):
-        textlist = example.text_a.split(' ')
-        labellist = example.label
-        tokens = []
-        labels = []
-        valid = []
-        label_mask = []
-        if len(textlist) != len(labellist):
-            print(ex_index)
-            print(textlist, labellist)
-            print(len(textlist), len(labellist))
-        for i, word in enumerate(textlist):
-            token = tokenizer.tokenize(word)
-            tokens.extend(token)
-            label_1 = labellist[i]
-            for m in range(len(token)):
-                if m == 0:
-                    labels.append(label_1)
-                    valid.append(1)
-                    label_mask.append(1)
-                else:
-                    valid.append(0)
-        if len(tokens) >= max_seq_length - 1:
-            tokens = tokens[0:(max_seq_length - 2)]
-            labels = labels[0:(max_seq_length - 2)]
-            valid = valid[0:(max_seq_length - 2)]
-            label_mask = label_mask[0:(max_seq_length - 2)]
-        ntokens = []
-        segment_ids = []
-        label_ids = []
-        ntokens.append("[CLS]")
-        segment_ids.append(0)
-        valid.insert(0,1)
-        label_mask.insert(0,1)
-        label_ids.append(label_map["[CLS]"])
-        for i, token in enumerate(tokens):
-            ntokens.append(token)
-            segment_ids.append(0)
-            if len(labels) > i:
-                label_ids.append(label_map[labels[i]])
-        ntokens.append("[SEP]")
-        segment_ids.append(0)
-        valid.append(1)
-        label_mask.append(1)
-        label_ids.append(label_map["[SEP]"])
-        input_ids = tokenizer.convert_tokens_to_ids(ntokens)
-
-        input_mask = [1] * len(input_ids)
-
-        # mask out labels for current turn.
-        cur_turn_index = label_ids.index(label_map['[SEP]'])
-
-        label_mask = [1] * cur_turn_index + [0] * (len(label_ids) - cur_turn_index)
-
-        assert len(label_ids) == len(label_mask)
-
-        while len(input_ids) < max_seq_length:
-            input_ids.append(tokenizer.pad_token_id)
-            input_mask.append(0)
-            segment_ids.append(0)
-            label_ids.append(0)
-            valid.append(1)
-            label_mask.append(0)
-        while len(label_ids) < max_seq_length:
-            label_ids.append(0)
-            label_mask.append(0)
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(label_ids) == max_seq_length
-        assert len(valid) == max_seq_length
-        assert len(label_mask) == max_seq_length
+        example_features = convert_example_to_feature(example, label_map, max_seq_length, tokenizer,
+                                                      window_stride=window_stride)
+        if len(example_features) > 1:
+            num_windowed += 1
 
         if ex_index < 1:
+            feature = example_features[0]
             logger.info("*** Example ***")
             logger.info("guid: %s" % (example.guid))
             logger.info("tokens: %s" % " ".join(
-                    [str(x) for x in tokens]))
-            logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-            logger.info("label_mask: %s" % " ".join([str(x) for x in label_mask]))
+                    [str(x) for x in tokenizer.convert_ids_to_tokens(feature.input_ids)[1:sum(feature.input_mask)-1]]))
+            logger.info("input_ids: %s" % " ".join([str(x) for x in feature.input_ids]))
+            logger.info("input_mask: %s" % " ".join([str(x) for x in feature.input_mask]))
+            logger.info("label_mask: %s" % " ".join([str(x) for x in feature.label_mask]))
             logger.info(
-                    "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-            logger.info("label: %s (id = %s)" % (example.label, label_ids))
-
-        features.append(
-                InputFeatures(input_ids=input_ids,
-                              input_mask=input_mask,
-                              segment_ids=segment_ids,
-                              label_id=label_ids,
-                              valid_ids=valid,
-                              label_mask=label_mask,
-                              _id=example.guid))
+                    "segment_ids: %s" % " ".join([str(x) for x in feature.segment_ids]))
+            logger.info("label: %s (id = %s)" % (example.label, feature.label_id))
+
+        features.extend(example_features)
 
         if ex_index % 1000 == 0:
             logger.info('converted {} / {} examples'.format(ex_index+1, len(examples)))
 
-    logger.info('Done converting examples to features in {:.1f} minutes'.format((time.time() - s_time) / 60))
+    if window_stride is not None:
+        logger.info('Split {} / {} examples into windows ({} features)'.format(num_windowed, len(examples),
+                                                                                len(features)))
+    elapsed = time.time() - s_time
+    logger.info('Done converting {} examples to features in {:.1f} s ({:.1f} examples/s)'.format(
+        len(examples), elapsed, len(examples) / max(elapsed, 1e-12)))
+    return features
+
+
+def convert_example_to_feature(example, label_map, max_seq_length, tokenizer, window_stride=None):
+    """Converts one example into a list of `InputFeatures`.
+
+    If the example does not fit in max_seq_length and window_stride is given, its history
+    (the words before the [SEP] word) is split into windows that overlap by all but
+    window_stride tokens, each followed by the full current turn. Windows never split a
+    word, and feature.window_start is the index of the window's first history word
+    (counting only words that give at least one token), so predictions can be merged
+    back with `merge_windows`. Otherwise, a single (possibly truncated) feature is returned.
+    """
+    textlist = example.text_a.split(' ')
+    labellist = example.label
+    if len(textlist) != len(labellist):
+        print(example.guid)
+        print(textlist, labellist)
+        print(len(textlist), len(labellist))
+
+    if isinstance(tokenizer, TrieWordPieceTokenizer):
+        word_ids = tokenizer.encode_words(textlist)
+    else:
+        word_ids = [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(word)) for word in textlist]
+    words = []
+    for i, token in enumerate(word_ids):
+        if token:
+            words.append((token, labellist[i]))
+
+    num_tokens = sum(len(token) for token, _ in words)
+    if window_stride is None or num_tokens < max_seq_length - 1 or '[SEP]' not in [l for _, l in words]:
+        return [_words_to_feature(words, example.guid, label_map, max_seq_length, tokenizer)]
+
+    num_history = [l for _, l in words].index('[SEP]')
+    history, current = words[:num_history], words[num_history:]
+    budget = max_seq_length - 2 - sum(len(token) for token, _ in current)
+    if budget < 1:
+        # the current turn alone does not fit
+        return [_words_to_feature(words, example.guid, label_map, max_seq_length, tokenizer)]
+
+    offsets = np.cumsum([0] + [len(token) for token, _ in history])
+    stride = min(window_stride, budget)
+    features = []
+    start = 0
+    while True:
+        end = max(int(np.searchsorted(offsets, offsets[start] + budget, side='right')) - 1, start + 1)
+        features.append(_words_to_feature(history[start:end] + current, example.guid, label_map, max_seq_length,
+                                          tokenizer, window_start=start))
+        if end >= num_history:
+            break
+        # first word at least stride tokens after the window start; no word is skipped
+        next_start = int(np.searchsorted(offsets, offsets[start] + stride, side='left'))
+        start = min(max(next_start, start + 1), end)
     return features
 
 
-def _load_previous_best_score(previous_model_dir, dev_on, metric='f1_token'):
+def _words_to_feature(words, guid, label_map, max_seq_length, tokenizer, window_start=0):
+    # words: [(word token ids, word label)]; the first token of every word is labelled
+    tokens = []
+    labels = []
+    valid = []
+    label_mask = []
+    for token, label_1 in words:
+        tokens.extend(token)
+        for m in range(len(token)):
+            if m == 0:
+                labels.append(label_1)
+                valid.append(1)
+                label_mask.append(1)
+            else:
+                valid.append(0)
+    if len(tokens) >= max_seq_length - 1:
+        tokens = tokens[0:(max_seq_length - 2)]
+        labels = labels[0:(max_seq_length - 2)]
+        valid = valid[0:(max_seq_length - 2)]
+        label_mask = label_mask[0:(max_seq_length - 2)]
+    ntokens = []
+    segment_ids = []
+    label_ids = []
+    ntokens.append(tokenizer.cls_token_id)
+    segment_ids.append(0)
+    valid.insert(0,1)
+    label_mask.insert(0,1)
+    label_ids.append(label_map["[CLS]"])
+    for i, token in enumerate(tokens):
+        ntokens.append(token)
+        segment_ids.append(0)
+        if len(labels) > i:
+            label_ids.append(label_map[labels[i]])
+    ntokens.append(tokenizer.sep_token_id)
+    segment_ids.append(0)
+    valid.append(1)
+    label_mask.append(1)
+    label_ids.append(label_map["[SEP]"])
+    input_ids = ntokens
+
+    input_mask = [1] * len(input_ids)
+
+    # mask out labels for current turn.
+    cur_turn_index = label_ids.index(label_map['[SEP]'])
+
+    label_mask = [1] * cur_turn_index + [0] * (len(label_ids) - cur_turn_index)
+
+    assert len(label_ids) == len(label_mask)
+
+    while len(input_ids) < max_seq_length:
+        input_ids.append(tokenizer.pad_token_id)
+        input_mask.append(0)
+        segment_ids.append(0)
+        label_ids.append(0)
+        valid.append(1)
+        label_mask.append(0)
+    while len(label_ids) < max_seq_length:
+        label_ids.append(0)
+        label_mask.append(0)
+    assert len(input_ids) == max_seq_length
+    assert len(input_mask) == max_seq_length
+    assert len(segment_ids) == max_seq_length
+    assert len(label_ids) == max_seq_length
+    assert len(valid) == max_seq_length
+    assert len(label_mask) == max_seq_length
+
+    return InputFeatures(input_ids=input_ids,
+                         input_mask=input_mask,
+                         segment_ids=segment_ids,
+                         label_id=label_ids,
+                         valid_ids=valid,
+                         label_mask=label_mask,
+                         _id=guid,
+                         window_start=window_start)
+
+
+def merge_windows(windows):
+    """Merges the per-word outputs of the windows of one example.
+
+    Args:
+        windows: [(window_start, [output of every history word in the window])].
+
+    Returns:
+        The output of every history word, taken from the window in which the word is
+        most central (i.e. has the most context on both sides).
+    """
+    num_words = max(start + len(outputs) for start, outputs in windows)
+    merged = [None] * num_words
+    best_context = [-1] * num_words
+    for start, outputs in windows:
+        for k, output in enumerate(outputs):
+            context = min(k, len(outputs) - 1 - k)
+            if context > best_context[start + k]:
+                best_context[start + k] = context
+                merged[start + k] = output
+    return merged
+
+
+def _load_tokenizer(model_dir, args):
+    tokenizer = BertTokenizer.from_pretrained(model_dir, do_lower_case=args.do_lower_case)
+    return tokenizer if args.no_fast_tokenizer else TrieWordPieceTokenizer(tokenizer)
+
+
+def _set_early_exit_config(config, args):
+    if args.exit_layers:
+        config.exit_layers = [int(layer) for layer in args.exit_layers.split(',')]
+    else:
+        config.exit_layers = list(range(1, config.num_hidden_layers))
+    config.exit_loss = args.early_exit
+
+
+def _model_class(model_dir):
+    config = json.load(open(os.path.join(model_dir, "config.json")))
+    return EarlyExitNer if 'exit_layers' in config else Ner
+
+
+def _load_trained_model(model_dir, mmap_weights=True):
+    """The trained model of model_dir, from its memory-mapped weights if they were exported (see
+    tools/mmap_weights.py), so that the processes of a host share them."""
+    if mmap_weights and has_mmap_weights(model_dir):
+        logger.info('Loading the memory-mapped weights of {}'.format(model_dir))
+        return load_mmap_model(_model_class(model_dir), model_dir)
+    return _model_class(model_dir).from_pretrained(model_dir)
+
+
+def _build_student(teacher, args, num_labels, tokenizer):
+    """A smaller Ner: from --student_config, or the teacher's config with fewer layers / a
+    smaller hidden size. If the hidden size is the teacher's, the embeddings, pooler and
+    classifier are copied from the teacher, and the layers from evenly spaced teacher
+    layers (or --student_init_layers)."""
+    if args.student_config:
+        config = BertConfig.from_json_file(args.student_config)
+        config.num_labels = num_labels
+        config.hidden_dropout_prob = args.hidden_dropout_prob
+        if config.vocab_size != tokenizer.vocab_size:
+            raise ValueError('The student vocab size ({}) differs from that of the teacher tokenizer ({})'
+                             .format(config.vocab_size, tokenizer.vocab_size))
+        logger.info('Student initialized randomly from {}'.format(args.student_config))
+        return Ner(config)
+
+    config = copy.deepcopy(teacher.config)
+    for attr in ['exit_layers', 'exit_loss']:
+        if hasattr(config, attr):
+            delattr(config, attr)
+    teacher_num_layers = config.num_hidden_layers
+    config.num_hidden_layers = args.student_layers or teacher_num_layers
+    config.hidden_dropout_prob = args.hidden_dropout_prob
+
+    if args.student_hidden_size and args.student_hidden_size != config.hidden_size:
+        if args.student_hidden_size % config.num_attention_heads:
+            raise ValueError('The student hidden size must be a multiple of the number of attention heads ({})'
+                             .format(config.num_attention_heads))
+        config.intermediate_size = config.intermediate_size * args.student_hidden_size // config.hidden_size
+        config.hidden_size = args.student_hidden_size
+        logger.info('Student initialized randomly (hidden size {} != teacher hidden size {})'
+                    .format(config.hidden_size, teacher.config.hidden_size))
+        return Ner(config)
+
+    if args.student_init_layers:
+        init_layers = [int(layer) for layer in args.student_init_layers.split(',')]
+    else:
+        init_layers = [(i + 1) * teacher_num_layers // config.num_hidden_layers - 1
+                       for i in range(config.num_hidden_layers)]
+    if len(init_layers) != config.num_hidden_layers:
+        raise ValueError('--student_init_layers must give one teacher layer per student layer')
+
+    student = Ner(config)
+    student.bert.embeddings.load_state_dict(teacher.bert.embeddings.state_dict())
+    for student_layer, teacher_layer in zip(student.bert.encoder.layer, init_layers):
+        student_layer.load_state_dict(teacher.bert.encoder.layer[teacher_layer].state_dict())
+    student.bert.pooler.load_state_dict(teacher.bert.pooler.state_dict())
+    student.classifier.load_state_dict(teacher.classifier.state_dict())
+    logger.info('Student initialized from teacher layers {}'.format(init_layers))
+    return student
+
+
+def _train_features_key(processor, data_dir, label_list, max_seq_length, tokenizer, do_lower_case,
+                        window_stride=None, turns_files=()):
+    """Hash of everything that determines the training features of processor.train_on (see
+    tools/features_cache.py)."""
+    data_files = processor.get_data_files(data_dir, processor.train_on) + list(turns_files)
+    settings = {'part': processor.part, 'history_budget': processor.history_budget,
+                'turn_delimiters': list(processor.turn_delimiters), 'label_list': label_list,
+                'max_seq_length': max_seq_length, 'window_stride': window_stride,
+                'do_lower_case': do_lower_case}
+    return features_cache_key(data_files, settings, tokenizer.vocab.keys())
+
+
+def _cached_train_data(features_cache, processor, data_dir, train_examples, label_list, max_seq_length, tokenizer,
+                       do_lower_case, window_stride=None, turns_files=()):
+    """TensorDataset of the features of train_examples, tokenized once per split (see tools/features_cache.py).
+
+    The features of the whole split are cached; train_examples (e.g. a train_portion sample)
+    selects among them.
+    """
+    cache_dir = os.path.join(features_cache, _train_features_key(processor, data_dir, label_list, max_seq_length,
+                                                                 tokenizer, do_lower_case, window_stride=window_stride,
+                                                                 turns_files=turns_files))
+
+    cached = load_features(cache_dir)
+    if cached is None:
+        logger.info('Tokenizing {} for the features cache {}'.format(processor.train_on, cache_dir))
+        examples = processor.get_train_examples(data_dir, uppercase=not do_lower_case)
+        save_features(cache_dir, convert_examples_to_features(examples, label_list, max_seq_length, tokenizer,
+                                                              window_stride=window_stride))
+        cached = load_features(cache_dir)
+    else:
+        logger.info('Loaded features from {}'.format(cache_dir))
+    arrays, ids = cached
+
+    guids = {example.guid for example in train_examples}
+    indices = [i for i, _id in enumerate(ids) if _id in guids]
+    train_data = TensorDataset(*[torch.from_numpy(arrays[name]) for name in FEATURE_ARRAYS])
+    if len(indices) < len(ids):
+        train_data = Subset(train_data, indices)
+    return train_data
+
+
+def _get_teacher_logits(teacher, teacher_model_dir, features, device, batch_size, cache_file=None,
+                        features_key=None):
+    """Logits of the teacher on the labelled positions of every feature, as a
+    [num features, max_seq_length, num labels] float16 tensor (zeros elsewhere).
+
+    They are cached in cache_file for the features of features_key (see _train_features_key),
+    and only the features missing from it are run through the teacher.
+    """
+    if cache_file and features_key is None:
+        raise ValueError('A features_key is required to cache the teacher logits.')
+    max_seq_length = len(features[0].input_ids)
+    fingerprint = model_fingerprint(teacher_model_dir)
+    key2logits = load_soft_labels(cache_file, fingerprint, features_key) if cache_file else dict()
+
+    todo = [f for f in features if feature_key(f) not in key2logits]
+    logger.info('Teacher soft labels: {} / {} features cached'.format(len(features) - len(todo), len(features)))
+    if todo:
+        all_input_ids = torch.tensor([f.input_ids for f in todo], dtype=torch.long)
+        all_input_mask = torch.tensor([f.input_mask for f in todo], dtype=torch.long)
+        all_segment_ids = torch.tensor([f.segment_ids for f in todo], dtype=torch.long)
+        all_valid_ids = torch.tensor([f.valid_ids for f in todo], dtype=torch.long)
+        data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_valid_ids)
+        dataloader = DataLoader(data, sampler=SequentialSampler(data), batch_size=batch_size)
+        teacher.eval()
+
+        k = 0
+        for input_ids, input_mask, segment_ids, valid_ids in tqdm(dataloader, desc="Teacher"):
+            with torch.no_grad():
+                logits = teacher(input_ids.to(device), segment_ids.to(device), input_mask.to(device),
+                                 valid_ids=valid_ids.to(device))
+            logits = logits.detach().cpu().numpy().astype(np.float16)
+            for feature_logits in logits:
+                feature = todo[k]
+                key2logits[feature_key(feature)] = feature_logits[:sum(feature.label_mask)]
+                k += 1
+
+        if cache_file:
+            save_soft_labels(cache_file, key2logits, fingerprint, features_key)
+            logger.info('Saved teacher soft labels to {}'.format(cache_file))
+
+    num_labels = teacher.num_labels
+    all_teacher_logits = np.zeros((len(features), max_seq_length, num_labels), dtype=np.float16)
+    for i, feature in enumerate(features):
+        feature_logits = key2logits[feature_key(feature)]
+        assert len(feature_logits) == sum(feature.label_mask), feature_key(feature)
+        all_teacher_logits[i, :len(feature_logits)] = feature_logits
+    return torch.from_numpy(all_teacher_logits)
+
+
+def _distillation_loss(logits, teacher_logits, labels, attention_mask_label, temperature=2.0, alpha=1.0):
+    """alpha * KL(teacher || student) at the given temperature + (1 - alpha) * cross entropy with the labels."""
+    num_labels = logits.size(-1)
+    active = attention_mask_label.view(-1) == 1
+    student_logits = logits.view(-1, num_labels)[active].float()
+    teacher_probs = F.softmax(teacher_logits.view(-1, num_labels)[active].float() / temperature, dim=1)
+    loss = alpha * temperature ** 2 * F.kl_div(F.log_softmax(student_logits / temperature, dim=1), teacher_probs,
+                                               reduction='batchmean')
+    if alpha < 1:
+        loss_fct = nn.CrossEntropyLoss(ignore_index=0)
+        loss = loss + (1 - alpha) * loss_fct(student_logits, labels.view(-1)[active])
+    return loss
+
+
+def autocast(device, precision='fp32'):
+    """Context manager that runs the ops inside it in the given precision (fp32 or bf16).
+
+    bf16 uses torch autocast: weights (and so the optimizer state) stay in fp32, while
+    matrix multiplications run in bfloat16.
+    """
+    if precision == 'fp32':
+        return contextlib.suppress()  # no-op
+    if precision != 'bf16':
+        raise ValueError('Unknown precision: {}'.format(precision))
+    if not hasattr(torch, 'autocast'):
+        raise ValueError('--precision bf16 requires torch >= 1.10 (found {})'.format(torch.__version__))
+    return torch.autocast(device.type, dtype=torch.bfloat16)
+
+
+def _auto_batch_size(args, model, device, mode, max_seq_length, max_batch_size, cache):
+    """Batch size for mode ('train': forward and backward, 'eval': forward) chosen by probing model on
+    random inputs of max_seq_length tokens (see tools/batch_size.py), or taken from the cache."""
+    key = cache_key(model, max_seq_length, device, mode, args.precision, max_batch_size,
+                    args.auto_batch_size_memory_fraction, args.auto_batch_size_min_gain)
+    batch_size = cache.get(key)
+    if batch_size is not None:
+        logger.info('Using the cached {} batch size {} ({})'.format(mode, batch_size, cache.path))
+        return batch_size
+
+    def run_batch(batch_size):
+        input_ids = torch.randint(1, model.config.vocab_size, (batch_size, max_seq_length), device=device)
+        ones = torch.ones_like(input_ids)
+        segment_ids = torch.zeros_like(input_ids)
+        if mode == 'train':
+            with autocast(device, args.precision):
+                loss = model(input_ids, segment_ids, ones, ones, ones, ones)
+            loss.backward()
+        else:
+            with torch.no_grad(), autocast(device, args.precision):
+                model(input_ids, segment_ids, ones, valid_ids=ones, attention_mask_label=ones)
+
+    # the probes must not change the training: keep the RNG state, the mode and no gradients
+    rng_state = torch.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+    training = model.training
+    model.train(mode == 'train')
+    try:
+        batch_size, probes = find_batch_size(run_batch, device, max_batch_size,
+                                             memory_fraction=args.auto_batch_size_memory_fraction,
+                                             min_gain=args.auto_batch_size_min_gain)
+    finally:
+        model.zero_grad()
+        model.train(training)
+        torch.set_rng_state(rng_state)
+        if cuda_rng_state is not None:
+            torch.cuda.set_rng_state(cuda_rng_state, device)
+    logger.info('Chose the {} batch size {}'.format(mode, batch_size))
+    cache.put(key, batch_size, probes)
+    return batch_size
+
+
+def _eval_profiler(args, output_dir, epoch_i, device):
+    if not args.profile_eval:
+        return contextlib.suppress()
+    return Profiler(os.path.join(output_dir, 'profile_eval_epoch{}'.format(epoch_i + 1)),
+                    use_cuda=device.type == 'cuda', python_sampling=args.profile_python, top_n=args.profile_top_n)
+
+
+def _load_previous_best_score(previous_model_dir, dev_on, metric='f1_token', registry=None):
+    if registry is not None:
+        record = registry.best(os.path.basename(os.path.normpath(previous_model_dir)), dev_on, metric=metric)
+        if record is not None:
+            return record[metric]
+    # models evaluated without a registry
     previous_eval_files = glob.glob(os.path.join(previous_model_dir, "eval_results_{}_epoch*.json".format(dev_on)))
     best_score = -1
     for eval_file in previous_eval_files:
@@ -485,6 +1092,9 @@ def \
     parser.add_argument('--fp16',
                         action='store_true',
                         help="Whether to use 16-bit float precision instead of 32-bit")
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help="Precision of the forward and backward passes (training and evaluation). bf16 uses "
+                             "autocast (e.g. on CPUs with bfloat16 matrix instructions) with fp32 weights.")
     parser.add_argument('--fp16_opt_level', type=str, default='O1',
                         help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
                              "See details at https://nvidia.github.io/apex/amp.html")
@@ -514,6 +1124,17 @@ def \
                         type=float,
                         default=1.0,
                         help="Portion of the training set to use.")
+    parser.add_argument("--streaming", action='store_true',
+                        help="Stream the training data from disk instead of loading it into memory. The split may "
+                             "be <train_on>.json, <train_on>.jsonl, a directory of .json/.jsonl shards or a glob.")
+    parser.add_argument("--shuffle_buffer_size", default=10000, type=int,
+                        help="Number of training features to shuffle at a time with --streaming.")
+    parser.add_argument("--features_cache", default=None, type=str,
+                        help="Directory caching the tokenized training features, shared by all runs on the same "
+                             "split and settings (e.g. the runs of a sweep); the features are memory-mapped. "
+                             "Not used with --teacher_model_id.")
+    parser.add_argument("--num_workers", default=0, type=int,
+                        help="Number of DataLoader workers with --streaming; each reads its own shard of the data.")
 
     parser.add_argument("--pretrained_model_id",
                         type=str,
@@ -537,6 +1158,104 @@ def \
     parser.add_argument("--model_type", default='bert', type=str,
                         help="Model type (bert)") # unused
 
+    parser.add_argument("--window_stride", default=None, type=int,
+                        help="If set, histories that do not fit in max_seq_length are split into overlapping windows "
+                             "that start this many tokens apart (each followed by the current turn) instead of "
+                             "being truncated. Predictions for every history term are merged back.")
+
+    parser.add_argument("--history_budget", default=None, type=str,
+                        help="Keep only part of the history: last_turns:K, first_and_last_turns:K or tokens:N "
+                             "(the last N history words).")
+    parser.add_argument("--turns_files", default=[], type=str, nargs='*',
+                        help="Raw query files (qid<TAB>utterance) of the data, used to find the turn boundaries "
+                             "of the history for --history_budget.")
+    parser.add_argument("--turn_delimiters", default='?', type=str,
+                        help="Space-separated words that end a turn, used when the turn boundaries are not known "
+                             "from --turns_files.")
+
+    parser.add_argument("--early_exit", default=None, choices=['joint', 'distill'],
+                        help="Train an early-exit model with token classifiers on intermediate layers: jointly with "
+                             "the final classifier, or distilled from the final classifier of a trained model "
+                             "(given with --pretrained_model_id and --retrain_on).")
+    parser.add_argument("--exit_layers", default=None, type=str,
+                        help="Comma-separated (1-based) layers with an exit classifier (default: all but the last).")
+    parser.add_argument("--exit_threshold", default=None, type=float,
+                        help="Early-exit models stop at the first exit layer at which all history terms are predicted "
+                             "with at least this probability (default: no early exit at evaluation, 0.9 for the "
+                             "evaluations during training).")
+
+    parser.add_argument("--teacher_model_id", default=None, type=str,
+                        help="Distill this trained model (under base_dir) into a smaller student (--model_id). "
+                             "The tokenizer, max_seq_length and casing of the teacher are used.")
+    parser.add_argument("--teacher_cache", default=None, type=str,
+                        help="File for the teacher soft labels (default: <teacher dir>/soft_labels_<train_on>.npz).")
+    parser.add_argument("--student_layers", default=None, type=int,
+                        help="Number of student layers (default: as the teacher).")
+    parser.add_argument("--student_hidden_size", default=None, type=int,
+                        help="Student hidden size (default: as the teacher). A different size means random init.")
+    parser.add_argument("--student_init_layers", default=None, type=str,
+                        help="Comma-separated (0-based) teacher layers that initialize the student layers "
+                             "(default: evenly spaced, ending with the last one).")
+    parser.add_argument("--student_config", default=None, type=str,
+                        help="BERT config json of a randomly initialized student (instead of the teacher's).")
+    parser.add_argument("--distill_temperature", default=2.0, type=float,
+                        help="Softmax temperature of the distillation loss.")
+    parser.add_argument("--distill_alpha", default=1.0, type=float,
+                        help="Weight of the distillation loss; the cross entropy with the labels gets 1 - alpha.")
+
+    parser.add_argument("--telemetry_sample_every", default=10, type=int,
+                        help="Time the stages (data wait, host-to-device copy, forward, backward, optimizer) of "
+                             "every n-th training step, and write them with the throughput and the evaluation "
+                             "timings to <model dir>/telemetry.jsonl and TensorBoard. 0 disables telemetry.")
+    parser.add_argument("--profile_steps", default=None, type=str,
+                        help="START:END: profile these training steps (1-based, inclusive) and write a Chrome trace "
+                             "and the top operators to <model dir>/profile_train_steps<START>-<END>.*")
+    parser.add_argument("--profile_eval", action='store_true',
+                        help="Profile every evaluation (<model dir>/profile_eval_epoch<N>.*).")
+    parser.add_argument("--profile_python", action='store_true',
+                        help="With --profile_steps/--profile_eval, also sample the Python stack.")
+    parser.add_argument("--profile_top_n", default=30, type=int,
+                        help="Number of operators (and Python functions) in the profile tables.")
+    parser.add_argument("--auto_batch_size", action='store_true',
+                        help="Choose the train and eval batch sizes by probing the model (cached per host and model "
+                             "config); --train_batch_size is kept as the effective batch size with gradient "
+                             "accumulation.")
+    parser.add_argument("--auto_batch_size_max", default=256, type=int,
+                        help="Largest eval batch size probed by --auto_batch_size.")
+    parser.add_argument("--auto_batch_size_memory_fraction", default=0.8, type=float,
+                        help="Fraction of the available (host or GPU) memory that --auto_batch_size may use.")
+    parser.add_argument("--auto_batch_size_min_gain", default=0.05, type=float,
+                        help="--auto_batch_size stops when doubling the batch size improves examples/s by less.")
+    parser.add_argument("--auto_batch_size_cache", default=None, type=str,
+                        help="Json file of the batch sizes chosen by --auto_batch_size (default: "
+                             "<base_dir>/batch_sizes.json).")
+    parser.add_argument("--host_profile", default=None, type=str,
+                        help="Host profile of benchmarks/autotune.py: evaluation without training uses its worker "
+                             "processes, threads per worker, core pinning and batch size for this host and model.")
+    parser.add_argument("--no_mmap_weights", action='store_true',
+                        help="Load trained models from pytorch_model.bin even if their weights were exported for "
+                             "memory mapping (tools/mmap_weights.py).")
+    parser.add_argument("--no_fast_tokenizer", action='store_true',
+                        help="Tokenize with BertTokenizer instead of the (identical) trie-based tokenizer of "
+                             "tools/wordpiece.py.")
+    parser.add_argument("--memory_report", action='store_true',
+                        help="Log the RSS (and GPU allocator peak) after every stage and write them to "
+                             "<model dir>/memory.json.")
+    parser.add_argument("--memory_trace_python", action='store_true',
+                        help="With --memory_report, also record the peak of Python allocations per stage (tracemalloc; "
+                             "slows down featurization).")
+    parser.add_argument("--memory_budget_mb", default=None, type=float,
+                        help="Fail as soon as the RSS exceeds this budget, or before an allocation that is known to "
+                             "exceed it (implies --memory_report).")
+    parser.add_argument("--registry", default=None, type=str,
+                        help="Optional SQLite file in which the metrics of every evaluation are recorded "
+                             "(e.g. <base_dir>/experiments.sqlite; see tools/experiment_registry.py).")
+    parser.add_argument("--prediction_cache", default=None, type=str,
+                        help="SQLite file caching the predictions of a trained model (evaluation without training "
+                             "only), so that repeated evaluations only run the model on unseen inputs.")
+    parser.add_argument("--prediction_cache_max_mb", default=1024, type=float,
+                        help="Size limit of the prediction cache; least recently used entries are evicted.")
+
     args = parser.parse_args()
 
     pretrained_model_dir = os.path.join(args.base_dir, args.pretrained_model_id) if args.pretrained_model_id else None
@@ -551,6 +1270,16 @@ def \
         args.do_lower_case = pretrained_model_args['do_lower_case']
         args.train_on = pretrained_model_args['train_on']
 
+    teacher_model_dir = os.path.join(args.base_dir, args.teacher_model_id) if args.teacher_model_id else None
+    if teacher_model_dir is not None:
+        if not args.do_train or args.retrain_on is not None:
+            raise ValueError('--teacher_model_id requires --do_train and cannot be used with --retrain_on.')
+        # the student uses the input format of the teacher
+        teacher_args = json.load(open(os.path.join(teacher_model_dir, "train_args.json")))
+        args.bert_model = teacher_model_dir
+        args.max_seq_length = teacher_args['max_seq_length']
+        args.do_lower_case = teacher_args['do_lower_case']
+
     output_dir = os.path.join(args.base_dir, args.model_id)
     if not args.bert_model and not args.do_train:
         args.bert_model = json.load(open(os.path.join(output_dir, "model_config.json")))['bert_model']
@@ -567,10 +1296,14 @@ def \
     logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
         device, n_gpu, bool(args.local_rank != -1), args.fp16))
 
+    if args.fp16 and args.precision != 'fp32':
+        raise ValueError("--fp16 (apex) cannot be combined with --precision {}".format(args.precision))
+
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
                             args.gradient_accumulation_steps))
 
+    effective_train_batch_size = args.train_batch_size
     args.train_batch_size = args.train_batch_size // args.gradient_accumulation_steps
 
     random.seed(args.seed)
@@ -587,6 +1320,13 @@ def \
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    registry = None
+    if args.registry and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
+        registry = ExperimentRegistry(args.registry)
+        if args.do_train:
+            # the output dir is new, so earlier records of this model_id are stale
+            registry.remove(args.model_id)
+
     task_name = args.task_name.lower()
 
     if task_name not in processors:
@@ -594,46 +1334,94 @@ def \
 
     train_on = args.train_on if not args.retrain_on else args.retrain_on
     logger.info('Training on {}...'.format(train_on))
-    processor = processors[task_name](train_on=train_on, dev_on=args.dev_on)
+    qid2turn_lengths = dict()
+    for turns_file in args.turns_files:
+        qid2turn_lengths.update(read_turn_lengths(turns_file))
+    history_budget = parse_history_budget(args.history_budget) if args.history_budget else None
+    processor = processors[task_name](train_on=train_on, dev_on=args.dev_on, history_budget=history_budget,
+                                      qid2turn_lengths=qid2turn_lengths, turn_delimiters=args.turn_delimiters.split())
 
     label_list = processor.get_labels()
     num_labels = len(label_list) + 1
 
-    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    tokenizer = _load_tokenizer(args.bert_model, args)
     do_lower_case = args.do_lower_case
 
     writer = SummaryWriter('./runs/' + args.model_id)
+    telemetry = Telemetry(os.path.join(output_dir, 'telemetry.jsonl') if args.telemetry_sample_every > 0 else None,
+                          writer=writer if args.telemetry_sample_every > 0 else None,
+                          sample_every=args.telemetry_sample_every, sync_cuda=device.type == 'cuda')
+    step_profiler = None
+    if args.profile_steps:
+        step_profiler = StepRangeProfiler(*parse_step_range(args.profile_steps),
+                                          output_prefix=os.path.join(output_dir, 'profile_train'),
+                                          use_cuda=device.type == 'cuda', python_sampling=args.profile_python,
+                                          top_n=args.profile_top_n)
+    memory = MemoryTracker(args.memory_report, budget_mb=args.memory_budget_mb,
+                           trace_python=args.memory_trace_python, device=device, telemetry=telemetry)
 
     train_examples = None
-    num_train_optimization_steps = 0
+    train_data = None
+    num_train_examples = 0
+    num_train_features = 0
     if args.do_train:
-        train_examples = processor.get_train_examples(args.data_dir, portion=args.train_portion,
-                                                      uppercase=not do_lower_case)
-        num_train_optimization_steps = int(
-            len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
-        if args.local_rank != -1:
-            num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
+        if args.streaming:
+            if teacher_model_dir is not None:
+                raise ValueError('--streaming cannot be combined with --teacher_model_id.')
+            if args.features_cache:
+                raise ValueError('--streaming cannot be combined with --features_cache.')
+            if args.local_rank != -1:
+                # the shards of the ranks could give different numbers of batches, and DDP would hang
+                raise ValueError('--streaming cannot be combined with distributed training (--local_rank).')
+            train_data, num_train_examples, num_train_features = processor.get_streaming_train_dataset(
+                args.data_dir, label_list, args.max_seq_length, tokenizer, portion=args.train_portion,
+                uppercase=not do_lower_case, window_stride=args.window_stride,
+                shuffle_buffer_size=args.shuffle_buffer_size, seed=args.seed)
+        else:
+            train_examples = processor.get_train_examples(args.data_dir, portion=args.train_portion,
+                                                          uppercase=not do_lower_case)
+            num_train_examples = len(train_examples)
+        memory.checkpoint('data_load')
 
     if args.local_rank not in [-1, 0]:
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
-    if args.retrain_on is None:
+    teacher = None
+    if teacher_model_dir is not None:
+        logger.info('Loading teacher model {}..'.format(args.teacher_model_id))
+        teacher = _load_trained_model(teacher_model_dir, mmap_weights=not args.no_mmap_weights)
+        teacher.to(device)
+        model = _build_student(teacher, args, num_labels, tokenizer)
+        logger.info('Student: {} layers, hidden size {} ({:.1f}M parameters; teacher: {:.1f}M)'.format(
+            model.config.num_hidden_layers, model.config.hidden_size,
+            sum(p.numel() for p in model.parameters()) / 1e6, sum(p.numel() for p in teacher.parameters()) / 1e6))
+
+    elif args.retrain_on is None:
         # Prepare a fresh model
         config = BertConfig.from_pretrained(args.bert_model,
                                             num_labels=num_labels,
                                             finetuning_task=args.task_name,
                                             hidden_dropout_prob=args.hidden_dropout_prob)
+        model_class = Ner
+        if args.early_exit:
+            _set_early_exit_config(config, args)
+            model_class = EarlyExitNer
 
-        model = Ner.from_pretrained(args.bert_model,
-                                    from_tf=False,
-                                    config=config)
+        model = model_class.from_pretrained(args.bert_model,
+                                            from_tf=False,
+                                            config=config)
 
     else:
         # resume a pretrained model!
         logger.info('Loading pretrained model {}..'.format(args.pretrained_model_id))
-        model = Ner.from_pretrained(pretrained_model_dir, hidden_dropout_prob=args.hidden_dropout_prob)
-        tokenizer = BertTokenizer.from_pretrained(pretrained_model_dir, do_lower_case=args.do_lower_case)
-        best_f1_score = _load_previous_best_score(pretrained_model_dir, args.dev_on)
+        if args.early_exit:
+            config = BertConfig.from_pretrained(pretrained_model_dir, hidden_dropout_prob=args.hidden_dropout_prob)
+            _set_early_exit_config(config, args)
+            model = EarlyExitNer.from_pretrained(pretrained_model_dir, config=config)
+        else:
+            model = Ner.from_pretrained(pretrained_model_dir, hidden_dropout_prob=args.hidden_dropout_prob)
+        tokenizer = _load_tokenizer(pretrained_model_dir, args)
+        best_f1_score = _load_previous_best_score(pretrained_model_dir, args.dev_on, registry=registry)
         logger.info('Loaded pretrained model {}. Prev best f1 score: {:.1f}'
                     .format(args.pretrained_model_id, 100*best_f1_score))
 
@@ -642,6 +1430,20 @@ def \
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
     model.to(device)
+    memory.checkpoint('model_load')
+
+    batch_size_cache = None
+    if args.auto_batch_size:
+        batch_size_cache = BatchSizeCache(args.auto_batch_size_cache or os.path.join(args.base_dir, 'batch_sizes.json'))
+    if args.auto_batch_size and args.do_train:
+        # keep the effective batch size with gradient accumulation
+        args.train_batch_size, args.gradient_accumulation_steps = accumulation_for(
+            effective_train_batch_size, _auto_batch_size(args, model, device, 'train', args.max_seq_length,
+                                                         effective_train_batch_size, batch_size_cache))
+        args.eval_batch_size = _auto_batch_size(args, model, device, 'eval', args.max_seq_length,
+                                                args.auto_batch_size_max, batch_size_cache)
+        logger.info('Batch sizes: train {} x {} accumulation steps, eval {}'.format(
+            args.train_batch_size, args.gradient_accumulation_steps, args.eval_batch_size))
 
     param_optimizer = list(model.named_parameters())
     # print(param_optimizer)
@@ -657,9 +1459,7 @@ def \
          'weight_decay': 0.0}
         ]
 
-    warmup_steps = int(args.warmup_proportion * num_train_optimization_steps)
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
-    scheduler = WarmupLinearSchedule(optimizer, warmup_steps=warmup_steps, t_total=num_train_optimization_steps)
     if args.fp16:
         try:
             from apex import amp
@@ -675,6 +1475,7 @@ def \
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
                                                           output_device=args.local_rank,
                                                           find_unused_parameters=True)
+    memory.checkpoint('optimizer')
 
     global_step = 0
     epoch_i = -1
@@ -685,48 +1486,112 @@ def \
     if args.do_train:
 
         best_f1_score = -1.0
-        train_features = convert_examples_to_features(
-            train_examples, label_list, args.max_seq_length, tokenizer)
+        if args.early_exit:
+            # select the model on early-exit predictions
+            model.exit_threshold = args.exit_threshold if args.exit_threshold is not None else 0.9
+        if args.streaming:
+            train_dataloader = DataLoader(train_data, batch_size=args.train_batch_size,
+                                          num_workers=args.num_workers)
+        elif args.features_cache and teacher is None:
+            train_data = _cached_train_data(args.features_cache, processor, args.data_dir, train_examples, label_list,
+                                            args.max_seq_length, tokenizer, do_lower_case,
+                                            window_stride=args.window_stride, turns_files=args.turns_files)
+            memory.checkpoint('feature_conversion')
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+        else:
+            s_time = time.perf_counter()
+            train_features = convert_examples_to_features(
+                train_examples, label_list, args.max_seq_length, tokenizer, window_stride=args.window_stride)
+            telemetry.record('featurize', num_examples=len(train_examples), featurize_s=time.perf_counter() - s_time)
+            memory.checkpoint('feature_conversion')
+            memory.check('tensorization', tensors_nbytes(6, len(train_features), args.max_seq_length))
+            all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
+            all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
+            all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
+            all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
+            all_valid_ids = torch.tensor([f.valid_ids for f in train_features], dtype=torch.long)
+            all_lmask_ids = torch.tensor([f.label_mask for f in train_features], dtype=torch.long)
+            train_tensors = [all_input_ids, all_input_mask, all_segment_ids, all_label_ids,all_valid_ids,all_lmask_ids]
+            if teacher is not None:
+                teacher_cache = args.teacher_cache or os.path.join(teacher_model_dir,
+                                                                   'soft_labels_{}.npz'.format(train_on))
+                features_key = _train_features_key(processor, args.data_dir, label_list, args.max_seq_length,
+                                                   tokenizer, do_lower_case, window_stride=args.window_stride,
+                                                   turns_files=args.turns_files)
+                train_tensors.append(_get_teacher_logits(teacher, teacher_model_dir, train_features, device,
+                                                         args.eval_batch_size, cache_file=teacher_cache,
+                                                         features_key=features_key))
+                teacher = None  # free memory
+            train_data = TensorDataset(*train_tensors)
+            memory.checkpoint('tensorization')
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+        if not args.streaming:
+            num_train_features = len(train_data)
+
+        # with --window_stride, an example may give several features (and training steps)
+        num_train_optimization_steps = int(
+            num_train_features / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
+        if args.local_rank != -1:
+            num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
+        warmup_steps = int(args.warmup_proportion * num_train_optimization_steps)
+        scheduler = WarmupLinearSchedule(optimizer, warmup_steps=warmup_steps, t_total=num_train_optimization_steps)
+
         logger.info("***** Running training *****")
-        logger.info("  Num examples = %d", len(train_examples))
+        logger.info("  Num examples = %d", num_train_examples)
+        logger.info("  Num features = %d", num_train_features)
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_optimization_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-        all_valid_ids = torch.tensor([f.valid_ids for f in train_features], dtype=torch.long)
-        all_lmask_ids = torch.tensor([f.label_mask for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids,all_valid_ids,all_lmask_ids)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
-        else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
 
         model.train()
+        # the first step allocates the gradients and the optimizer state
+        memory.check('first_step', training_state_nbytes(model))
 
         for epoch_i in trange(int(args.num_train_epochs), desc="Epoch"):
+            if args.streaming:
+                train_data.set_epoch(epoch_i)
+            epoch_start_time = time.time()
+            telemetry.start_epoch(epoch_i)
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
             model.train()
 
+            data_start_time = time.perf_counter()
             for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
-                batch = tuple(t.to(device) for t in batch)
-                input_ids, input_mask, segment_ids, label_ids, valid_ids,l_mask = batch
-                loss = model(input_ids, segment_ids, input_mask, label_ids,valid_ids,l_mask)
+                telemetry.begin_step()
+                if step_profiler is not None:
+                    step_profiler.begin_step(total_nb_tr_steps + 1)
+                telemetry.add('data_wait', time.perf_counter() - data_start_time)
+                with telemetry.timer('h2d'):
+                    batch = tuple(t.to(device) for t in batch)
+                input_ids, input_mask, segment_ids, label_ids, valid_ids,l_mask = batch[:6]
+                with telemetry.timer('forward'), autocast(device, args.precision):
+                    if teacher_model_dir is not None:
+                        logits = model(input_ids, segment_ids, input_mask, valid_ids=valid_ids)
+                        loss = _distillation_loss(logits, batch[6], label_ids, l_mask,
+                                                  temperature=args.distill_temperature, alpha=args.distill_alpha)
+                    else:
+                        loss = model(input_ids, segment_ids, input_mask, label_ids,valid_ids,l_mask)
                 if n_gpu > 1:
                     loss = loss.mean() # mean() to average on multi-gpu.
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
 
-                if args.fp16:
-                    with amp.scale_loss(loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    loss.backward()
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                with telemetry.timer('backward'):
+                    if args.fp16:
+                        with amp.scale_loss(loss, optimizer) as scaled_loss:
+                            scaled_loss.backward()
+                        torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
+                    else:
+                        loss.backward()
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
                 loss_val = loss.item()
                 # print('step: {} loss: {:.4f}'.format(nb_tr_steps, loss_val))
@@ -736,18 +1601,30 @@ def \
                 nb_tr_steps += 1
                 total_nb_tr_steps += 1
 
-                if (total_nb_tr_steps + 1) % 10:
+                if total_nb_tr_steps % 10 == 0:
                     writer.add_scalar('Loss/train', loss_val, total_nb_tr_steps)
 
                 if (step + 1) % args.gradient_accumulation_steps == 0:
-                    optimizer.step()
-                    scheduler.step()  # Update learning rate schedule
-                    model.zero_grad()
+                    with telemetry.timer('optimizer'):
+                        optimizer.step()
+                        scheduler.step()  # Update learning rate schedule
+                        model.zero_grad()
                     global_step += 1
 
+                telemetry.end_step(input_ids.size(0), input_mask=input_mask)
+                if step_profiler is not None:
+                    step_profiler.end_step(total_nb_tr_steps)
+                if total_nb_tr_steps == 1:
+                    memory.checkpoint('first_step')
+                data_start_time = time.perf_counter()
+
             logger.info('[EPOCH {}] Training loss: {:.4f}'.format(epoch_i, tr_loss))
-            cur_f1_score, cur__p_score, cur_r_score = _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, output_dir,
-                                    args.max_seq_length, do_lower_case)
+            train_time = time.time() - epoch_start_time
+            with _eval_profiler(args, output_dir, epoch_i, device):
+                cur_f1_score, cur__p_score, cur_r_score = _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, output_dir,
+                                        args.max_seq_length, do_lower_case, registry=registry,
+                                        timings={'train_epoch_s': train_time}, telemetry=telemetry)
+            memory.checkpoint('eval_epoch{}'.format(epoch_i))
 
             writer.add_scalar('F1/dev', cur_f1_score, total_nb_tr_steps)
             writer.add_scalar('P/dev', cur__p_score, total_nb_tr_steps)
@@ -784,23 +1661,159 @@ def \
                 logger.info('F1 score did not improve ({:.2f} vs {:.2f}). Stopping...'.format(cur_f1_score, best_f1_score))
                 break
 
+        if step_profiler is not None:
+            step_profiler.close()
+
     else:
         # Load a trained model and vocabulary that you have fine-tuned
 
-        model = Ner.from_pretrained(output_dir)
-        tokenizer = BertTokenizer.from_pretrained(output_dir, do_lower_case=args.do_lower_case)
+        model = _load_trained_model(output_dir, mmap_weights=not args.no_mmap_weights)
+        if isinstance(model, EarlyExitNer):
+            model.exit_threshold = args.exit_threshold
+        tokenizer = _load_tokenizer(output_dir, args)
 
     model.to(device)
 
     if args.do_eval and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
         config_args = json.load(open(os.path.join(output_dir, "train_args.json")))
         max_seq_length = config_args['max_seq_length']
-        _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, output_dir, max_seq_length, do_lower_case)
-
+        inference_pool = None
+        if args.host_profile and not args.do_train and device.type == 'cpu':
+            topology = HostProfile(args.host_profile).lookup(model.config, max_seq_length, args.precision)
+            if topology is None:
+                logger.warning('No topology of this host and model in {}; run benchmarks/autotune.py'.format(
+                    args.host_profile))
+            else:
+                logger.info('Inference topology: {num_workers} workers x {num_threads} threads, batch size '
+                            '{batch_size} (pinned: {pin})'.format(**topology))
+                args.eval_batch_size = topology['batch_size']
+                if topology['num_workers'] > 1 and not isinstance(model, EarlyExitNer):
+                    inference_pool = InferencePool(output_dir, topology['num_workers'], topology['num_threads'],
+                                                   pin=topology['pin'], mmap_weights=not args.no_mmap_weights)
+                else:
+                    apply_topology(topology['num_threads'],
+                                   worker_cpus(1, topology['num_threads'])[0] if topology['pin'] else None)
+        if args.auto_batch_size and not args.do_train:
+            args.eval_batch_size = _auto_batch_size(args, model, device, 'eval', max_seq_length,
+                                                    args.auto_batch_size_max, batch_size_cache)
+
+        prediction_cache = None
+        if args.prediction_cache:
+            if args.do_train:
+                logger.warning('--prediction_cache is ignored when training.')
+            elif isinstance(model, EarlyExitNer):
+                # the predictions depend on --exit_threshold, and the layer stats need every batch to run
+                logger.warning('--prediction_cache is ignored for early-exit models.')
+            else:
+                fingerprint = model_fingerprint(output_dir)
+                if args.precision != 'fp32':
+                    fingerprint += '-' + args.precision
+                prediction_cache = PredictionCache(args.prediction_cache, fingerprint,
+                                                   max_seq_length, max_size_mb=args.prediction_cache_max_mb)
+
+        with _eval_profiler(args, output_dir, epoch_i, device):
+            # after training, every epoch is already in the registry (and this is the last epoch's model,
+            # not necessarily the saved best one)
+            _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, output_dir, max_seq_length, do_lower_case,
+                     prediction_cache=prediction_cache, registry=None if args.do_train else registry,
+                     telemetry=telemetry, inference_pool=inference_pool)
+        memory.checkpoint('eval')
+
+        if prediction_cache is not None:
+            prediction_cache.close()
+        if inference_pool is not None:
+            inference_pool.close()
+
+    memory.report(os.path.join(output_dir, 'memory.json'))
     writer.close()
+    telemetry.close()
+    if registry is not None:
+        registry.close()
 
 
-def _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, output_dir, max_seq_length, do_lower_case):
+def decode_predictions(features, all_preds, all_rel_probs, label_list, tokenizer):
+    """Turns the per-position predictions of features into per-example history words, labels,
+    predicted labels and REL probabilities (merging the windows of an example).
+
+    Returns (ids, x_input, y_true, y_pred, y_prob).
+    """
+    y_true = []
+    y_pred = []
+    y_prob = []
+    x_input = []
+    _ids = []
+
+    # whether to collapse multiple predictions of the same token in one
+    label_map = {i : label for i, label in enumerate(label_list,1)}
+
+    # [(guid, [(window_start, labels, predictions, REL probabilities, input words)])]
+    example_windows = []
+    for feature, logits, rel_probs in zip(features, all_preds, all_rel_probs):
+        label_ids = feature.label_id
+        input_ids = feature.input_ids
+        valid_ids = feature.valid_ids
+
+        temp_1 = []
+        temp_2 = []
+        temp_3 = []
+        temp_4 = []
+
+        for j, m in enumerate(label_ids):
+
+            if j == 0:  # CLS
+                continue
+            elif label_ids[j] == len(label_map):
+
+                tmp = tokenizer.convert_ids_to_tokens(input_ids)
+                x_input_tokens = []
+                for jj in range(1, len(tmp)):
+                    token = tmp[jj]
+                    if token == '[PAD]':
+                        break
+                    if valid_ids[jj] == 1:
+                        x_input_tokens.append(token)
+                    else:
+                        x_input_tokens[-1] += token
+
+                # remove bert tokenization chars ## from tokens
+                x_input_tokens = [s.replace('##', '') for s in x_input_tokens]
+
+                window = (feature.window_start, temp_1, temp_2, temp_4, x_input_tokens)
+                if feature.window_start > 0 and example_windows and example_windows[-1][0] == feature._id:
+                    example_windows[-1][1].append(window)
+                else:
+                    example_windows.append((feature._id, [window]))
+
+                break
+            else:
+                temp_1.append(label_map[label_ids[j]])
+                temp_2.append(label_map.get(logits[j], 'O'))
+                temp_3.append(input_ids[j])
+                temp_4.append(round(float(rel_probs[j]), 6))
+
+    for guid, windows in example_windows:
+        if len(windows) == 1:
+            _, temp_1, temp_2, temp_4, x_input_tokens = windows[0]
+        else:
+            merged = merge_windows([(start, list(zip(t1, t2, t4, x[:len(t1)])))
+                                    for start, t1, t2, t4, x in windows])
+            temp_1, temp_2, temp_4, history_tokens = [list(column) for column in zip(*merged)]
+            # the current turn is the same in every window
+            _, last_labels, _, _, last_tokens = windows[-1]
+            x_input_tokens = history_tokens + last_tokens[len(last_labels):]
+
+        x_input.append(x_input_tokens)
+        y_true.append(temp_1)
+        y_pred.append(temp_2)
+        y_prob.append(temp_4)
+        _ids.append(guid)
+
+    return _ids, x_input, y_true, y_pred, y_prob
+
+
+def _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, output_dir, max_seq_length, do_lower_case,
+             prediction_cache=None, registry=None, timings=None, telemetry=None, inference_pool=None):
+    eval_start_time = time.time()
     if args.eval_on == "dev":
         eval_examples = processor.get_dev_examples(args.data_dir, uppercase=not do_lower_case)
     elif args.eval_on == "test":
@@ -808,91 +1821,42 @@ def _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, out
     else:
         raise ValueError("eval on dev or test set only")
 
-    eval_features = convert_examples_to_features(eval_examples, label_list, max_seq_length, tokenizer)
+    stage_start_time = time.perf_counter()
+    eval_features = convert_examples_to_features(eval_examples, label_list, max_seq_length, tokenizer,
+                                                 window_stride=args.window_stride)
+    eval_timings = {'featurize_s': time.perf_counter() - stage_start_time}
     logger.info("***** Running evaluation *****")
     logger.info("  Num examples = %d", len(eval_examples))
+    logger.info("  Num features = %d", len(eval_features))
     logger.info("  Batch size = %d", args.eval_batch_size)
 
-    all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-    all_valid_ids = torch.tensor([f.valid_ids for f in eval_features], dtype=torch.long)
-    all_lmask_ids = torch.tensor([f.label_mask for f in eval_features], dtype=torch.long)
-    all_guids = [x.guid for x in eval_examples]
-    eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids,all_valid_ids,all_lmask_ids)
-    # Run prediction for full data
-    eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
-    model.eval()
-    # eval_loss, eval_accuracy = 0, 0
-    # nb_eval_steps, nb_eval_examples = 0, 0
-    y_true = []
-    y_pred = []
-    x_input = []
-    _ids = []
+    rel_label_id = label_list.index('REL') + 1
 
-    # whether to collapse multiple predictions of the same token in one
-    label_map = {i : label for i, label in enumerate(label_list,1)}
+    model_to_eval = model.module if hasattr(model, 'module') else model
+    if isinstance(model_to_eval, EarlyExitNer):
+        model_to_eval.reset_exit_stats()
 
-    i_guids = 0
-    for input_ids, input_mask, segment_ids, label_ids,valid_ids,l_mask in tqdm(eval_dataloader, desc="Evaluating"):
-        input_ids = input_ids.to(device)
-        input_mask = input_mask.to(device)
-        segment_ids = segment_ids.to(device)
-        valid_ids = valid_ids.to(device)
-        label_ids = label_ids.to(device)
-        l_mask = l_mask.to(device)
-
-        with torch.no_grad():
-            logits = model(input_ids, segment_ids, input_mask,valid_ids=valid_ids,attention_mask_label=l_mask)
-
-        logits = torch.argmax(F.log_softmax(logits,dim=2),dim=2)
-        logits = logits.detach().cpu().numpy()
-        label_ids = label_ids.to('cpu').numpy()
-        input_ids = input_ids.to('cpu').numpy()
-        valid_ids = valid_ids.to('cpu').numpy()
-
-        for i, label in enumerate(label_ids):
-            temp_1 = []
-            temp_2 = []
-            temp_3 = []
-
-            for j, m in enumerate(label):
-
-                if j == 0:  # CLS
-                    continue
-                elif label_ids[i][j] == len(label_map):
-
-                    tmp = tokenizer.convert_ids_to_tokens(input_ids[i])
-                    x_input_tokens = []
-                    for jj in range(1, len(tmp)):
-                        token = tmp[jj]
-                        if token == '[PAD]':
-                            break
-                        if valid_ids[i][jj] == 1:
-                            x_input_tokens.append(token)
-                        else:
-                            x_input_tokens[-1] += token
-
-                    # remove bert tokenization chars ## from tokens
-                    x_input_tokens = [s.replace('##', '') for s in x_input_tokens]
-                    x_input.append(x_input_tokens)
-
-                    y_true.append(temp_1)
-                    y_pred.append(temp_2)
-                    _ids.append(all_guids[i_guids])
-                    i_guids += 1
+    stage_start_time = time.perf_counter()
+    all_preds, all_rel_probs = _predict(model, eval_features, device, args.eval_batch_size, rel_label_id,
+                                        prediction_cache=prediction_cache, precision=args.precision,
+                                        inference_pool=inference_pool)
+    eval_timings['predict_s'] = time.perf_counter() - stage_start_time
 
-                    break
-                else:
-                    temp_1.append(label_map[label_ids[i][j]])
-                    temp_2.append(label_map.get(logits[i][j], 'O'))
-                    temp_3.append(input_ids[i][j])
+    if isinstance(model_to_eval, EarlyExitNer) and model_to_eval.num_examples:
+        logger.info('[Early exit] threshold={}, average layers executed: {:.2f} / {}'.format(
+            model_to_eval.exit_threshold, model_to_eval.average_layers_executed(),
+            len(model_to_eval.bert.encoder.layer)))
 
+    stage_start_time = time.perf_counter()
+    _ids, x_input, y_true, y_pred, y_prob = decode_predictions(eval_features, all_preds, all_rel_probs, label_list,
+                                                                tokenizer)
+    eval_timings['decode_s'] = time.perf_counter() - stage_start_time
+
+    stage_start_time = time.perf_counter()
     _f1_score_token = eval_seq_labeling_token.f1_score(y_true, y_pred, average='micro')
     _p_score_token = eval_seq_labeling_token.precision_score(y_true, y_pred, average='micro')
     _r_score_token = eval_seq_labeling_token.recall_score(y_true, y_pred, average='micro')
+    eval_timings['metrics_s'] = time.perf_counter() - stage_start_time
 
     logger.info('[Token eval] P={:.1f}, R={:.1f}, F1={:.1f}'.format(100 * _p_score_token, 100 * _r_score_token, 100 * _f1_score_token))
 
@@ -906,6 +1870,7 @@ def _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, out
 
         'y_true': y_true,
         'y_pred': y_pred,
+        'y_prob': y_prob,
         'x_input': x_input,
         'dev_on': args.dev_on,
         'ids': _ids
@@ -914,8 +1879,138 @@ def _do_eval(args, epoch_i, device, processor, label_list, tokenizer, model, out
     output_eval_file = os.path.join(output_dir, "eval_results_{}_epoch{}.json".format(args.dev_on, epoch_i+1))
     json.dump(d, open(output_eval_file, 'w'))
 
+    if telemetry is not None:
+        num_tokens = sum(sum(f.input_mask) for f in eval_features)
+        telemetry.record('eval', num_examples=len(eval_examples),
+                         examples_per_s=len(eval_features) / max(eval_timings['predict_s'], 1e-12),
+                         tokens_per_s=num_tokens / max(eval_timings['predict_s'], 1e-12), **eval_timings)
+
+    if registry is not None:
+        timings = dict(timings or dict(), eval_s=time.time() - eval_start_time, **eval_timings)
+        train_args = vars(args) if args.do_train else json.load(open(os.path.join(output_dir, "train_args.json")))
+        registry.record(os.path.basename(os.path.normpath(output_dir)), args.dev_on, epoch_i+1, _f1_score_token,
+                        _p_score_token, _r_score_token, train_args=train_args, timings=timings,
+                        artifact_path=output_eval_file)
+
     return _f1_score_token, _p_score_token, _r_score_token
 
 
+# the model of an inference worker process
+_inference_model = None
+
+
+def _init_inference_worker(model_dir, cpu_queue, num_threads, mmap_weights):
+    global _inference_model
+    apply_topology(num_threads, cpu_queue.get())
+    _inference_model = _load_trained_model(model_dir, mmap_weights=mmap_weights)
+    _inference_model.eval()
+
+
+def _predict_in_worker(task):
+    features, batch_size, rel_label_id, precision = task
+    return _predict(_inference_model, features, torch.device('cpu'), batch_size, rel_label_id, precision=precision)
+
+
+class InferencePool(object):
+    """CPU worker processes that run _predict on chunks of the features. Every worker loads the model from
+    model_dir (its own copy, unless the weights are memory-mapped) and runs with num_threads threads, pinned
+    to its own cores with pin."""
+
+    def __init__(self, model_dir, num_workers, num_threads, pin=True, mmap_weights=True):
+        context = multiprocessing.get_context('spawn')
+        self._manager = context.Manager()
+        cpu_queue = self._manager.Queue()
+        for cpus in worker_cpus(num_workers, num_threads) if pin else [None] * num_workers:
+            cpu_queue.put(cpus)
+        self.num_workers = num_workers
+        self._pool = context.Pool(num_workers, initializer=_init_inference_worker,
+                                  initargs=(model_dir, cpu_queue, num_threads, mmap_weights))
+
+    def predict(self, features, batch_size, rel_label_id, precision='fp32'):
+        # chunks of whole batches (so that the batches are those of a single process), a few per worker
+        num_batches = (len(features) + batch_size - 1) // batch_size
+        chunk_size = batch_size * max(1, num_batches // (4 * self.num_workers))
+        tasks = [(features[i:i + chunk_size], batch_size, rel_label_id, precision)
+                 for i in range(0, len(features), chunk_size)]
+        all_preds, all_rel_probs = [], []
+        for preds, rel_probs in self._pool.map(_predict_in_worker, tasks, chunksize=1):
+            all_preds.extend(preds)
+            all_rel_probs.extend(rel_probs)
+        return all_preds, all_rel_probs
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self._manager.shutdown()
+
+
+def _predict(model, features, device, batch_size, rel_label_id, prediction_cache=None, precision='fp32',
+             inference_pool=None):
+    """Returns the predicted label ids and the REL probabilities of every position of every feature.
+
+    With a prediction cache, only the features that are not in the cache are run through the model.
+    With an inference pool, they are run by its worker processes instead of model.
+    """
+    all_preds = [None] * len(features)
+    all_rel_probs = [None] * len(features)
+    todo = list(range(len(features)))
+
+    if prediction_cache is not None:
+        keys = [prediction_cache.key(f) for f in features]
+        cached = prediction_cache.get_many(keys)
+        todo = [i for i, key in enumerate(keys) if key not in cached]
+        for i, key in enumerate(keys):
+            if key in cached:
+                all_preds[i], all_rel_probs[i] = cached[key]
+
+    if todo and inference_pool is not None:
+        todo_preds, todo_rel_probs = inference_pool.predict([features[i] for i in todo], batch_size, rel_label_id,
+                                                            precision=precision)
+        for i, preds, rel_probs in zip(todo, todo_preds, todo_rel_probs):
+            all_preds[i] = preds
+            all_rel_probs[i] = rel_probs
+    elif todo:
+        todo_features = [features[i] for i in todo]
+        all_input_ids = torch.tensor([f.input_ids for f in todo_features], dtype=torch.long)
+        all_input_mask = torch.tensor([f.input_mask for f in todo_features], dtype=torch.long)
+        all_segment_ids = torch.tensor([f.segment_ids for f in todo_features], dtype=torch.long)
+        all_valid_ids = torch.tensor([f.valid_ids for f in todo_features], dtype=torch.long)
+        all_lmask_ids = torch.tensor([f.label_mask for f in todo_features], dtype=torch.long)
+        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_valid_ids, all_lmask_ids)
+        # Run prediction for full data
+        eval_sampler = SequentialSampler(eval_data)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=batch_size)
+        model.eval()
+
+        k = 0
+        for input_ids, input_mask, segment_ids, valid_ids, l_mask in tqdm(eval_dataloader, desc="Evaluating"):
+            input_ids = input_ids.to(device)
+            input_mask = input_mask.to(device)
+            segment_ids = segment_ids.to(device)
+            valid_ids = valid_ids.to(device)
+            l_mask = l_mask.to(device)
+
+            with torch.no_grad(), autocast(device, precision):
+                logits = model(input_ids, segment_ids, input_mask,valid_ids=valid_ids,attention_mask_label=l_mask)
+            logits = logits.float()
+
+            # keep the REL probability of every token so that decision thresholds can be tuned offline
+            rel_probs = F.softmax(logits, dim=2)[:, :, rel_label_id].detach().cpu().numpy()
+            logits = torch.argmax(F.log_softmax(logits,dim=2),dim=2)
+            logits = logits.detach().cpu().numpy()
+
+            for preds, probs in zip(logits, rel_probs):
+                all_preds[todo[k]] = preds
+                all_rel_probs[todo[k]] = probs
+                k += 1
+
+    if prediction_cache is not None:
+        if todo:
+            prediction_cache.put_many((keys[i], all_preds[i], all_rel_probs[i]) for i in todo)
+        prediction_cache.report()
+
+    return all_preds, all_rel_probs
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,147 @@
+"""
+Local BM25 (+RM3) retrieval for the query files generated by generate_query_files_for_trained_model.py.
+
+Builds a compressed inverted index over a local passage collection (once) and
+writes a TREC run file, e.g.:
+
+    python -m run_retrieval --collection_file collection.tsv --index_dir ./index \
+        --model_output_file $MODEL_OUTPUT_FILE --raw_query_file $RAW_QUERY_FILE --dataset_name cast \
+        --run_file run_quretec.txt --rm3
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from generate_query_files_for_trained_model import generate_query_file, read_qid2curquestion
+from tools.eval_retrieval import RetrievalEvaluator, aggregate, read_qrels
+from tools.inverted_index import InvertedIndex, build_index
+
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def write_run_file(qid2hits, run_file, run_tag):
+    with open(run_file, 'w') as fw:
+        for qid, hits in qid2hits:
+            for rank, (docid, score) in enumerate(hits, 1):
+                fw.write('{} Q0 {} {} {:.6f} {}\n'.format(qid, docid, rank, score, run_tag))
+
+
+def retrieve(index, qid2query, num_threads=1, **search_kwargs):
+    """Runs all queries on a thread pool; returns [(qid, [(docid, score), ...])] in query order."""
+    qids = list(qid2query.keys())
+
+    def search(qid):
+        return index.search(qid2query[qid], **search_kwargs)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(zip(qids, executor.map(search, qids)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--index_dir",
+                        type=str,
+                        required=True,
+                        help="Index directory. It is built from --collection_file if it does not exist.")
+
+    parser.add_argument("--collection_file",
+                        type=str,
+                        help="Passage collection: tsv (docid<TAB>text) or jsonl ({\"id\", \"contents\"}).")
+
+    parser.add_argument("--block_size",
+                        type=int,
+                        default=100000,
+                        help="Number of documents encoded at a time when building the index.")
+
+    parser.add_argument("--query_file",
+                        type=str,
+                        help="Query file (qid<TAB>query). Alternatively, give the model output to generate it.")
+
+    parser.add_argument("--model_output_file",
+                        type=str,
+                        help="Model output file; the query file is generated as <run_file>.queries.tsv.")
+
+    parser.add_argument("--raw_query_file",
+                        type=str)
+
+    parser.add_argument("--dataset_name",
+                        default='cast',
+                        type=str)
+
+    parser.add_argument("--run_file",
+                        type=str,
+                        required=True,
+                        help="Output TREC run file.")
+
+    parser.add_argument("--run_tag",
+                        default='quretec_bm25',
+                        type=str)
+
+    parser.add_argument("--hits", default=1000, type=int,
+                        help="Number of documents retrieved per query.")
+    parser.add_argument("--k1", default=0.9, type=float,
+                        help="BM25 k1.")
+    parser.add_argument("--b", default=0.4, type=float,
+                        help="BM25 b.")
+    parser.add_argument("--rm3", action='store_true',
+                        help="Expand queries with RM3.")
+    parser.add_argument("--fb_docs", default=10, type=int,
+                        help="RM3 feedback documents.")
+    parser.add_argument("--fb_terms", default=10, type=int,
+                        help="RM3 feedback terms.")
+    parser.add_argument("--original_query_weight", default=0.5, type=float,
+                        help="RM3 weight of the original query.")
+    parser.add_argument("--num_threads", default=os.cpu_count(), type=int,
+                        help="Number of retrieval threads.")
+
+    parser.add_argument("--qrel_file",
+                        type=str,
+                        help="If given, evaluate the run against these qrels (json or TREC format).")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.index_dir, 'meta.json')):
+        if not args.collection_file:
+            raise ValueError('No index found in {}; --collection_file is required to build it.'
+                             .format(args.index_dir))
+        logger.info('Building index in {}...'.format(args.index_dir))
+        build_index(args.collection_file, args.index_dir, block_size=args.block_size)
+
+    query_file = args.query_file
+    if query_file is None:
+        if not (args.model_output_file and args.raw_query_file):
+            raise ValueError('Either --query_file or --model_output_file and --raw_query_file are required.')
+        query_file = args.run_file + '.queries.tsv'
+        generate_query_file(args.raw_query_file, args.model_output_file, query_file, args.dataset_name)
+
+    index = InvertedIndex(args.index_dir)
+    qid2query = read_qid2curquestion(query_file)
+
+    s_time = time.time()
+    qid2hits = retrieve(index, qid2query, num_threads=args.num_threads, hits=args.hits, k1=args.k1, b=args.b,
+                        rm3=args.rm3, fb_docs=args.fb_docs, fb_terms=args.fb_terms,
+                        original_query_weight=args.original_query_weight)
+    logger.info('Retrieved {} queries in {:.1f} seconds'.format(len(qid2hits), time.time() - s_time))
+
+    write_run_file(qid2hits, args.run_file, args.run_tag)
+    logger.info('Written {}'.format(args.run_file))
+
+    if args.qrel_file:
+        evaluator = RetrievalEvaluator(read_qrels(args.qrel_file))
+        qids, per_query_metrics = evaluator.evaluate((qid, docid, score) for qid, hits in qid2hits
+                                                     for docid, score in hits)
+        means = aggregate(per_query_metrics)
+        logger.info('[Retrieval eval] {} queries: {}'.format(
+            len(qids), ', '.join('{}={:.4f}'.format(m, means[m]) for m in sorted(means))))
+
+
+if __name__ == '__main__':
+    main()
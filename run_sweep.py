@@ -0,0 +1,186 @@
+"""
+Runs a grid of run_ner.py trainings (e.g. learning curves over --train_portion, or
+learning rate x dropout x seed) and collects their best dev f1_token, e.g.:
+
+    python -m run_sweep --config sweep.json --sweep_dir ./sweeps/lr_portion --num_parallel 4 --threads_per_run 2
+
+with sweep.json:
+
+    {"args": {"task_name": "ner", "bert_model": "bert-large-uncased", "do_lower_case": true,
+              "data_dir": "./data/quac_canard/token_classification/", "base_dir": "./models/",
+              "train_on": "train_gold_supervision", "dev_on": "dev_gold_supervision", "no_cuda": true},
+     "grid": {"train_portion": [0.1, 0.5, 1.0], "learning_rate": [5e-5, 1e-4], "seed": [42, 43, 44]}}
+
+Every configuration is trained in its own process with --model_id <sweep name>_<config id>
+and at most threads_per_run CPU threads. All runs share one --features_cache
+(<sweep_dir>/features by default), so the training split is tokenized once: the first
+run builds the cache alone and the others memory-map it. Finished runs are recorded in
+<sweep_dir>/results.jsonl; when the sweep is restarted, they are skipped and the model
+directories of unfinished runs are removed. The table of all runs is written to
+<sweep_dir>/results.tsv.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def expand_grid(grid):
+    """Returns one {arg: value} dict per combination of the grid values, in a fixed order."""
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def config_id(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+
+def to_command_line(args):
+    """run_ner.py command line of an {arg: value} dict (True for flags)."""
+    command = [sys.executable, '-m', 'run_ner']
+    for name, value in sorted(args.items()):
+        if value is True:
+            command.append('--' + name)
+        elif value is not False and value is not None:
+            command.extend(['--' + name] + ([str(v) for v in value] if isinstance(value, list) else [str(value)]))
+    return command
+
+
+def read_results(results_file):
+    results = dict()
+    if os.path.exists(results_file):
+        with open(results_file) as fin:
+            for line in fin:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result['model_id']] = result
+    return results
+
+
+def _best_score(model_dir, dev_on, registry_file):
+    from run_ner import _load_previous_best_score
+    from tools.experiment_registry import ExperimentRegistry
+    registry = ExperimentRegistry(registry_file) if registry_file and os.path.exists(registry_file) else None
+    try:
+        return _load_previous_best_score(model_dir, dev_on, registry=registry)
+    finally:
+        if registry is not None:
+            registry.close()
+
+
+class SweepRunner(object):
+
+    def __init__(self, base_args, grid, sweep_dir, sweep_name=None, threads_per_run=1):
+        self.base_args = dict(base_args)
+        self.configs = expand_grid(grid)
+        self.sweep_dir = sweep_dir
+        self.sweep_name = sweep_name or os.path.basename(os.path.normpath(sweep_dir))
+        self.threads_per_run = threads_per_run
+        self.results_file = os.path.join(sweep_dir, 'results.jsonl')
+        self.base_args.setdefault('features_cache', os.path.join(sweep_dir, 'features'))
+        self.base_args['do_train'] = True
+        self.registry_file = self.base_args.get('registry')
+
+    def model_id(self, config):
+        return '{}_{}'.format(self.sweep_name, config_id(config))
+
+    def run(self, config):
+        """Trains one configuration and returns its result record."""
+        model_id = self.model_id(config)
+        model_dir = os.path.join(self.base_args['base_dir'], model_id)
+        if os.path.exists(model_dir):
+            # left over by an interrupted sweep
+            shutil.rmtree(model_dir)
+
+        args = dict(self.base_args, **config)
+        args['model_id'] = model_id
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.threads_per_run), MKL_NUM_THREADS=str(self.threads_per_run))
+        log_file = os.path.join(self.sweep_dir, 'logs', model_id + '.log')
+        with open(log_file, 'w') as fout:
+            returncode = subprocess.call(to_command_line(args), stdout=fout, stderr=subprocess.STDOUT, env=env)
+
+        result = {'model_id': model_id, 'config': config, 'returncode': returncode, 'log_file': log_file,
+                  'f1_token': _best_score(model_dir, args['dev_on'], self.registry_file) if returncode == 0 else None}
+        if returncode == 0:
+            with open(self.results_file, 'a') as fout:
+                fout.write(json.dumps(result) + '\n')
+        return result
+
+    def run_all(self, num_parallel=1):
+        """Runs the configurations without a result and returns the results of all of them."""
+        for path in [self.sweep_dir, os.path.join(self.sweep_dir, 'logs')]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        results = read_results(self.results_file)
+        pending = [config for config in self.configs if self.model_id(config) not in results]
+        print('{} / {} runs to go'.format(len(pending), len(self.configs)))
+
+        def report(result):
+            results[result['model_id']] = result
+            print('{} {}'.format(result['model_id'], 'f1_token={:.4f}'.format(result['f1_token'])
+                                 if result['returncode'] == 0 else 'failed, see ' + result['log_file']))
+
+        if pending:
+            # the first run tokenizes the training data for the features cache
+            report(self.run(pending[0]))
+            with ThreadPoolExecutor(max_workers=num_parallel) as executor:
+                for result in executor.map(self.run, pending[1:]):
+                    report(result)
+
+        return [results[self.model_id(config)] for config in self.configs
+                if self.model_id(config) in results]
+
+    def write_table(self, results, output_file=None):
+        names = sorted(self.configs[0]) if self.configs else []
+        rows = [['model_id'] + names + ['f1_token']]
+        for result in sorted(results, key=lambda r: [r['config'][name] for name in names]):
+            f1 = '{:.2f}'.format(100 * result['f1_token']) if result['f1_token'] is not None else 'failed'
+            rows.append([result['model_id']] + [str(result['config'][name]) for name in names] + [f1])
+        output_file = output_file or os.path.join(self.sweep_dir, 'results.tsv')
+        with open(output_file, 'w') as fout:
+            for row in rows:
+                fout.write('\t'.join(row) + '\n')
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Grid sweep of run_ner.py trainings.')
+
+    parser.add_argument("--config", type=str, required=True,
+                        help='json file with the common run_ner.py arguments ("args") and the grid ("grid": '
+                             '{argument: [values]}).')
+    parser.add_argument("--sweep_dir", type=str, required=True,
+                        help="Directory for the results, logs and (by default) the features cache.")
+    parser.add_argument("--sweep_name", type=str,
+                        help="Prefix of the model ids (default: the name of sweep_dir).")
+    parser.add_argument("--num_parallel", type=int, default=1,
+                        help="Number of runs at a time.")
+    parser.add_argument("--threads_per_run", type=int,
+                        help="CPU threads of every run (OMP_NUM_THREADS; default: the CPUs divided among the "
+                             "parallel runs).")
+
+    args = parser.parse_args()
+
+    threads_per_run = args.threads_per_run or max(1, (os.cpu_count() or 1) // args.num_parallel)
+    config = json.load(open(args.config))
+    runner = SweepRunner(config['args'], config['grid'], args.sweep_dir, sweep_name=args.sweep_name,
+                         threads_per_run=threads_per_run)
+    results = runner.run_all(num_parallel=args.num_parallel)
+    runner.write_table(results)
+
+
+if __name__ == '__main__':
+    main()
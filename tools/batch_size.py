@@ -0,0 +1,164 @@
+"""
+Automatic batch-size selection of run_ner.py (--auto_batch_size).
+
+Batch sizes 1, 2, 4, ... (up to a maximum) are probed with real forward passes (and
+backward passes for training) of the model at the real max_seq_length. Every probe
+measures the examples/s and the memory used on top of what was allocated before it:
+the torch allocator peak on GPU, or the peak RSS on CPU. Probing stops before the next
+size would use more than a fraction of the available memory (extrapolated linearly
+from the last probe), when a probe goes over it or runs out of memory, and when the
+throughput stops improving by at least min_gain. The largest size that was within
+the memory limit and still improved the throughput is chosen.
+
+The choices are cached in a json file under a key of the host, device, number of
+threads, model config, max_seq_length, precision and probing settings, so a host
+probes once per model config.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+import platform
+import socket
+import time
+
+import torch
+
+from tools.memory import MB, available_memory, current_rss, peak_rss, reset_peak_rss
+from tools.topology import model_config_hash
+
+logger = logging.getLogger(__name__)
+
+
+def candidate_batch_sizes(max_batch_size):
+    """1, 2, 4, ... below max_batch_size, then max_batch_size."""
+    sizes = []
+    batch_size = 1
+    while batch_size < max_batch_size:
+        sizes.append(batch_size)
+        batch_size *= 2
+    return sizes + [max_batch_size]
+
+
+def accumulation_for(effective_batch_size, max_batch_size):
+    """(batch size, gradient accumulation steps) with the largest batch size <= max_batch_size that
+    divides effective_batch_size, so that the effective batch size stays the same."""
+    batch_size = max(d for d in range(1, min(max_batch_size, effective_batch_size) + 1)
+                     if effective_batch_size % d == 0)
+    return batch_size, effective_batch_size // batch_size
+
+
+def _is_out_of_memory(error):
+    return 'out of memory' in str(error).lower()
+
+
+def _measure(run_batch, batch_size, device, repeats):
+    """Seconds per batch (best of repeats, after a warm-up) and bytes used by run_batch(batch_size)."""
+    cuda = device.type == 'cuda'
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+        base = torch.cuda.memory_allocated()
+    else:
+        reset_peak_rss()
+        base = current_rss()
+
+    run_batch(batch_size)
+    times = []
+    for _ in range(repeats):
+        if cuda:
+            torch.cuda.synchronize()
+        s_time = time.perf_counter()
+        run_batch(batch_size)
+        if cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - s_time)
+
+    used = (torch.cuda.max_memory_allocated() if cuda else peak_rss()) - base
+    return min(times), max(used, 0)
+
+
+def find_batch_size(run_batch, device, max_batch_size, memory_fraction=0.8, min_gain=0.05, repeats=2):
+    """Returns (batch size, probes) for run_batch(batch_size), a callable that runs one batch.
+
+    probes: [{'batch_size', 'examples_per_s', 'memory_mb'}] of the probed sizes.
+    """
+    if device.type == 'cuda':
+        limit = memory_fraction * torch.cuda.mem_get_info(device)[0]
+    else:
+        limit = memory_fraction * available_memory()
+    logger.info('Probing batch sizes up to {} within {:.0f} MB...'.format(max_batch_size, limit / MB))
+
+    probes = []
+    best = None
+    for batch_size in candidate_batch_sizes(max_batch_size):
+        if probes and probes[-1]['memory_mb'] * MB * batch_size / probes[-1]['batch_size'] > limit:
+            logger.info('  {}: would exceed the memory limit'.format(batch_size))
+            break
+        try:
+            seconds, used = _measure(run_batch, batch_size, device, repeats)
+        except RuntimeError as e:
+            if not _is_out_of_memory(e):
+                raise
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+            logger.info('  {}: out of memory'.format(batch_size))
+            break
+        probe = {'batch_size': batch_size, 'examples_per_s': batch_size / max(seconds, 1e-12),
+                 'memory_mb': used / MB}
+        probes.append(probe)
+        logger.info('  {}: {:.1f} examples/s, {:.1f} MB'.format(batch_size, probe['examples_per_s'],
+                                                                probe['memory_mb']))
+        if used > limit:
+            break
+        if best is not None and probe['examples_per_s'] < (1 + min_gain) * best['examples_per_s']:
+            break
+        best = probe
+
+    if best is None:
+        logger.warning('Batch size 1 does not fit in {:.0f} MB; using it anyway.'.format(limit / MB))
+        return 1, probes
+    return best['batch_size'], probes
+
+
+def cache_key(model, max_seq_length, device, mode, precision, max_batch_size, memory_fraction, min_gain):
+    """Key of a choice: host, device, threads, model config and probing settings."""
+    if device.type == 'cuda':
+        device_name = torch.cuda.get_device_name(device)
+    else:
+        device_name = '{}-{}cpu-{}threads'.format(platform.processor() or platform.machine(), os.cpu_count(),
+                                                  torch.get_num_threads())
+    return '|'.join(str(x) for x in [socket.gethostname(), device_name, model_config_hash(model.config), mode,
+                                     max_seq_length, precision, max_batch_size, memory_fraction, min_gain])
+
+
+class BatchSizeCache(object):
+    """The chosen batch sizes as {key: {'batch_size', 'probes', 'time'}} in a json file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return dict()
+        with open(self.path) as fin:
+            return json.load(fin)
+
+    def get(self, key):
+        entry = self._read().get(key)
+        return entry['batch_size'] if entry else None
+
+    def put(self, key, batch_size, probes):
+        entries = self._read()
+        entries[key] = {'batch_size': batch_size, 'probes': probes, 'time': time.time()}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.tmp{}'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fout:
+            json.dump(entries, fout, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
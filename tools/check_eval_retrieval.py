@@ -0,0 +1,77 @@
+"""
+Checks tools/eval_retrieval.py against the numbers of trec_eval on a fixture:
+
+    python -m tools.check_eval_retrieval
+
+tools/fixtures/trec_eval has a small qrels and run file (graded judgments, tied
+scores, unjudged documents, a query without relevant documents, a judged query
+missing from the run and a run query missing from the qrels) and expected.json, the
+per-query and mean metrics of trec_eval on them. The check exits with an error on
+any difference, and also when evaluating the same run again changes anything.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+from tools.eval_retrieval import RetrievalEvaluator, aggregate, read_qrels
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'trec_eval')
+
+
+def compare(expected, qids, per_query_metrics, tolerance):
+    """Differences between expected (trec_eval) and the given metrics, as messages."""
+    differences = []
+    if sorted(qids) != sorted(expected['per_query']):
+        differences.append('evaluated queries {} vs trec_eval {}'.format(sorted(qids), sorted(expected['per_query'])))
+    means = aggregate(per_query_metrics)
+    for metric, value in sorted(expected['all'].items()):
+        if metric not in means:
+            differences.append('{}: missing'.format(metric))
+            continue
+        if abs(means[metric] - value) > tolerance:
+            differences.append('{} all: {:.6f} vs trec_eval {:.6f}'.format(metric, means[metric], value))
+        for qid, metric_value in zip(qids, per_query_metrics[metric]):
+            expected_value = expected['per_query'].get(qid, {}).get(metric)
+            if expected_value is not None and abs(metric_value - expected_value) > tolerance:
+                differences.append('{} {}: {:.6f} vs trec_eval {:.6f}'.format(metric, qid, metric_value,
+                                                                              expected_value))
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks tools/eval_retrieval.py against trec_eval on a fixture.')
+
+    parser.add_argument("--fixture_dir", type=str, default=FIXTURE_DIR,
+                        help="Directory with qrels.txt, run.txt and expected.json.")
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+
+    args = parser.parse_args()
+
+    expected = json.load(open(os.path.join(args.fixture_dir, 'expected.json')))
+    evaluator = RetrievalEvaluator(read_qrels(os.path.join(args.fixture_dir, 'qrels.txt')))
+    num_docids = len(evaluator.docid2index)
+
+    differences = []
+    for _ in range(2):
+        qids, per_query_metrics = evaluator.evaluate_file(os.path.join(args.fixture_dir, 'run.txt'),
+                                                          ndcg_cutoffs=(3, 5, 10), recall_cutoffs=(100, 1000))
+        differences.extend(compare(expected, qids, per_query_metrics, args.tolerance))
+    if len(evaluator.docid2index) != num_docids:
+        differences.append('evaluating the run added {} docids to the evaluator'.format(
+            len(evaluator.docid2index) - num_docids))
+
+    for difference in differences:
+        print('MISMATCH ' + difference)
+    print('{} queries, {} metrics: {} mismatches'.format(len(expected['per_query']), len(expected['all']),
+                                                         len(differences)))
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == '__main__':
+    main()
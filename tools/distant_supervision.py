@@ -0,0 +1,202 @@
+"""
+Distant supervision for query resolution: generates the token classification data
+read by run_ner.py (``bert_ner_overlap``) from raw conversations and their gold
+rewrites, e.g.:
+
+    python -m tools.distant_supervision --raw_query_file train_raw.tsv --rewrite_file train_rewrites.tsv \
+        --output_dir ./data/new_logs/token_classification/train_ds --num_shards 8 --num_workers 8
+
+Every turn but the first becomes one example: the words of the previous turns,
+'[SEP]' and the words of the current turn. A history word is labelled REL if its
+normalized form occurs in the gold rewrite but not in the current turn, and O
+otherwise (the words of the current turn are always O).
+
+Both input files are tsv (qid<TAB>text); the turns of a conversation (topic#turn
+for QuAC, topic_turn for CAsT) must be contiguous and in order in the raw query
+file. Conversations are labelled in parallel, and the output is written to
+<output_dir>/part-<shard>.jsonl, so it can be used with --train_on <name of
+output_dir> (see ConvSearchProcessor.get_data_files).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+from collections import defaultdict
+
+SEP = '[SEP]'
+
+_PUNCTUATION = re.compile(r'^\W+|\W+$', re.UNICODE)
+
+
+def normalize(word):
+    """Lowercases a word and strips leading and trailing punctuation ('' for punctuation only)."""
+    return _PUNCTUATION.sub('', word.lower())
+
+
+def _get_topic_id(qid):
+    separator = '#' if '#' in qid else '_'
+    return qid[:qid.index(separator)]
+
+
+def read_rewrites(rewrite_file):
+    qid2rewrite = dict()
+    with open(rewrite_file) as fin:
+        for line in fin:
+            qid, rewrite = line.rstrip('\n').split('\t')[:2]
+            qid2rewrite[qid] = rewrite
+    return qid2rewrite
+
+
+def iter_conversations(raw_query_file):
+    """Yields the [(qid, question)] turns of one conversation at a time."""
+    seen_topic_ids = set()
+    topic_id, turns = None, []
+    with open(raw_query_file) as fin:
+        for line in fin:
+            qid, question = line.rstrip('\n').split('\t')[:2]
+            if _get_topic_id(qid) != topic_id:
+                if turns:
+                    yield turns
+                topic_id, turns = _get_topic_id(qid), []
+                if topic_id in seen_topic_ids:
+                    raise ValueError('The turns of conversation {} are not contiguous in {}'
+                                     .format(topic_id, raw_query_file))
+                seen_topic_ids.add(topic_id)
+            turns.append((qid, question))
+    if turns:
+        yield turns
+
+
+def label_conversation(turns, stopwords=frozenset()):
+    """Returns the examples of one conversation given its [(qid, question, rewrite)] turns.
+
+    The history is indexed by normalized word (positions of its occurrences), so the labels
+    of a turn are found in time linear in the length of the turn and its rewrite; only the
+    positions of the REL words are visited.
+    """
+    examples = []
+    history = []
+    term2positions = defaultdict(list)
+    for i, (qid, question, rewrite) in enumerate(turns):
+        words = question.split()
+        if i > 0:
+            if rewrite is None:
+                raise ValueError('No gold rewrite for {}'.format(qid))
+            current_terms = {normalize(w) for w in words}
+            labels = ['O'] * len(history)
+            for term in {normalize(w) for w in rewrite.split()}:
+                if term and term not in stopwords and term not in current_terms:
+                    for position in term2positions.get(term, []):
+                        labels[position] = 'REL'
+            examples.append({'id': qid,
+                             'bert_ner_overlap': [history + [SEP] + words, labels + [SEP] + ['O'] * len(words)]})
+        for w in words:
+            term2positions[normalize(w)].append(len(history))
+            history.append(w)
+    return examples
+
+
+class _Labeller(object):
+    # picklable callable for the process pool
+
+    def __init__(self, stopwords):
+        self.stopwords = stopwords
+
+    def __call__(self, turns):
+        return label_conversation(turns, self.stopwords)
+
+
+def _iter_conversations_with_rewrites(raw_query_file, qid2rewrite, stats):
+    # a conversation is cut at its first turn (other than the first) without a rewrite
+    for turns in iter_conversations(raw_query_file):
+        stats['num_conversations'] += 1
+        missing = [i for i, (qid, _) in enumerate(turns) if i > 0 and qid not in qid2rewrite]
+        stats['num_missing_rewrites'] += len(missing)
+        if missing:
+            turns = turns[:missing[0]]
+        yield [(qid, question, qid2rewrite.get(qid)) for qid, question in turns]
+
+
+def generate(raw_query_file, rewrite_file, output_dir, num_shards=1, num_workers=1, stopwords=frozenset(),
+             chunksize=16):
+    """Labels all conversations and writes them to num_shards jsonl files in output_dir.
+
+    Conversation i goes to shard i % num_shards. Turns without a gold rewrite (other than
+    first turns) are skipped, together with the rest of their conversation.
+    Returns counts of conversations, examples, REL labels and missing rewrites.
+    """
+    qid2rewrite = read_rewrites(rewrite_file)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    stats = {'num_conversations': 0, 'num_missing_rewrites': 0, 'num_examples': 0, 'num_rel': 0,
+             'num_history_words': 0}
+    conversations = _iter_conversations_with_rewrites(raw_query_file, qid2rewrite, stats)
+
+    paths = [os.path.join(output_dir, 'part-{:05d}.jsonl'.format(shard)) for shard in range(num_shards)]
+    fouts = [open(path + '.tmp', 'w') for path in paths]
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    try:
+        labeller = _Labeller(stopwords)
+        results = pool.imap(labeller, conversations, chunksize=chunksize) if pool is not None \
+            else (labeller(turns) for turns in conversations)
+        for i, examples in enumerate(results):
+            fout = fouts[i % num_shards]
+            for example in examples:
+                labels = example['bert_ner_overlap'][1]
+                stats['num_examples'] += 1
+                stats['num_rel'] += labels.count('REL')
+                stats['num_history_words'] += labels.index(SEP)
+                fout.write(json.dumps(example) + '\n')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for fout in fouts:
+            fout.close()
+    for path in paths:
+        os.replace(path + '.tmp', path)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate token classification data from gold rewrites.')
+
+    parser.add_argument("--raw_query_file", type=str, required=True,
+                        help="tsv file with qid<TAB>question, the turns of every conversation in order.")
+    parser.add_argument("--rewrite_file", type=str, required=True,
+                        help="tsv file with qid<TAB>gold rewrite.")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="Directory for the part-*.jsonl shards.")
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                        help="Number of processes (1 labels in the main process).")
+    parser.add_argument("--stopwords_file", type=str,
+                        help="Optional file with one stopword per line; stopwords are never labelled REL.")
+
+    args = parser.parse_args()
+
+    stopwords = frozenset()
+    if args.stopwords_file:
+        with open(args.stopwords_file) as fin:
+            stopwords = frozenset(normalize(line.strip()) for line in fin if line.strip())
+
+    stats = generate(args.raw_query_file, args.rewrite_file, args.output_dir, num_shards=args.num_shards,
+                     num_workers=args.num_workers, stopwords=stopwords)
+
+    print('Written {} examples of {} conversations to {} shard(s) in {}'.format(
+        stats['num_examples'], stats['num_conversations'], args.num_shards, args.output_dir))
+    print('REL labels: {} / {} history words'.format(stats['num_rel'], stats['num_history_words']))
+    if stats['num_missing_rewrites']:
+        print('Warning: {} turns have no gold rewrite; they and the rest of their conversation were skipped.'
+              .format(stats['num_missing_rewrites']))
+
+
+if __name__ == '__main__':
+    main()
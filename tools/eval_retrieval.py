@@ -0,0 +1,278 @@
+"""
+Vectorized TREC-style retrieval metrics: NDCG@k, MAP, MRR and Recall@k.
+
+Qrels and runs are loaded once into integer arrays (query index, document
+index, relevance / score). Runs are ordered like trec_eval (by decreasing
+score, ties by decreasing docid) and all metrics are computed for all queries
+at once with numpy. As in trec_eval, documents with relevance >= 1 are
+relevant, NDCG uses the relevance grade as gain, and only queries that appear
+in both the run and the qrels are evaluated.
+
+Usage:
+    python -m tools.eval_retrieval --qrel_file qrels.json --run_file run.txt
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+from itertools import islice
+
+import numpy as np
+
+
+def read_qrels(qrel_file):
+    """Reads qrels as a list of (qid, docid, relevance).
+
+    Supports json ({qid: {docid: relevance}}) and the TREC format (qid 0 docid relevance).
+    """
+    if qrel_file.endswith('.json'):
+        qrels = json.load(open(qrel_file))
+        return [(str(qid), str(docid), int(rel)) for qid, docs in qrels.items() for docid, rel in docs.items()]
+
+    qrels = []
+    with open(qrel_file) as fin:
+        for line in fin:
+            fields = line.split()
+            if fields:
+                qrels.append((fields[0], fields[2], int(fields[3])))
+    return qrels
+
+
+def read_run(run_file):
+    """Yields (qid, docid, score) from a TREC run file (qid Q0 docid rank score tag)."""
+    for qids, docids, scores in _iter_run_columns(run_file):
+        for row in zip(qids, docids, scores):
+            yield row
+
+
+def _iter_run_columns(run_file, chunk_size=1 << 24):
+    # parses about chunk_size characters of lines at a time into (qids, docids, scores) columns
+    with open(run_file) as fin:
+        while True:
+            lines = fin.readlines(chunk_size)
+            if not lines:
+                break
+            fields = ''.join(lines).split()
+            if len(fields) != 6 * len(lines):
+                fields = [f for line in lines for f in (line.split() + [''] * 6)[:6] if line.strip()]
+            yield fields[0::6], fields[2::6], np.asarray(fields[4::6], dtype=np.float64)
+
+
+def _iter_row_columns(run, chunk_size=1 << 20):
+    run = iter(run)
+    while True:
+        rows = list(islice(run, chunk_size))
+        if not rows:
+            break
+        qids, docids, scores = zip(*rows)
+        yield qids, docids, np.asarray(scores, dtype=np.float64)
+
+
+class RetrievalEvaluator(object):
+    """Evaluates runs against one set of qrels."""
+
+    def __init__(self, qrels):
+        qids, docids, rels = zip(*qrels) if qrels else ((), (), ())
+        self.qids = sorted(set(qids))
+        self.qid2index = {qid: i for i, qid in enumerate(self.qids)}
+        self.num_queries = len(self.qids)
+
+        self.docid2index = dict()
+        self.q = np.asarray([self.qid2index[qid] for qid in qids], dtype=np.int64)
+        self.d = np.asarray([self._docid_index(docid) for docid in docids], dtype=np.int64)
+        self.rel = np.asarray(rels, dtype=np.int64)
+        self.num_rel = np.bincount(self.q, weights=self.rel >= 1, minlength=self.num_queries)
+
+        # qrels in (query, decreasing relevance) order, for the ideal DCG
+        order = np.lexsort((-self.rel, self.q))
+        self._ideal_q = self.q[order]
+        self._ideal_gain = np.maximum(self.rel[order], 0)
+        self._ideal_rank = _ranks_within(self._ideal_q)
+
+    def _docid_index(self, docid):
+        return self.docid2index.setdefault(docid, len(self.docid2index))
+
+    def _encode_run(self, run_columns):
+        # only unique docids are kept as strings; rows become integer arrays. Docids that are
+        # not in the qrels go to a mapping of this run, so the evaluator does not grow per run.
+        run_q, run_d, run_scores = [], [], []
+        docid2index = dict(self.docid2index)
+        qid_index, docid_index = self.qid2index.get, docid2index.setdefault
+        for qids, docids, scores in run_columns:
+            q = np.asarray([qid_index(qid, -1) for qid in qids], dtype=np.int64)
+            d = np.asarray([docid_index(docid, len(docid2index)) for docid in docids], dtype=np.int64)
+            keep = q >= 0
+            run_q.append(q[keep])
+            run_d.append(d[keep])
+            run_scores.append(scores[keep])
+        run_q, run_d, scores = [np.concatenate(x) if x else np.zeros(0, dtype=t)
+                                for x, t in [(run_q, np.int64), (run_d, np.int64), (run_scores, np.float64)]]
+
+        # integer docids that sort like the docid strings (for trec_eval's tie breaking)
+        vocab = np.empty(len(docid2index), dtype=object)
+        vocab[list(docid2index.values())] = list(docid2index.keys())
+        string_rank = np.empty(len(vocab), dtype=np.int64)
+        string_rank[np.argsort(vocab.astype(str), kind='mergesort')] = np.arange(len(vocab))
+        return run_q, run_d, scores, string_rank
+
+    def evaluate(self, run, ndcg_cutoffs=(3, 5, 10), recall_cutoffs=(100, 1000)):
+        """Computes per-query metrics of a run given as an iterable of (qid, docid, score).
+
+        Returns:
+            (qids, dict metric -> per-query array). Means are given by ``aggregate``.
+        """
+        return self._evaluate(_iter_row_columns(run), ndcg_cutoffs, recall_cutoffs)
+
+    def evaluate_file(self, run_file, ndcg_cutoffs=(3, 5, 10), recall_cutoffs=(100, 1000)):
+        """Same as ``evaluate`` for a TREC run file, parsed in large chunks."""
+        return self._evaluate(_iter_run_columns(run_file), ndcg_cutoffs, recall_cutoffs)
+
+    def _evaluate(self, run_columns, ndcg_cutoffs, recall_cutoffs):
+        run_q, run_d, scores, string_rank = self._encode_run(run_columns)
+        if len(run_q) == 0:
+            return [], dict()
+        num_docs = len(string_rank)
+
+        # trec_eval order: by query, decreasing score, decreasing docid
+        order = np.lexsort((-string_rank[run_d], -scores, run_q))
+        run_q, run_d = run_q[order], run_d[order]
+        rank = _ranks_within(run_q)
+
+        qrel_keys = self.q * num_docs + self.d
+        key_order = np.argsort(qrel_keys)
+        qrel_keys, qrel_rels = qrel_keys[key_order], self.rel[key_order]
+        run_keys = run_q * num_docs + run_d
+        pos = np.minimum(np.searchsorted(qrel_keys, run_keys), len(qrel_keys) - 1)
+        rel = np.where(qrel_keys[pos] == run_keys, qrel_rels[pos], 0)
+
+        is_rel = rel >= 1
+        num_rel = self.num_rel
+        evaluated = np.unique(run_q)
+        n = self.num_queries
+
+        def per_query(weights):
+            return np.bincount(run_q, weights=weights, minlength=n)
+
+        def safe_div(a, b):
+            return np.where(b > 0, a / np.maximum(b, 1), 0.)
+
+        metrics = dict()
+
+        # MAP
+        cum_rel = np.cumsum(is_rel)
+        group_start = np.concatenate([[0], np.flatnonzero(np.diff(run_q)) + 1])
+        cum_rel_before_group = np.repeat(cum_rel[group_start] - is_rel[group_start],
+                                         np.diff(np.concatenate([group_start, [len(run_q)]])))
+        precision_at_rank = (cum_rel - cum_rel_before_group) / rank
+        metrics['map'] = safe_div(per_query(is_rel * precision_at_rank), num_rel)
+
+        # MRR
+        first_rel_q, first_rel_index = np.unique(run_q[is_rel], return_index=True)
+        recip_rank = np.zeros(n)
+        recip_rank[first_rel_q] = 1. / rank[is_rel][first_rel_index]
+        metrics['recip_rank'] = recip_rank
+
+        # NDCG@k
+        discount = 1. / np.log2(rank + 1)
+        ideal_discount = 1. / np.log2(self._ideal_rank + 1)
+        gain = np.maximum(rel, 0)
+        for k in ndcg_cutoffs:
+            dcg = per_query(gain * discount * (rank <= k))
+            idcg = np.bincount(self._ideal_q, weights=self._ideal_gain * ideal_discount * (self._ideal_rank <= k),
+                               minlength=n)
+            metrics['ndcg_cut_{}'.format(k)] = safe_div(dcg, idcg)
+
+        # Recall@k
+        for k in recall_cutoffs:
+            metrics['recall_{}'.format(k)] = safe_div(per_query(is_rel & (rank <= k)), num_rel)
+
+        return [self.qids[i] for i in evaluated], {m: v[evaluated] for m, v in metrics.items()}
+
+
+def _ranks_within(groups):
+    """1-based position of every element within its run of equal (sorted) group values."""
+    if len(groups) == 0:
+        return np.zeros(0, dtype=np.int64)
+    group_start = np.concatenate([[0], np.flatnonzero(np.diff(groups)) + 1])
+    sizes = np.diff(np.concatenate([group_start, [len(groups)]]))
+    return np.arange(len(groups)) - np.repeat(group_start, sizes) + 1
+
+
+def aggregate(per_query_metrics):
+    """Means of per-query metrics."""
+    return {m: float(np.mean(v)) if len(v) else 0. for m, v in per_query_metrics.items()}
+
+
+def evaluate_run(qrel_file, run_file, ndcg_cutoffs=(3, 5, 10), recall_cutoffs=(100, 1000)):
+    """Returns (mean metrics, qids, per-query metrics) of a run file."""
+    evaluator = RetrievalEvaluator(read_qrels(qrel_file))
+    qids, per_query_metrics = evaluator.evaluate_file(run_file, ndcg_cutoffs=ndcg_cutoffs,
+                                                      recall_cutoffs=recall_cutoffs)
+    return aggregate(per_query_metrics), qids, per_query_metrics
+
+
+def _parse_cutoffs(s):
+    return tuple(int(k) for k in s.split(',') if k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TREC-style evaluation of a run file.')
+
+    parser.add_argument("--qrel_file",
+                        type=str,
+                        help="Qrels in json ({qid: {docid: relevance}}) or TREC format.")
+
+    parser.add_argument("--dataset_name",
+                        type=str,
+                        help="If --qrel_file is not given, use the qrels of this dataset (quac or cast)...")
+
+    parser.add_argument("--split",
+                        type=str,
+                        help="...and this split...")
+
+    parser.add_argument("--qrel_data_dir",
+                        type=str,
+                        help="...found under this directory.")
+
+    parser.add_argument("--run_file",
+                        type=str,
+                        required=True)
+
+    parser.add_argument("--ndcg_cutoffs",
+                        type=str,
+                        default='3,5,10')
+
+    parser.add_argument("--recall_cutoffs",
+                        type=str,
+                        default='100,1000')
+
+    parser.add_argument("--per_query_file",
+                        type=str,
+                        help="Optional json file for the per-query metrics (e.g. for significance testing).")
+
+    args = parser.parse_args()
+
+    qrel_file = args.qrel_file
+    if qrel_file is None:
+        if not (args.dataset_name and args.split and args.qrel_data_dir):
+            raise ValueError('Either --qrel_file or --dataset_name, --split and --qrel_data_dir are required.')
+        from generate_query_files_for_trained_model import _get_qrel_file
+        qrel_file = _get_qrel_file(args.dataset_name, args.split, data_dir=args.qrel_data_dir)
+
+    means, qids, per_query_metrics = evaluate_run(qrel_file, args.run_file,
+                                                  ndcg_cutoffs=_parse_cutoffs(args.ndcg_cutoffs),
+                                                  recall_cutoffs=_parse_cutoffs(args.recall_cutoffs))
+    print('{:<16s}\t{}'.format('num_q', len(qids)))
+    for metric in sorted(means):
+        print('{:<16s}\t{:.4f}'.format(metric, means[metric]))
+
+    if args.per_query_file:
+        json.dump({'qids': qids, 'metrics': {m: v.tolist() for m, v in per_query_metrics.items()}},
+                  open(args.per_query_file, 'w'))
+
+
+if __name__ == '__main__':
+    main()
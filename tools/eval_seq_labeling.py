@@ -9,6 +9,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import argparse
+import json
+import time
 from collections import defaultdict
 
 import numpy as np
@@ -332,3 +335,163 @@ def classification_report(y_true, y_pred, digits=2, suffix=False):
                              width=width, digits=digits)
 
     return report
+
+
+
+def threshold_sweep(y_true, y_prob, thresholds=None, num_thresholds=1001):
+    """Compute token precision, recall and F1 for many decision thresholds at once.
+
+    A token is predicted as relevant when its probability is at least the
+    threshold. Scores are computed from cumulative counts over the tokens
+    sorted by probability, so the cost is one sort plus one binary search per
+    threshold. Scores for a single threshold match ``precision_score``,
+    ``recall_score`` and ``f1_score`` on the corresponding predictions.
+
+    Args:
+        y_true : 2d array. Ground truth (correct) target values.
+        y_prob : 2d array. Probability of the positive label for every token of y_true.
+        thresholds : 1d array. Thresholds to evaluate (optional).
+        num_thresholds : int. Number of evenly spaced thresholds in [0, 1] used if thresholds is None.
+
+    Returns:
+        thresholds, precision, recall, f1 : 1d arrays of the same length.
+
+    Example:
+        >>> y_true = [['O', 'REL', 'O'], ['REL', 'O']]
+        >>> y_prob = [[0.1, 0.8, 0.6], [0.4, 0.2]]
+        >>> _, p, r, f1 = threshold_sweep(y_true, y_prob, thresholds=[0.5])
+        >>> print(p[0], r[0], f1[0])
+        0.5 0.5 0.5
+    """
+    if any(isinstance(s, list) for s in y_true):
+        y_true = [item for sublist in y_true for item in sublist]
+        y_prob = [item for sublist in y_prob for item in sublist]
+
+    if len(y_true) != len(y_prob):
+        raise ValueError('y_true and y_prob have different lengths ({} vs {})'.format(len(y_true), len(y_prob)))
+
+    if thresholds is None:
+        thresholds = np.linspace(0.0, 1.0, num_thresholds)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    is_true = np.asarray(y_true, dtype=object) != 'O'
+    probs = np.asarray(y_prob, dtype=np.float64)
+
+    order = np.argsort(probs, kind='mergesort')
+    probs = probs[order]
+    # tp_above[k]: number of true tokens among those with the (len - k) highest probabilities
+    tp_above = np.concatenate([np.cumsum(is_true[order][::-1])[::-1], [0]])
+
+    first_predicted = np.searchsorted(probs, thresholds, side='left')
+    nb_pred = len(probs) - first_predicted
+    nb_correct = tp_above[first_predicted]
+    nb_true = is_true.sum()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(nb_pred > 0, nb_correct / np.maximum(nb_pred, 1), 0.)
+        r = np.where(nb_true > 0, nb_correct / max(nb_true, 1), 0.)
+        f1 = np.where(p + r > 0, 2 * p * r / (p + r), 0.)
+
+    return thresholds, p, r, f1
+
+
+def get_token_counts(y_true, y_pred):
+    """Count true positives, false positives and false negatives per sequence.
+
+    Counts follow the token-level entities of ``get_entities``, so summing
+    them over all sequences gives the numbers behind ``precision_score``,
+    ``recall_score`` and ``f1_score``.
+
+    Args:
+        y_true : 2d array. Ground truth (correct) target values.
+        y_pred : 2d array. Estimated targets as returned by a tagger.
+
+    Returns:
+        counts : int array of shape (num_sequences, 3) with columns tp, fp, fn.
+
+    Example:
+        >>> y_true = [['O', 'REL', 'REL'], ['REL', 'O']]
+        >>> y_pred = [['REL', 'REL', 'O'], ['O', 'O']]
+        >>> get_token_counts(y_true, y_pred).tolist()
+        [[1, 1, 1], [0, 0, 1]]
+    """
+    lengths = [len(seq) for seq in y_true]
+    if lengths != [len(seq) for seq in y_pred]:
+        raise ValueError('y_true and y_pred have different sequence lengths')
+
+    seq_index = np.repeat(np.arange(len(lengths)), lengths)
+    flat_true = np.asarray([item for sublist in y_true for item in sublist], dtype=object)
+    flat_pred = np.asarray([item for sublist in y_pred for item in sublist], dtype=object)
+
+    is_true = flat_true != 'O'
+    is_pred = flat_pred != 'O'
+    is_correct = is_true & (flat_true == flat_pred)
+
+    tp = np.bincount(seq_index, weights=is_correct, minlength=len(lengths))
+    nb_pred = np.bincount(seq_index, weights=is_pred, minlength=len(lengths))
+    nb_true = np.bincount(seq_index, weights=is_true, minlength=len(lengths))
+
+    return np.stack([tp, nb_pred - tp, nb_true - tp], axis=1).astype(np.int64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep the REL decision threshold of a model output file.')
+
+    parser.add_argument("--model_output_file",
+                        type=str,
+                        required=True,
+                        help="eval_results_*.json file written by run_ner.py.")
+
+    parser.add_argument("--num_thresholds",
+                        type=int,
+                        default=1001,
+                        help="Number of evenly spaced thresholds in [0, 1].")
+
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=None,
+                        help="Threshold used for the query file. Defaults to the F1-optimal one.")
+
+    parser.add_argument("--raw_query_file",
+                        type=str,
+                        help="If given (with --output_file), write a query file at the chosen threshold.")
+
+    parser.add_argument("--dataset_name",
+                        default='cast',
+                        type=str)
+
+    parser.add_argument("--output_file",
+                        type=str)
+
+    args = parser.parse_args()
+
+    model_output_dct = json.load(open(args.model_output_file))
+    if 'y_prob' not in model_output_dct:
+        raise ValueError('{} has no REL probabilities (y_prob); re-run the evaluation with run_ner.py.'
+                         .format(args.model_output_file))
+
+    s_time = time.time()
+    thresholds, p, r, f1 = threshold_sweep(model_output_dct['y_true'], model_output_dct['y_prob'],
+                                           num_thresholds=args.num_thresholds)
+    best = int(np.argmax(f1))
+    print('Swept {} thresholds in {:.3f} seconds.'.format(len(thresholds), time.time() - s_time))
+
+    print('[Token eval, argmax] P={:.1f}, R={:.1f}, F1={:.1f}'.format(100 * model_output_dct['precision_token'],
+                                                                     100 * model_output_dct['recall_token'],
+                                                                     100 * model_output_dct['f1_token']))
+    print('[Token eval, threshold={:.3f}] P={:.1f}, R={:.1f}, F1={:.1f}'.format(thresholds[best], 100 * p[best],
+                                                                               100 * r[best], 100 * f1[best]))
+
+    if args.output_file:
+        if not args.raw_query_file:
+            raise ValueError('--raw_query_file is required to write a query file.')
+        from generate_query_files_for_trained_model import generate_query_file
+
+        threshold = args.threshold if args.threshold is not None else float(thresholds[best])
+        print('Writing query file at threshold {:.3f}...'.format(threshold))
+        generate_query_file(args.raw_query_file, args.model_output_file, args.output_file, args.dataset_name,
+                            threshold=threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Registry of evaluation results: one small record per evaluation run by run_ner.py
+(model_id, split, epoch, P/R/F1, train args, timings and the path of the
+eval_results_*.json file with the predictions), in a SQLite file indexed by model_id
+and split. Finding the best checkpoint of a model or building a results table then
+never parses the (large) prediction files.
+
+run_ner.py writes to the file given with --registry (e.g. <base_dir>/experiments.sqlite).
+To query it:
+
+    python -m tools.experiment_registry --registry ./models/experiments.sqlite table --split dev_cast
+    python -m tools.experiment_registry --registry ./models/experiments.sqlite best --model_id 191790_50 --split dev_cast
+
+and to add the results of models evaluated before the registry existed:
+
+    python -m tools.experiment_registry --registry ./models/experiments.sqlite import --base_dir ./models/
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+
+METRICS = ['f1_token', 'precision_token', 'recall_token']
+
+_COLUMNS = ['model_id', 'split', 'epoch', 'f1_token', 'precision_token', 'recall_token', 'train_args', 'timings',
+            'artifact_path', 'created_at']
+
+
+class ExperimentRegistry(object):
+    """SQLite-backed registry of evaluation records; safe to share between concurrent runs."""
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS evals ('
+                          'id INTEGER PRIMARY KEY, model_id TEXT, split TEXT, epoch INTEGER, '
+                          'f1_token REAL, precision_token REAL, recall_token REAL, '
+                          'train_args TEXT, timings TEXT, artifact_path TEXT, created_at REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS evals_model_split ON evals (model_id, split, f1_token)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS evals_split ON evals (split, f1_token)')
+        self.conn.commit()
+
+    def record(self, model_id, split, epoch, f1_token, precision_token, recall_token, train_args=None, timings=None,
+               artifact_path=None, created_at=None):
+        """Appends the record of one evaluation."""
+        with self.conn:
+            self.conn.execute('INSERT INTO evals ({}) VALUES ({})'.format(', '.join(_COLUMNS),
+                                                                          ', '.join('?' * len(_COLUMNS))),
+                              (model_id, split, epoch, f1_token, precision_token, recall_token,
+                               json.dumps(train_args or dict(), default=str), json.dumps(timings or dict()),
+                               os.path.abspath(artifact_path) if artifact_path else None,
+                               created_at if created_at is not None else time.time()))
+
+    def remove(self, model_id):
+        """Removes the records of model_id (e.g. when its directory is trained anew)."""
+        with self.conn:
+            self.conn.execute('DELETE FROM evals WHERE model_id = ?', (model_id,))
+
+    def _rows(self, query, params):
+        cursor = self.conn.execute(query, params)
+        for row in cursor:
+            record = dict(zip(_COLUMNS, row))
+            record['train_args'] = json.loads(record['train_args'])
+            record['timings'] = json.loads(record['timings'])
+            yield record
+
+    def best(self, model_id, split, metric='f1_token'):
+        """The record with the highest metric of model_id on split, or None."""
+        if metric not in METRICS:
+            raise ValueError('Unknown metric: {}'.format(metric))
+        return next(self._rows('SELECT {} FROM evals WHERE model_id = ? AND split = ? ORDER BY {} DESC, id LIMIT 1'
+                               .format(', '.join(_COLUMNS), metric), (model_id, split)), None)
+
+    def records(self, model_id=None, split=None):
+        """All records, optionally of one model_id (or a prefix ending with '*') and/or split, in order."""
+        conditions, params = [], []
+        if model_id is not None:
+            if model_id.endswith('*'):
+                conditions.append(r"model_id LIKE ? ESCAPE '\'")
+                params.append(model_id[:-1].replace('%', r'\%').replace('_', r'\_') + '%')
+            else:
+                conditions.append('model_id = ?')
+                params.append(model_id)
+        if split is not None:
+            conditions.append('split = ?')
+            params.append(split)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return list(self._rows('SELECT {} FROM evals{} ORDER BY id'.format(', '.join(_COLUMNS), where), params))
+
+    def results_table(self, split, model_id=None, metric='f1_token', train_args=()):
+        """The best record of every model on split, best first, as rows of
+        [model_id, epoch, P, R, F1] + the given train args."""
+        best = dict()
+        for record in self.records(model_id=model_id, split=split):
+            if record['model_id'] not in best or record[metric] > best[record['model_id']][metric]:
+                best[record['model_id']] = record
+        rows = []
+        for record in sorted(best.values(), key=lambda r: -r[metric]):
+            rows.append([record['model_id'], record['epoch'], record['precision_token'], record['recall_token'],
+                         record['f1_token']] + [record['train_args'].get(name) for name in train_args])
+        return rows
+
+    def import_eval_files(self, base_dir):
+        """Records the eval_results_<split>_epoch<N>.json files under base_dir/<model_id>/ that
+        are not in the registry yet. Returns the number of records added."""
+        known = {row[0] for row in self.conn.execute('SELECT artifact_path FROM evals')}
+        num_added = 0
+        for path in sorted(glob.glob(os.path.join(base_dir, '*', 'eval_results_*_epoch*.json'))):
+            path = os.path.abspath(path)
+            match = re.match(r'eval_results_(.+)_epoch(\d+)\.json$', os.path.basename(path))
+            if path in known or match is None:
+                continue
+            try:
+                results = json.load(open(path))
+                metrics = [results[metric] for metric in ['f1_token', 'precision_token', 'recall_token']]
+            except (ValueError, KeyError):
+                continue
+            model_dir = os.path.dirname(path)
+            train_args_file = os.path.join(model_dir, 'train_args.json')
+            train_args = json.load(open(train_args_file)) if os.path.exists(train_args_file) else None
+            self.record(os.path.basename(model_dir), match.group(1), int(match.group(2)), *metrics,
+                        train_args=train_args, artifact_path=path, created_at=os.path.getmtime(path))
+            num_added += 1
+        return num_added
+
+    def close(self):
+        self.conn.close()
+
+
+def _print_table(header, rows):
+    # P/R/F1 (columns 2-4) in percent
+    rows = [header] + [[str(value) if not 2 <= i <= 4 else '{:.2f}'.format(100 * value)
+                        for i, value in enumerate(row)] for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the registry of evaluation results.')
+    parser.add_argument("--registry", type=str, required=True,
+                        help="Registry file (the --registry of run_ner.py).")
+    subparsers = parser.add_subparsers(dest='command')
+
+    table_parser = subparsers.add_parser('table', help='Best result of every model on a split.')
+    table_parser.add_argument("--split", type=str, required=True)
+    table_parser.add_argument("--model_id", type=str,
+                              help="A model_id, or a prefix followed by '*' (e.g. the models of a sweep).")
+    table_parser.add_argument("--metric", type=str, default='f1_token', choices=METRICS)
+    table_parser.add_argument("--train_args", type=str, nargs='*', default=[],
+                              help="Train args to add as columns (e.g. learning_rate train_portion).")
+
+    best_parser = subparsers.add_parser('best', help='Best epoch of a model on a split.')
+    best_parser.add_argument("--model_id", type=str, required=True)
+    best_parser.add_argument("--split", type=str, required=True)
+    best_parser.add_argument("--metric", type=str, default='f1_token', choices=METRICS)
+
+    import_parser = subparsers.add_parser('import', help='Add existing eval_results_*.json files.')
+    import_parser.add_argument("--base_dir", type=str, required=True)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('choose a command: table, best or import')
+
+    registry = ExperimentRegistry(args.registry)
+    if args.command == 'table':
+        rows = registry.results_table(args.split, model_id=args.model_id, metric=args.metric,
+                                      train_args=args.train_args)
+        _print_table(['model_id', 'epoch', 'P', 'R', 'F1'] + args.train_args, rows)
+    elif args.command == 'best':
+        record = registry.best(args.model_id, args.split, metric=args.metric)
+        if record is None:
+            print('No results for {} on {}'.format(args.model_id, args.split))
+        else:
+            print(json.dumps({name: record[name] for name in _COLUMNS if name != 'train_args'}, indent=2))
+    else:
+        print('Added {} records'.format(registry.import_eval_files(args.base_dir)))
+    registry.close()
+
+
+if __name__ == '__main__':
+    main()
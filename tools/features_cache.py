@@ -0,0 +1,68 @@
+"""
+On-disk cache of tokenized training features (run_ner.py --features_cache), so
+that runs over the same split (e.g. the configurations of a sweep, see run_sweep.py)
+tokenize it only once.
+
+Every cache entry is a directory named after a hash of everything that determines the
+features: the data files (path, size and modification time), the processor and
+featurization settings and the tokenizer vocabulary. It holds one .npy file per
+feature array and the example id of every feature. The arrays are memory-mapped
+copy-on-write, so concurrent runs share the pages of the page cache instead of each
+holding its own copy.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+FEATURE_ARRAYS = ['input_ids', 'input_mask', 'segment_ids', 'label_id', 'valid_ids', 'label_mask']
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+
+def features_cache_key(data_files, settings, vocab):
+    """Hash of the data files, a json-serializable dict of settings and the tokenizer vocabulary."""
+    h = hashlib.sha1()
+    h.update(json.dumps({'data_files': [_file_signature(path) for path in data_files],
+                         'settings': settings}, sort_keys=True).encode('utf-8'))
+    h.update('\n'.join(vocab).encode('utf-8'))
+    return h.hexdigest()
+
+
+def save_features(cache_dir, features):
+    """Writes the feature arrays and example ids of features to cache_dir.
+
+    The directory is written under a temporary name and renamed, so concurrent runs
+    that build the same entry never see a partial one.
+    """
+    tmp_dir = '{}.tmp-{}'.format(cache_dir, uuid.uuid4().hex)
+    os.makedirs(tmp_dir)
+    for name in FEATURE_ARRAYS:
+        np.save(os.path.join(tmp_dir, name + '.npy'),
+                np.asarray([getattr(f, name) for f in features], dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'ids.npy'), np.asarray([f._id for f in features], dtype=str))
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # built by another run in the meantime
+        shutil.rmtree(tmp_dir)
+
+
+def load_features(cache_dir):
+    """Returns ({array name: memory-mapped int64 array}, example ids) or None if not cached."""
+    if not os.path.isdir(cache_dir):
+        return None
+    arrays = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='c') for name in FEATURE_ARRAYS}
+    ids = np.load(os.path.join(cache_dir, 'ids.npy'))
+    return arrays, ids
@@ -0,0 +1,114 @@
+"""
+History budgets: bound the input length (and so the latency) of long conversations
+by keeping only part of the history before the current turn.
+
+Budgets are given as strings:
+
+    last_turns:K            the last K turns of the history
+    first_and_last_turns:K  the first turn and the last K turns
+    tokens:N                the last N history words
+
+The data only stores the concatenated history, so turn boundaries are recovered
+from the raw query file of the split when its previous turns add up to the history
+(``read_turn_lengths``). Otherwise, a turn is assumed to end at every delimiter
+word (``?`` by default); histories without delimiters count as a single turn.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import defaultdict
+
+POLICIES = ['last_turns', 'first_and_last_turns', 'tokens']
+
+SEP = '[SEP]'
+
+
+def parse_history_budget(spec):
+    """Parses 'policy:K' into (policy, K)."""
+    try:
+        policy, k = spec.split(':')
+        k = int(k)
+    except ValueError:
+        raise ValueError('Invalid history budget "{}": expected policy:K'.format(spec))
+    if policy not in POLICIES:
+        raise ValueError('Unknown history budget policy "{}" (choose from {})'.format(policy, ', '.join(POLICIES)))
+    if k < 0:
+        raise ValueError('Invalid history budget "{}": K must be >= 0'.format(spec))
+    return policy, k
+
+
+def read_turn_lengths(raw_query_file):
+    """Returns {qid: [number of words of every previous turn of the conversation]}.
+
+    Turns are taken in file order within each conversation (topic#turn for QuAC,
+    topic_turn for CAsT).
+    """
+    qid2turn_lengths = dict()
+    topic2lengths = defaultdict(list)
+    with open(raw_query_file) as fin:
+        for line in fin:
+            qid, question = line.rstrip('\n').split('\t')[:2]
+            separator = '#' if '#' in qid else '_'
+            lengths = topic2lengths[qid[:qid.index(separator)]]
+            qid2turn_lengths[qid] = list(lengths)
+            lengths.append(len(question.split()))
+    return qid2turn_lengths
+
+
+def split_turns(num_history, history=None, turn_lengths=None, delimiters=('?',)):
+    """Splits history word positions into turns: returns [(start, end)].
+
+    Uses turn_lengths if they add up to num_history, else the delimiter words of history.
+    """
+    if turn_lengths is not None and sum(turn_lengths) == num_history:
+        turns = []
+        start = 0
+        for length in turn_lengths:
+            if length:
+                turns.append((start, start + length))
+            start += length
+        return turns
+
+    turns = []
+    start = 0
+    for i in range(num_history):
+        if history is not None and history[i] in delimiters:
+            turns.append((start, i + 1))
+            start = i + 1
+    if start < num_history:
+        turns.append((start, num_history))
+    return turns
+
+
+def select_history(tokens, budget, turn_lengths=None, delimiters=('?',)):
+    """Positions of the words of tokens (history, [SEP], current turn) kept by the budget.
+
+    Args:
+        tokens: words of the example.
+        budget: (policy, K) as given by ``parse_history_budget``, or None to keep everything.
+        turn_lengths: optional number of words of every history turn.
+        delimiters: words that end a turn, if turn_lengths are not available.
+    """
+    if budget is None or SEP not in tokens:
+        return list(range(len(tokens)))
+    num_history = tokens.index(SEP)
+    policy, k = budget
+
+    if policy == 'tokens':
+        kept = list(range(max(num_history - k, 0), num_history))
+    else:
+        turns = split_turns(num_history, tokens, turn_lengths, delimiters)
+        selected = turns[max(len(turns) - k, 0):] if k else []
+        if policy == 'first_and_last_turns' and turns and turns[0] not in selected:
+            selected = [turns[0]] + selected
+        kept = [i for start, end in selected for i in range(start, end)]
+
+    return kept + list(range(num_history, len(tokens)))
+
+
+def apply_history_budget(tokens, labels, budget, turn_lengths=None, delimiters=('?',)):
+    """Returns (tokens, labels, kept positions) of an example after applying the budget."""
+    kept = select_history(tokens, budget, turn_lengths=turn_lengths, delimiters=delimiters)
+    return [tokens[i] for i in kept], [labels[i] for i in kept], kept
@@ -0,0 +1,368 @@
+"""
+Compressed inverted index with BM25 and RM3 retrieval over a local passage collection.
+
+Index layout (one directory):
+    meta.json           number of documents, average document length, analyzer settings
+    terms.txt           one term per line; the line number is the term id
+    df.npy              document frequency of every term
+    offsets.npy         byte offset of the postings of every term in postings.bin (num_terms + 1)
+    postings.bin        per term, varint-encoded (docid delta, tf) pairs in docid order
+    forward_offsets.npy byte offset of every document vector in forward.bin (num_docs + 1)
+    forward.bin         per document, varint-encoded (term id delta, tf) pairs in term id order
+    doclens.npy         number of indexed tokens of every document
+    docids.txt          external document ids; docid_offsets.npy holds their byte offsets
+
+All arrays and binary files are memory-mapped when the index is opened, and
+postings are decoded with vectorized numpy operations.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Lucene's default English stop words
+STOPWORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is',
+                       'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there',
+                       'these', 'they', 'this', 'to', 'was', 'will', 'with'])
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def analyze(text, stopwords=STOPWORDS):
+    """Lowercases and splits text into word tokens, dropping stop words."""
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in stopwords]
+
+
+def varint_encode(values):
+    """Encodes non-negative integers as LEB128 varints.
+
+    Returns:
+        (bytes as a uint8 array, number of bytes of every value)
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values >= np.uint64(1 << (7 * k))
+
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max()) if len(values) else 0):
+        mask = nbytes > k
+        byte = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (nbytes[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[mask] + k] = (byte | more).astype(np.uint8)
+    return out, nbytes
+
+
+def varint_decode(buf):
+    """Decodes a uint8 array of LEB128 varints into an int64 array."""
+    buf = np.asarray(buf, dtype=np.uint8)
+    if len(buf) == 0:
+        return np.zeros(0, dtype=np.int64)
+    is_last = buf < 0x80
+    ends = np.flatnonzero(is_last)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    value_index = np.cumsum(is_last) - is_last
+    shifts = (np.arange(len(buf)) - starts[value_index]) * 7
+    return np.add.reduceat((buf & 0x7f).astype(np.int64) << shifts, starts)
+
+
+def _interleave(a, b):
+    out = np.empty(2 * len(a), dtype=np.int64)
+    out[0::2] = a
+    out[1::2] = b
+    return out
+
+
+def iter_collection(collection_file):
+    """Yields (docid, text) from a tsv (docid<TAB>text) or jsonl ({"id", "contents"}) collection."""
+    with open(collection_file) as fin:
+        for line in fin:
+            if collection_file.endswith('.jsonl'):
+                doc = json.loads(line)
+                yield str(doc['id']), doc['contents']
+            else:
+                line = line.rstrip('\n')
+                if line:
+                    docid, text = line.split('\t', 1)
+                    yield docid, text
+
+
+class _IndexBuilder(object):
+    """Encodes the postings of one block of documents at a time into temporary runs."""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.term2id = dict()
+        self.last_doc = np.full(1024, -1, dtype=np.int64)  # last doc index seen per term id
+        self.df = np.zeros(1024, dtype=np.int64)
+        self.num_docs = 0
+        self.doclens = []
+        self.forward_lengths = []
+        self.runs_path = os.path.join(index_dir, 'postings.runs.tmp')
+        self.runs = []  # (term ids, offsets in the runs file, byte lengths) per block
+        self.runs_size = 0
+        self.f_runs = open(self.runs_path, 'wb')
+        self.f_forward = open(os.path.join(index_dir, 'forward.bin'), 'wb')
+        self.f_docids = open(os.path.join(index_dir, 'docids.txt'), 'w')
+        self._reset_block()
+
+    def _reset_block(self):
+        self.block_tids, self.block_docs, self.block_tfs = [], [], []
+        self.block_first_doc = self.num_docs
+
+    def add(self, docid, text):
+        self.f_docids.write(docid + '\n')
+        tokens = analyze(text)
+        self.doclens.append(len(tokens))
+        tfs = Counter()
+        for t in tokens:
+            tid = self.term2id.get(t)
+            if tid is None:
+                tid = self.term2id[t] = len(self.term2id)
+            tfs[tid] += 1
+        for tid in sorted(tfs):
+            self.block_tids.append(tid)
+            self.block_docs.append(self.num_docs)
+            self.block_tfs.append(tfs[tid])
+        self.num_docs += 1
+
+    def flush(self):
+        first_doc, num_block_docs = self.block_first_doc, self.num_docs - self.block_first_doc
+        if num_block_docs == 0:
+            return
+        tids, docs, tfs = [np.asarray(x, dtype=np.int64) for x in (self.block_tids, self.block_docs,
+                                                                     self.block_tfs)]
+        self._reset_block()
+
+        if len(self.term2id) > len(self.last_doc):
+            size = max(len(self.term2id), 2 * len(self.last_doc))
+            self.last_doc = np.concatenate([self.last_doc, np.full(size - len(self.last_doc), -1, dtype=np.int64)])
+            self.df = np.concatenate([self.df, np.zeros(size - len(self.df), dtype=np.int64)])
+
+        # forward index: entries are grouped by document, with sorted term ids
+        is_doc_start = np.ones(len(docs), dtype=bool)
+        is_doc_start[1:] = docs[1:] != docs[:-1]
+        tid_deltas = np.where(is_doc_start, tids, tids - np.roll(tids, 1))
+        encoded, nbytes = varint_encode(_interleave(tid_deltas, tfs))
+        self.f_forward.write(encoded.tobytes())
+        self.forward_lengths.append(np.bincount(docs - first_doc, weights=nbytes[0::2] + nbytes[1::2],
+                                                minlength=num_block_docs).astype(np.int64))
+        if len(docs) == 0:
+            return
+
+        # inverted index: sort by (term, doc); the first docid of a term is relative to the previous block
+        order = np.lexsort((docs, tids))
+        tids, docs, tfs = tids[order], docs[order], tfs[order]
+        is_term_start = np.ones(len(tids), dtype=bool)
+        is_term_start[1:] = tids[1:] != tids[:-1]
+        doc_deltas = np.where(is_term_start, docs - self.last_doc[tids], docs - np.roll(docs, 1))
+        encoded, nbytes = varint_encode(_interleave(doc_deltas, tfs))
+        self.f_runs.write(encoded.tobytes())
+
+        unique_tids = tids[is_term_start]
+        term_index = np.cumsum(is_term_start) - 1
+        lengths = np.bincount(term_index, weights=nbytes[0::2] + nbytes[1::2]).astype(np.int64)
+        self.runs.append((unique_tids, self.runs_size + np.cumsum(lengths) - lengths, lengths))
+        self.runs_size += int(lengths.sum())
+        self.df[unique_tids] += np.bincount(term_index)
+
+        is_term_end = np.ones(len(tids), dtype=bool)
+        is_term_end[:-1] = is_term_start[1:]
+        self.last_doc[tids[is_term_end]] = docs[is_term_end]
+
+    def close(self):
+        self.flush()
+        for f in [self.f_runs, self.f_forward, self.f_docids]:
+            f.close()
+
+        # merge the runs of all blocks into one postings list per term (the stable sort keeps docid order)
+        num_terms = len(self.term2id)
+        tids, src_offsets, lengths = [np.concatenate([run[k] for run in self.runs]) if self.runs
+                                      else np.zeros(0, dtype=np.int64) for k in range(3)]
+        order = np.argsort(tids, kind='mergesort')
+        _gather_ranges(self.runs_path, os.path.join(self.index_dir, 'postings.bin'),
+                       src_offsets[order], lengths[order])
+        os.remove(self.runs_path)
+
+        offsets = np.zeros(num_terms + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(tids, weights=lengths, minlength=num_terms)).astype(np.int64)
+        forward_offsets = np.zeros(self.num_docs + 1, dtype=np.int64)
+        if self.forward_lengths:
+            forward_offsets[1:] = np.cumsum(np.concatenate(self.forward_lengths))
+
+        with open(os.path.join(self.index_dir, 'terms.txt'), 'w') as fw:
+            for t in sorted(self.term2id, key=self.term2id.get):
+                fw.write(t + '\n')
+        np.save(os.path.join(self.index_dir, 'df.npy'), self.df[:num_terms])
+        np.save(os.path.join(self.index_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(self.index_dir, 'forward_offsets.npy'), forward_offsets)
+        np.save(os.path.join(self.index_dir, 'doclens.npy'), np.asarray(self.doclens, dtype=np.int32))
+
+        docid_offsets = [0]
+        with open(os.path.join(self.index_dir, 'docids.txt'), 'rb') as fin:
+            for line in fin:
+                docid_offsets.append(docid_offsets[-1] + len(line))
+        np.save(os.path.join(self.index_dir, 'docid_offsets.npy'), np.asarray(docid_offsets, dtype=np.int64))
+
+        meta = {'num_docs': self.num_docs,
+                'num_terms': num_terms,
+                'avg_doclen': float(np.mean(self.doclens)) if self.doclens else 0.,
+                'analyzer': 'lowercase, \\w+ tokens, lucene english stop words, no stemming'}
+        json.dump(meta, open(os.path.join(self.index_dir, 'meta.json'), 'w'))
+        return meta
+
+
+def build_index(collection_file, index_dir, block_size=100000):
+    """Builds the index of a collection, encoding postings one block of documents at a time.
+
+    Peak memory is bounded by one block of documents plus the term dictionary.
+    """
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    s_time = time.time()
+
+    builder = _IndexBuilder(index_dir)
+    for docid, text in iter_collection(collection_file):
+        builder.add(docid, text)
+        if builder.num_docs % block_size == 0:
+            builder.flush()
+            logger.info('Indexed {} documents'.format(builder.num_docs))
+    meta = builder.close()
+
+    logger.info('Indexed {} documents and {} terms in {:.1f} minutes'.format(meta['num_docs'], meta['num_terms'],
+                                                                            (time.time() - s_time) / 60))
+    return meta
+
+
+def _gather_ranges(src_path, dst_path, src_offsets, lengths, max_chunk_bytes=1 << 26):
+    """Writes the byte ranges (src_offsets, lengths) of src_path one after the other into dst_path."""
+    total = int(lengths.sum())
+    with open(dst_path, 'wb') as fw:
+        if total == 0:
+            return
+        src = np.memmap(src_path, dtype=np.uint8, mode='r')
+        ends = np.cumsum(lengths)
+        row = 0
+        while row < len(lengths):
+            start_bytes = ends[row] - lengths[row]
+            last = max(row + 1, int(np.searchsorted(ends, start_bytes + max_chunk_bytes, side='right')))
+            rows = slice(row, last)
+            chunk_lengths = lengths[rows]
+            within = np.arange(int(chunk_lengths.sum())) - np.repeat(np.cumsum(chunk_lengths) - chunk_lengths,
+                                                                     chunk_lengths)
+            fw.write(src[np.repeat(src_offsets[rows], chunk_lengths) + within].tobytes())
+            row = last
+        del src
+
+
+class InvertedIndex(object):
+    """Memory-mapped index built by ``build_index``, with BM25 and RM3 retrieval."""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.meta = json.load(open(os.path.join(index_dir, 'meta.json')))
+        self.num_docs = self.meta['num_docs']
+        self.avg_doclen = self.meta['avg_doclen']
+
+        with open(os.path.join(index_dir, 'terms.txt')) as fin:
+            self.term2id = {line.rstrip('\n'): i for i, line in enumerate(fin)}
+
+        def load(name):
+            return np.load(os.path.join(index_dir, name), mmap_mode='r')
+
+        def load_bin(name):
+            path = os.path.join(index_dir, name)
+            return np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) else np.zeros(0, np.uint8)
+
+        self.df = load('df.npy')
+        self.offsets = load('offsets.npy')
+        self.postings_bin = load_bin('postings.bin')
+        self.forward_offsets = load('forward_offsets.npy')
+        self.forward_bin = load_bin('forward.bin')
+        self.doclens = load('doclens.npy')
+        self.docid_offsets = load('docid_offsets.npy')
+        self.docids_bin = load_bin('docids.txt')
+
+    def postings(self, tid):
+        """Returns (doc indices, term frequencies) of a term id."""
+        values = varint_decode(self.postings_bin[self.offsets[tid]:self.offsets[tid + 1]])
+        return np.cumsum(values[0::2]) - 1, values[1::2]
+
+    def doc_vector(self, doc):
+        """Returns (term ids, term frequencies) of a document index."""
+        values = varint_decode(self.forward_bin[self.forward_offsets[doc]:self.forward_offsets[doc + 1]])
+        return np.cumsum(values[0::2]), values[1::2]
+
+    def docid(self, doc):
+        return self.docids_bin[self.docid_offsets[doc]:self.docid_offsets[doc + 1] - 1].tobytes().decode('utf-8')
+
+    def bm25(self, weighted_tids, k1=0.9, b=0.4, hits=1000):
+        """Scores the documents matching (term id, weight) pairs with BM25.
+
+        Returns:
+            (doc indices, scores) of the top hits, by decreasing score.
+        """
+        matches = [(w, self.postings(tid), self.df[tid]) for tid, w in weighted_tids]
+        if not matches:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        candidates = np.unique(np.concatenate([docs for _, (docs, _), _ in matches]))
+        scores = np.zeros(len(candidates), dtype=np.float64)
+        for w, (docs, tfs), df in matches:
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+            norm = k1 * (1 - b + b * self.doclens[docs] / self.avg_doclen)
+            scores[np.searchsorted(candidates, docs)] += w * idf * tfs * (k1 + 1) / (tfs + norm)
+
+        # sort by decreasing score, ties by doc index
+        top = np.lexsort((candidates, -scores))[:hits]
+        return candidates[top], scores[top]
+
+    def query_tids(self, query):
+        """Returns the (term id, weight) pairs of a query; repeated terms get a higher weight."""
+        counts = Counter(self.term2id[t] for t in analyze(query) if t in self.term2id)
+        return sorted(counts.items())
+
+    def rm3(self, weighted_tids, docs, scores, fb_terms=10, original_query_weight=0.5):
+        """Expands a query with the RM3 relevance model estimated from feedback documents."""
+        relevance_model = Counter()
+        for doc, score in zip(docs, scores):
+            tids, tfs = self.doc_vector(doc)
+            if len(tids) == 0:
+                continue
+            for tid, weight in zip(tids.tolist(), (score * tfs / tfs.sum()).tolist()):
+                relevance_model[tid] += weight
+
+        expansion = relevance_model.most_common(fb_terms)
+        expansion_norm = sum(w for _, w in expansion) or 1.
+        query_norm = sum(w for _, w in weighted_tids) or 1.
+
+        expanded = Counter()
+        for tid, w in weighted_tids:
+            expanded[tid] += original_query_weight * w / query_norm
+        for tid, w in expansion:
+            expanded[tid] += (1 - original_query_weight) * w / expansion_norm
+        return sorted(expanded.items())
+
+    def search(self, query, hits=1000, k1=0.9, b=0.4, rm3=False, fb_docs=10, fb_terms=10,
+               original_query_weight=0.5):
+        """Retrieves (docid, score) pairs for a query string."""
+        weighted_tids = self.query_tids(query)
+        docs, scores = self.bm25(weighted_tids, k1=k1, b=b, hits=hits)
+        if rm3 and len(docs):
+            weighted_tids = self.rm3(weighted_tids, docs[:fb_docs], scores[:fb_docs], fb_terms=fb_terms,
+                                     original_query_weight=original_query_weight)
+            docs, scores = self.bm25(weighted_tids, k1=k1, b=b, hits=hits)
+        return [(self.docid(doc), float(score)) for doc, score in zip(docs, scores)]
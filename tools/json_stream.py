@@ -0,0 +1,112 @@
+"""
+Incremental readers for the large json files used in this repo.
+
+``iter_json_array`` yields the elements of a json array one at a time, either
+of a top-level array (data files) or of the array stored under a top-level key
+(e.g. ``ids`` in eval_results_*.json), while keeping only one read chunk and
+one element in memory. ``iter_jsonl`` does the same for json lines files.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import re
+
+CHUNK_SIZE = 1 << 20
+
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_jsonl(path):
+    """Yields the json object of every non-empty line of a json lines file."""
+    with open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_json_array(path, key=None, chunk_size=CHUNK_SIZE):
+    """Yields the elements of a json array without loading the whole file.
+
+    Args:
+        path: json file.
+        key: if None, the file must contain a top-level array. Otherwise, the
+            array stored under this key of the top-level object is read (the
+            key must not be used by nested objects).
+        chunk_size: number of characters read at a time.
+
+    Raises:
+        KeyError: if the key is not found.
+        ValueError: if the file is not valid json.
+    """
+    decoder = json.JSONDecoder()
+    if key is None:
+        start = re.compile(r'\s*\[')
+    else:
+        start = re.compile(re.escape(json.dumps(key)) + r'\s*:\s*\[')
+
+    with open(path) as fin:
+        buf = ''
+        eof = False
+
+        # locate the opening bracket of the array
+        while True:
+            match = start.match(buf) if key is None else start.search(buf)
+            if match and (match.end() < len(buf) or eof):
+                pos = match.end()
+                break
+            if eof:
+                if key is None:
+                    raise ValueError('{} does not contain a json array'.format(path))
+                raise KeyError(key)
+            chunk = fin.read(chunk_size)
+            eof = not chunk
+            if key is not None and not match:
+                # keep enough of the tail for a key split across chunks
+                buf = buf[-(len(key) + 64):]
+            buf += chunk
+
+        expect_value = True
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+
+            if pos == len(buf):
+                if eof:
+                    raise ValueError('Unexpected end of file in {}'.format(path))
+                chunk = fin.read(chunk_size)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+
+            if buf[pos] == ']':
+                return
+            if not expect_value:
+                if buf[pos] != ',':
+                    raise ValueError('Expected "," at position {} of the array in {}'.format(pos, path))
+                pos += 1
+                expect_value = True
+                continue
+
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                value, end = None, None
+
+            # numbers (and literals) may continue in the next chunk
+            if end is None or (end == len(buf) and not eof):
+                if eof:
+                    raise ValueError('Invalid json value in {}'.format(path))
+                chunk = fin.read(chunk_size)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+
+            yield value
+            pos = end
+            expect_value = False
@@ -0,0 +1,173 @@
+"""
+Memory accounting of run_ner.py per pipeline stage (--memory_report, --memory_budget_mb).
+
+At every stage boundary (data load, model load, optimizer creation, feature
+conversion, tensorization, first training step, evaluation) the tracker records
+the current and peak RSS of the process, optionally the peak of Python allocations
+(tracemalloc, which slows Python code down) and, on GPU, the peak of the torch
+allocator. At the end, the per-stage breakdown is logged and written as json.
+
+With a budget, a stage that leaves the RSS above it fails with a MemoryError. Some
+large allocations can be predicted before they are made, such as the feature tensors
+and the gradients plus AdamW state of the first step. Those fail before the memory is
+allocated, instead of after minutes of work or an OOM kill.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+import resource
+import sys
+import tracemalloc
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+MB = 1 << 20
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (since the last reset_peak_rss)."""
+    try:
+        with open('/proc/self/status') as fin:
+            for line in fin:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def reset_peak_rss():
+    """Resets the peak RSS to the current RSS (Linux >= 4.0); returns whether it could."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def available_memory():
+    """Bytes of host memory that can still be allocated: MemAvailable, or less under a cgroup limit."""
+    available = None
+    try:
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    for limit_file, usage_file in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            limit = open(limit_file).read().strip()
+            if limit != 'max':
+                free = int(limit) - int(open(usage_file).read())
+                available = free if available is None else min(available, free)
+            break
+        except (IOError, OSError, ValueError):
+            continue
+    if available is None:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    return available
+
+
+def tensors_nbytes(num_tensors, num_rows, row_length, itemsize=8):
+    """Bytes of num_tensors [num_rows, row_length] tensors (int64 by default)."""
+    return num_tensors * num_rows * row_length * itemsize
+
+
+def training_state_nbytes(model):
+    """Bytes allocated by the first optimizer step: gradients and the two AdamW moments."""
+    return 3 * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+
+
+class MemoryTracker(object):
+
+    def __init__(self, enabled=False, budget_mb=None, trace_python=False, device=None, telemetry=None):
+        self.enabled = enabled or budget_mb is not None
+        self.budget = int(budget_mb * MB) if budget_mb is not None else None
+        self.trace_python = trace_python and self.enabled
+        self.cuda = device is not None and device.type == 'cuda'
+        self.telemetry = telemetry
+        self.stages = []
+        self._previous_rss = None
+        if self.trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.enabled:
+            self._previous_rss = current_rss()
+
+    def checkpoint(self, stage):
+        """Records the memory at the end of stage and enforces the budget."""
+        if not self.enabled:
+            return
+        rss = current_rss()
+        record = {'stage': stage, 'rss_mb': rss / MB, 'delta_mb': (rss - self._previous_rss) / MB,
+                  'peak_rss_mb': peak_rss() / MB}
+        if self.trace_python:
+            _, python_peak = tracemalloc.get_traced_memory()
+            record['python_peak_mb'] = python_peak / MB
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        if self.cuda:
+            record['cuda_peak_mb'] = torch.cuda.max_memory_allocated() / MB
+            torch.cuda.reset_max_memory_allocated()
+        self._previous_rss = rss
+        self.stages.append(record)
+        logger.info('[Memory] {}: rss={:.1f} MB ({:+.1f}), peak rss={:.1f} MB{}{}'.format(
+            stage, record['rss_mb'], record['delta_mb'], record['peak_rss_mb'],
+            ', python peak={:.1f} MB'.format(record['python_peak_mb']) if 'python_peak_mb' in record else '',
+            ', cuda peak={:.1f} MB'.format(record['cuda_peak_mb']) if 'cuda_peak_mb' in record else ''))
+        if self.telemetry is not None:
+            self.telemetry.record('memory', **record)
+
+        if self.budget is not None and rss > self.budget:
+            raise MemoryError('RSS after {} is {:.1f} MB, above the budget of {:.1f} MB.\n{}'.format(
+                stage, rss / MB, self.budget / MB, self.breakdown()))
+
+    def check(self, stage, nbytes):
+        """Fails before stage if allocating nbytes more would exceed the budget."""
+        if self.budget is None:
+            return
+        rss = current_rss()
+        if rss + nbytes > self.budget:
+            raise MemoryError('{} needs about {:.1f} MB on top of the current {:.1f} MB, above the budget of '
+                              '{:.1f} MB.\n{}'.format(stage, nbytes / MB, rss / MB, self.budget / MB,
+                                                      self.breakdown()))
+
+    def breakdown(self):
+        """Per-stage table of the recorded stages."""
+        columns = ['rss_mb', 'delta_mb', 'peak_rss_mb'] + \
+            [c for c in ['python_peak_mb', 'cuda_peak_mb'] if self.stages and c in self.stages[0]]
+        lines = ['{:<24s}'.format('stage') + ''.join('{:>16s}'.format(c) for c in columns)]
+        for record in self.stages:
+            lines.append('{:<24s}'.format(record['stage']) +
+                         ''.join('{:>16.1f}'.format(record[c]) for c in columns))
+        return '\n'.join(lines)
+
+    def report(self, path=None):
+        """Logs the per-stage breakdown and writes the stages to the json file path."""
+        if not self.enabled or not self.stages:
+            return
+        logger.info('[Memory] per-stage breakdown:\n' + self.breakdown())
+        if path:
+            json.dump({'budget_mb': self.budget / MB if self.budget is not None else None, 'stages': self.stages},
+                      open(path, 'w'), indent=2)
@@ -0,0 +1,202 @@
+"""
+Memory-mapped model weights: a flat file that processes map instead of reading.
+
+`Ner.from_pretrained` reads pytorch_model.bin into private memory, so N inference
+processes on a host hold N copies of the weights. The export writes the state dict
+to <model_dir>/weights.mmap. The file has an 8-byte magic, the 8-byte length of a
+json header (names, dtypes, shapes and offsets of the tensors), then the tensor data,
+each tensor aligned to 64 bytes. The loader maps the file copy-on-write and builds the
+model with tensors that point into the mapping. Loading only faults in the pages that
+are used, and all processes that map the file share one physical copy in the page
+cache.
+
+With fp16, the weights are stored in half precision (half the size on disk and to
+read) and converted back to the model dtype when loaded, so they are no longer shared.
+
+    python -m tools.mmap_weights --model_dir ./models/$MODEL_ID [--fp16]
+
+The header records the size and modification time of pytorch_model.bin, so weights of
+an older checkpoint are not used (run the export again after copying a model
+directory).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import contextlib
+import inspect
+import json
+import logging
+import mmap
+import os
+import struct
+
+import torch
+from pytorch_transformers import WEIGHTS_NAME
+
+logger = logging.getLogger(__name__)
+
+MMAP_WEIGHTS_NAME = 'weights.mmap'
+MAGIC = b'QRTCMMAP'
+ALIGNMENT = 64
+
+_DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16,
+           'int64': torch.int64, 'int32': torch.int32, 'uint8': torch.uint8, 'bool': torch.bool}
+
+
+def _dtype_name(dtype):
+    return str(dtype).replace('torch.', '')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _source_stamp(model_dir):
+    path = os.path.join(model_dir, WEIGHTS_NAME)
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def export_mmap_weights(state_dict, path, fp16=False, source=None):
+    """Writes state_dict to path (floating point tensors in fp16 with fp16)."""
+    tensors = []
+    entries = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        stored = tensor.half() if fp16 and tensor.is_floating_point() else tensor
+        offset = _align(offset)
+        nbytes = stored.numel() * stored.element_size()
+        entries.append({'name': name, 'dtype': _dtype_name(tensor.dtype), 'stored_dtype': _dtype_name(stored.dtype),
+                        'shape': list(tensor.shape), 'offset': offset, 'nbytes': nbytes})
+        tensors.append(stored)
+        offset += nbytes
+    header = json.dumps({'version': 1, 'source': source, 'tensors': entries}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fout:
+        fout.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for entry, tensor in zip(entries, tensors):
+            fout.seek(data_start + entry['offset'])
+            # through uint8, since numpy has no bfloat16
+            fout.write(tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() else b'')
+        fout.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_header(path):
+    with open(path, 'rb') as fin:
+        if fin.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a memory-mapped weights file'.format(path))
+        header_length, = struct.unpack('<Q', fin.read(8))
+        header = json.loads(fin.read(header_length).decode('utf-8'))
+    header['data_start'] = _align(len(MAGIC) + 8 + header_length)
+    return header
+
+
+def load_mmap_state_dict(path):
+    """The state dict of path, with tensors that point into a copy-on-write mapping of the file."""
+    header = read_header(path)
+    with open(path, 'rb') as fin:
+        # the mapping stays open as long as tensors refer to it
+        mapping = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_COPY)
+    state_dict = dict()
+    for entry in header['tensors']:
+        dtype, stored_dtype = _DTYPES[entry['dtype']], _DTYPES[entry['stored_dtype']]
+        if entry['nbytes']:
+            tensor = torch.frombuffer(mapping, dtype=stored_dtype, count=entry['nbytes'] // stored_dtype.itemsize,
+                                      offset=header['data_start'] + entry['offset']).view(entry['shape'])
+        else:
+            tensor = torch.empty(entry['shape'], dtype=stored_dtype)
+        state_dict[entry['name']] = tensor.to(dtype) if dtype != stored_dtype else tensor
+    return state_dict
+
+
+def has_mmap_weights(model_dir):
+    """Whether model_dir has memory-mapped weights of its current pytorch_model.bin."""
+    path = os.path.join(model_dir, MMAP_WEIGHTS_NAME)
+    if not os.path.exists(path):
+        return False
+    source = read_header(path)['source']
+    if source is not None and source != _source_stamp(model_dir):
+        logger.warning('{} was exported from another {}; export it again to use it'.format(path, WEIGHTS_NAME))
+        return False
+    return True
+
+
+# the initializers of reset_parameters (of nn.Linear, nn.Embedding, nn.LayerNorm, ...)
+_INIT_FUNCTIONS = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'xavier_uniform_',
+                   'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_']
+
+
+@contextlib.contextmanager
+def _no_weight_initialization(model_class):
+    # skips the random initialization of weights that are assigned anyway: the torch.nn.init
+    # functions and the _init_weights of the pretrained model base class, which also initializes
+    # submodules like BertModel (init_weights still prunes heads). On the meta device, the first
+    # normal_ would also import torch._dynamo (seconds per process).
+    init_functions = {name: getattr(torch.nn.init, name) for name in _INIT_FUNCTIONS if hasattr(torch.nn.init, name)}
+    base_class = next(c for c in model_class.__mro__ if '_init_weights' in vars(c))
+    init_weights = vars(base_class)['_init_weights']
+    for name in init_functions:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    base_class._init_weights = lambda self, module: None
+    try:
+        yield
+    finally:
+        for name, function in init_functions.items():
+            setattr(torch.nn.init, name, function)
+        base_class._init_weights = init_weights
+
+
+def load_mmap_model(model_class, model_dir, path=None):
+    """model_class (a pytorch_transformers model) with the config of model_dir and the memory-mapped weights of
+    path (default: <model_dir>/weights.mmap)."""
+    config = model_class.config_class.from_pretrained(model_dir)
+    state_dict = load_mmap_state_dict(path or os.path.join(model_dir, MMAP_WEIGHTS_NAME))
+    if 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters:
+        # no memory for (and no random initialization of) weights that are replaced anyway
+        with torch.device('meta'), _no_weight_initialization(model_class):
+            model = model_class(config)
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        with _no_weight_initialization(model_class):
+            model = model_class(config)
+        missing = set(model.state_dict()) ^ set(state_dict)
+        if missing:
+            raise KeyError('Mismatching weights in {}: {}'.format(model_dir, sorted(missing)))
+        for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+            tensor.data = state_dict[name]
+    model.eval()
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports the weights of a trained model for memory mapping.')
+
+    parser.add_argument("--model_dir", type=str, required=True,
+                        help="Directory of a trained model (base_dir/model_id).")
+    parser.add_argument("--output_file", type=str, default=None,
+                        help="Default: <model_dir>/" + MMAP_WEIGHTS_NAME + ", which run_ner.py loads.")
+    parser.add_argument("--fp16", action='store_true',
+                        help="Store the weights in fp16 (they are converted back when loaded, so not shared).")
+
+    args = parser.parse_args()
+
+    from run_ner import _model_class
+
+    model = _model_class(args.model_dir).from_pretrained(args.model_dir)
+    path = export_mmap_weights(model.state_dict(), args.output_file or os.path.join(args.model_dir, MMAP_WEIGHTS_NAME),
+                               fp16=args.fp16, source=_source_stamp(args.model_dir))
+    print('Wrote {} ({:.1f} MB)'.format(path, os.path.getsize(path) / (1 << 20)))
+
+
+if __name__ == '__main__':
+    main()
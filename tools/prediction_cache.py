@@ -0,0 +1,169 @@
+"""
+Persistent cache of per-token predictions, so that re-evaluating a trained model on
+the same inputs does not run BERT again.
+
+Entries live in a SQLite file and are keyed by a fingerprint of the model checkpoint
+plus a hash of the example's input features (token ids, masks, valid ids, label mask)
+and max_seq_length. Each entry stores the argmax label ids and the REL probabilities of
+every position. The least recently used entries are evicted when the cache grows
+beyond its size limit.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of variables per statement
+_MAX_VARIABLES = 500
+
+
+def model_fingerprint(model_dir, filenames=('config.json', 'pytorch_model.bin')):
+    """sha1 of the checkpoint files of a model directory.
+
+    The hash is stored in <model_dir>/.fingerprint.json together with the sizes and
+    modification times of the files, so the checkpoint is only re-hashed when it changes.
+    """
+    paths = [os.path.join(model_dir, f) for f in filenames if os.path.exists(os.path.join(model_dir, f))]
+    if not paths:
+        raise ValueError('No checkpoint files found in {}'.format(model_dir))
+    stamp = [[os.path.basename(p), os.path.getsize(p), os.path.getmtime(p)] for p in paths]
+
+    fingerprint_file = os.path.join(model_dir, '.fingerprint.json')
+    if os.path.exists(fingerprint_file):
+        saved = json.load(open(fingerprint_file))
+        if saved['stamp'] == stamp:
+            return saved['sha1']
+
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                sha1.update(block)
+    fingerprint = sha1.hexdigest()
+    try:
+        json.dump({'stamp': stamp, 'sha1': fingerprint}, open(fingerprint_file, 'w'))
+    except (IOError, OSError):
+        pass  # read-only model dir: hash again next time
+    return fingerprint
+
+
+class PredictionCache(object):
+    """SQLite-backed cache of (label ids, REL probabilities) per input feature."""
+
+    def __init__(self, path, model_fingerprint, max_seq_length, max_size_mb=1024):
+        self.path = path
+        self.model_fingerprint = model_fingerprint
+        self.max_seq_length = max_seq_length
+        self.max_size = int(max_size_mb * (1 << 20))
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                          'key TEXT PRIMARY KEY, model TEXT, pred_ids BLOB, rel_probs BLOB, '
+                          'size INTEGER, last_access REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS predictions_last_access ON predictions (last_access)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats (model TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)')
+        self.conn.commit()
+
+    def key(self, feature):
+        sha1 = hashlib.sha1()
+        sha1.update('{}|{}'.format(self.model_fingerprint, self.max_seq_length).encode('utf-8'))
+        for values in [feature.input_ids, feature.input_mask, feature.segment_ids, feature.valid_ids,
+                       feature.label_mask]:
+            sha1.update(np.asarray(values, dtype=np.int32).tobytes())
+        return sha1.hexdigest()
+
+    def get_many(self, keys):
+        """Returns {key: (label ids, REL probabilities)} for the keys in the cache.
+
+        Hits and misses are counted per key of keys, so a key that occurs several times (duplicate
+        features) counts several times.
+        """
+        found = dict()
+        keys = list(keys)
+        distinct_keys = list(set(keys))
+        for start in range(0, len(distinct_keys), _MAX_VARIABLES):
+            chunk = distinct_keys[start:start + _MAX_VARIABLES]
+            rows = self.conn.execute('SELECT key, pred_ids, rel_probs FROM predictions WHERE key IN ({})'
+                                     .format(','.join('?' * len(chunk))), chunk)
+            for key, pred_ids, rel_probs in rows:
+                found[key] = (np.frombuffer(pred_ids, dtype=np.uint8).astype(np.int64),
+                              np.frombuffer(rel_probs, dtype=np.float32))
+
+        now = time.time()
+        self.conn.executemany('UPDATE predictions SET last_access = ? WHERE key = ?',
+                              [(now, key) for key in found])
+        self.conn.commit()
+        num_hits = sum(key in found for key in keys)
+        self.hits += num_hits
+        self.misses += len(keys) - num_hits
+        return found
+
+    def put_many(self, items):
+        """Stores (key, label ids, REL probabilities) items and evicts entries if the cache is too large."""
+        now = time.time()
+        rows = []
+        for key, pred_ids, rel_probs in items:
+            pred_ids = np.asarray(pred_ids, dtype=np.uint8).tobytes()
+            rel_probs = np.asarray(rel_probs, dtype=np.float32).tobytes()
+            rows.append((key, self.model_fingerprint, pred_ids, rel_probs, len(pred_ids) + len(rel_probs), now))
+        self.conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+        self.evict()
+
+    def size(self):
+        num_entries, total_size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM predictions') \
+            .fetchone()
+        return num_entries, total_size
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is below 90% of its size limit."""
+        _, total_size = self.size()
+        if total_size <= self.max_size:
+            return
+        to_free = total_size - int(0.9 * self.max_size)
+        evicted = []
+        for key, size in self.conn.execute('SELECT key, size FROM predictions ORDER BY last_access'):
+            evicted.append(key)
+            to_free -= size
+            if to_free <= 0:
+                break
+        for start in range(0, len(evicted), _MAX_VARIABLES):
+            chunk = evicted[start:start + _MAX_VARIABLES]
+            self.conn.execute('DELETE FROM predictions WHERE key IN ({})'.format(','.join('?' * len(chunk))), chunk)
+        self.conn.commit()
+        logger.info('Prediction cache: evicted {} entries'.format(len(evicted)))
+
+    def report(self):
+        """Logs the hit rate of this session and saves the cumulative counts of the model."""
+        self.conn.execute('INSERT OR IGNORE INTO stats VALUES (?, 0, 0)', (self.model_fingerprint,))
+        self.conn.execute('UPDATE stats SET hits = hits + ?, misses = misses + ? WHERE model = ?',
+                          (self.hits, self.misses, self.model_fingerprint))
+        self.conn.commit()
+        total_hits, total_misses = self.conn.execute('SELECT hits, misses FROM stats WHERE model = ?',
+                                                     (self.model_fingerprint,)).fetchone()
+        num_entries, total_size = self.size()
+
+        def rate(hits, misses):
+            return 100. * hits / (hits + misses) if hits + misses else 0.
+
+        logger.info('Prediction cache: {} hits, {} misses ({:.1f}% hit rate; {:.1f}% for this model overall), '
+                    '{} entries, {:.1f} MB'.format(self.hits, self.misses, rate(self.hits, self.misses),
+                                                   rate(total_hits, total_misses), num_entries,
+                                                   total_size / (1 << 20)))
+        self.hits = self.misses = 0
+
+    def close(self):
+        self.conn.close()
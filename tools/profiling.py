@@ -0,0 +1,161 @@
+"""
+On-demand profiling of run_ner.py (--profile_steps START:END, --profile_eval).
+
+A profiled block runs under the PyTorch autograd profiler. It writes to
+<output_prefix>.trace.json a Chrome trace (chrome://tracing or https://ui.perfetto.dev)
+and to <output_prefix>.top_ops.txt the top operators by self CPU time. With Python
+sampling, a background thread also records the Python stack of the profiled thread
+every few milliseconds. It writes the most frequent functions (self and inclusive) to
+<output_prefix>.python.txt and the stacks to <output_prefix>.python.folded (for
+flamegraph.pl or speedscope).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def parse_step_range(spec):
+    """Parses 'START:END' (1-based training steps, inclusive) into (START, END)."""
+    try:
+        start, end = [int(x) for x in spec.split(':')]
+    except ValueError:
+        raise ValueError('Invalid step range "{}": expected START:END'.format(spec))
+    if not 1 <= start <= end:
+        raise ValueError('Invalid step range "{}": expected 1 <= START <= END'.format(spec))
+    return start, end
+
+
+class PythonSampler(object):
+    """Samples the Python stack of one thread at a fixed interval from a background thread."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='python-sampler')
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, output_prefix, top_n=30):
+        num_samples = sum(self.stacks.values())
+        self_counts, inclusive_counts = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for frame in set(stack):
+                inclusive_counts[frame] += count
+
+        with open(output_prefix + '.python.txt', 'w') as fout:
+            fout.write('{} samples every {:.1f} ms\n'.format(num_samples, 1000 * self.interval))
+            for title, counts in [('self', self_counts), ('inclusive', inclusive_counts)]:
+                fout.write('\nTop {} functions ({}):\n'.format(top_n, title))
+                for frame, count in counts.most_common(top_n):
+                    fout.write('{:>7.1f}%  {}\n'.format(100 * count / max(num_samples, 1), frame))
+        with open(output_prefix + '.python.folded', 'w') as fout:
+            for stack, count in self.stacks.items():
+                fout.write('{} {}\n'.format(';'.join(frame.replace(';', ':') for frame in stack), count))
+
+
+class Profiler(object):
+    """Context manager that profiles a block and writes the results to output_prefix.*."""
+
+    def __init__(self, output_prefix, use_cuda=False, python_sampling=False, sampling_interval=0.005,
+                 sort_by='self_cpu_time_total', top_n=30):
+        self.output_prefix = output_prefix
+        self.use_cuda = use_cuda
+        self.python_sampling = python_sampling
+        self.sampling_interval = sampling_interval
+        self.sort_by = sort_by
+        self.top_n = top_n
+        self._profile = None
+        self._sampler = None
+        self._start_time = None
+
+    def start(self):
+        kwargs = {'use_cuda': True} if self.use_cuda else dict()
+        self._profile = torch.autograd.profiler.profile(**kwargs)
+        self._profile.__enter__()
+        if self.python_sampling:
+            self._sampler = PythonSampler(threading.current_thread().ident, interval=self.sampling_interval)
+            self._sampler.start()
+        self._start_time = time.time()
+
+    def stop(self):
+        elapsed = time.time() - self._start_time
+        if self._sampler is not None:
+            self._sampler.stop()
+        self._profile.__exit__(None, None, None)
+
+        self._profile.export_chrome_trace(self.output_prefix + '.trace.json')
+        with open(self.output_prefix + '.top_ops.txt', 'w') as fout:
+            fout.write(self._profile.key_averages().table(sort_by=self.sort_by, row_limit=self.top_n))
+        written = [self.output_prefix + '.trace.json', self.output_prefix + '.top_ops.txt']
+        if self._sampler is not None:
+            self._sampler.write(self.output_prefix, top_n=self.top_n)
+            written.append(self.output_prefix + '.python.txt')
+        logger.info('Profiled {:.1f} s: {}'.format(elapsed, ', '.join(written)))
+        self._profile = None
+        self._sampler = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class StepRangeProfiler(object):
+    """Profiles the training steps start..end (1-based, inclusive) of a loop that calls
+    begin_step / end_step around every step."""
+
+    def __init__(self, start, end, output_prefix, **kwargs):
+        self.start = start
+        self.end = end
+        self.profiler = Profiler('{}_steps{}-{}'.format(output_prefix, start, end), **kwargs)
+
+    def begin_step(self, step):
+        if step == self.start:
+            self.profiler.start()
+
+    def end_step(self, step):
+        if step == self.end and self.profiler.running:
+            self.profiler.stop()
+
+    def close(self):
+        # training ended before END
+        if self.profiler.running:
+            self.profiler.stop()
@@ -0,0 +1,244 @@
+"""
+Paired significance tests for the token-level P/R/F1 of two models.
+
+Per-query tp/fp/fn counts are computed once from two eval_results_*.json files
+written by run_ner.py. Bootstrap resamples and randomization (permutation)
+swaps are then applied to the count arrays in batches of matrix products, so
+no labels are re-read or re-scored per resample.
+
+Usage:
+    python -m tools.significance_test --model_output_file_a A.json --model_output_file_b B.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from tools.eval_seq_labeling import get_token_counts
+
+METRICS = ['precision_token', 'recall_token', 'f1_token']
+
+# upper bound on the number of elements of a (resamples x queries) matrix held in memory at once
+_MAX_BATCH_ELEMENTS = 10000000
+
+
+def load_paired_counts(model_output_file_a, model_output_file_b):
+    """Load per-query tp/fp/fn counts of two model outputs, aligned by query id."""
+    counts = []
+    ids = []
+    for model_output_file in [model_output_file_a, model_output_file_b]:
+        model_output_dct = json.load(open(model_output_file))
+        counts.append(get_token_counts(model_output_dct['y_true'], model_output_dct['y_pred']))
+        ids.append(model_output_dct['ids'])
+
+    id2index_b = {qid: i for i, qid in enumerate(ids[1])}
+    shared = [(i, id2index_b[qid]) for i, qid in enumerate(ids[0]) if qid in id2index_b]
+    if len(shared) != len(ids[0]) or len(shared) != len(ids[1]):
+        print('Warning: {} / {} queries are shared between the two model outputs; '
+              'testing on the shared ones.'.format(len(shared), max(len(ids[0]), len(ids[1]))))
+    if not shared:
+        raise ValueError('The two model outputs have no query ids in common.')
+
+    index_a, index_b = [np.asarray(x) for x in zip(*shared)]
+    return counts[0][index_a], counts[1][index_b], [ids[0][i] for i in index_a]
+
+
+def _prf(sums):
+    """Micro P/R/F1 from summed counts of shape (..., 3); returns shape (..., 3)."""
+    sums = np.asarray(sums, dtype=np.float64)
+    tp, fp, fn = sums[..., 0], sums[..., 1], sums[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(tp + fp > 0, tp / (tp + fp), 0.)
+        r = np.where(tp + fn > 0, tp / (tp + fn), 0.)
+        f1 = np.where(p + r > 0, 2 * p * r / (p + r), 0.)
+    return np.stack([p, r, f1], axis=-1)
+
+
+def _bootstrap_batch(job):
+    """Scores of both systems on `num_samples` paired bootstrap resamples."""
+    counts, num_samples, seed = job
+    rng = np.random.RandomState(seed)
+    num_queries = counts.shape[0]
+    # row k holds how often each query is drawn in resample k
+    weights = rng.multinomial(num_queries, np.full(num_queries, 1. / num_queries), size=num_samples)
+    sums = weights.astype(np.float64).dot(counts)
+    return _prf(sums[:, :3]), _prf(sums[:, 3:])
+
+
+def _randomization_batch(job):
+    """Scores of both systems after randomly swapping their per-query outputs."""
+    counts, num_samples, seed = job
+    rng = np.random.RandomState(seed)
+    num_queries = counts.shape[0]
+    counts_a, counts_b = counts[:, :3], counts[:, 3:]
+    swaps = rng.randint(0, 2, size=(num_samples, num_queries)).astype(np.float64)
+    moved = swaps.dot(counts_b - counts_a)
+    return _prf(counts_a.sum(axis=0) + moved), _prf(counts_b.sum(axis=0) - moved)
+
+
+def _run_batches(batch_fn, counts_a, counts_b, num_samples, seed, num_workers):
+    counts = np.concatenate([counts_a, counts_b], axis=1).astype(np.float64)
+    batch_size = max(1, min(num_samples, _MAX_BATCH_ELEMENTS // counts.shape[0]))
+
+    # batches (and their seeds) do not depend on num_workers, so results are reproducible
+    jobs = []
+    for i, start in enumerate(range(0, num_samples, batch_size)):
+        jobs.append((counts, min(batch_size, num_samples - start), seed + i))
+
+    if num_workers > 1 and len(jobs) > 1:
+        pool = Pool(num_workers)
+        try:
+            results = pool.map(batch_fn, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [batch_fn(job) for job in jobs]
+
+    scores_a = np.concatenate([x[0] for x in results])
+    scores_b = np.concatenate([x[1] for x in results])
+    return scores_a, scores_b
+
+
+def paired_bootstrap_test(counts_a, counts_b, num_samples=10000, alpha=0.05, seed=42, num_workers=1):
+    """Paired bootstrap test for the difference (b - a) in token P/R/F1.
+
+    The two-sided p-value is the fraction of resampled differences that lie at
+    least as far from the observed difference as the observed difference lies
+    from zero. Confidence intervals are percentile intervals.
+
+    Returns:
+        dict: metric -> {'a', 'b', 'delta', 'p_value', 'ci_a', 'ci_b', 'ci_delta'}.
+    """
+    observed_a, observed_b = _prf(counts_a.sum(axis=0)), _prf(counts_b.sum(axis=0))
+    scores_a, scores_b = _run_batches(_bootstrap_batch, counts_a, counts_b, num_samples, seed, num_workers)
+    deltas = scores_b - scores_a
+    observed_delta = observed_b - observed_a
+
+    p_values = np.mean(np.abs(deltas - observed_delta) >= np.abs(observed_delta) - 1e-12, axis=0)
+    percentiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    ci_a = np.percentile(scores_a, percentiles, axis=0)
+    ci_b = np.percentile(scores_b, percentiles, axis=0)
+    ci_delta = np.percentile(deltas, percentiles, axis=0)
+
+    result = dict()
+    for k, metric in enumerate(METRICS):
+        result[metric] = {'a': float(observed_a[k]),
+                          'b': float(observed_b[k]),
+                          'delta': float(observed_delta[k]),
+                          'p_value': float(p_values[k]),
+                          'ci_a': [float(x) for x in ci_a[:, k]],
+                          'ci_b': [float(x) for x in ci_b[:, k]],
+                          'ci_delta': [float(x) for x in ci_delta[:, k]]}
+    return result
+
+
+def randomization_test(counts_a, counts_b, num_samples=10000, seed=42, num_workers=1):
+    """Paired approximate randomization test for the difference (b - a) in token P/R/F1.
+
+    Returns:
+        dict: metric -> {'a', 'b', 'delta', 'p_value'}.
+    """
+    observed_a, observed_b = _prf(counts_a.sum(axis=0)), _prf(counts_b.sum(axis=0))
+    scores_a, scores_b = _run_batches(_randomization_batch, counts_a, counts_b, num_samples, seed, num_workers)
+    observed_delta = observed_b - observed_a
+
+    nb_extreme = np.sum(np.abs(scores_b - scores_a) >= np.abs(observed_delta) - 1e-12, axis=0)
+    p_values = (nb_extreme + 1) / (num_samples + 1)
+
+    result = dict()
+    for k, metric in enumerate(METRICS):
+        result[metric] = {'a': float(observed_a[k]),
+                          'b': float(observed_b[k]),
+                          'delta': float(observed_delta[k]),
+                          'p_value': float(p_values[k])}
+    return result
+
+
+def _print_result(name, result):
+    print('[{}]'.format(name))
+    for metric in METRICS:
+        x = result[metric]
+        line = '  {:<16s} a={:.1f} b={:.1f} delta={:+.1f} p={:.4f}'.format(
+            metric, 100 * x['a'], 100 * x['b'], 100 * x['delta'], x['p_value'])
+        if 'ci_delta' in x:
+            line += ' CI(delta)=[{:+.1f}, {:+.1f}]'.format(100 * x['ci_delta'][0], 100 * x['ci_delta'][1])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Paired significance tests for token P/R/F1.')
+
+    parser.add_argument("--model_output_file_a",
+                        type=str,
+                        required=True,
+                        help="eval_results_*.json of the baseline model.")
+
+    parser.add_argument("--model_output_file_b",
+                        type=str,
+                        required=True,
+                        help="eval_results_*.json of the compared model.")
+
+    parser.add_argument("--method",
+                        default='both',
+                        choices=['bootstrap', 'randomization', 'both'])
+
+    parser.add_argument("--num_samples",
+                        type=int,
+                        default=10000,
+                        help="Number of bootstrap resamples / random permutations.")
+
+    parser.add_argument("--alpha",
+                        type=float,
+                        default=0.05,
+                        help="Confidence intervals are (1 - alpha) percentile intervals.")
+
+    parser.add_argument("--num_workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes (useful for very large splits).")
+
+    parser.add_argument("--seed",
+                        type=int,
+                        default=42)
+
+    parser.add_argument("--output_file",
+                        type=str,
+                        help="Optional json file for the results.")
+
+    args = parser.parse_args()
+
+    counts_a, counts_b, ids = load_paired_counts(args.model_output_file_a, args.model_output_file_b)
+    print('Testing on {} queries with {} samples.'.format(len(ids), args.num_samples))
+
+    results = {'model_output_file_a': args.model_output_file_a,
+               'model_output_file_b': args.model_output_file_b,
+               'num_queries': len(ids),
+               'num_samples': args.num_samples}
+
+    if args.method in ['bootstrap', 'both']:
+        s_time = time.time()
+        results['bootstrap'] = paired_bootstrap_test(counts_a, counts_b, num_samples=args.num_samples,
+                                                     alpha=args.alpha, seed=args.seed,
+                                                     num_workers=args.num_workers)
+        _print_result('paired bootstrap, {:.1f}s'.format(time.time() - s_time), results['bootstrap'])
+
+    if args.method in ['randomization', 'both']:
+        s_time = time.time()
+        results['randomization'] = randomization_test(counts_a, counts_b, num_samples=args.num_samples,
+                                                      seed=args.seed, num_workers=args.num_workers)
+        _print_result('randomization, {:.1f}s'.format(time.time() - s_time), results['randomization'])
+
+    if args.output_file:
+        json.dump(results, open(args.output_file, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
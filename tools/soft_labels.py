@@ -0,0 +1,54 @@
+"""
+Compact on-disk cache of the per-token logits of a teacher model, used as soft
+labels for distillation (run_ner.py --teacher_model_id).
+
+Only the labelled (history) positions of every feature are kept, as float16, in a
+single npz file together with the fingerprint of the teacher checkpoint and the key
+of the training features (the features_cache_key of tools/features_cache.py: the
+data files and the processor and featurization settings), so a stale cache is
+never used.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+
+def feature_key(feature):
+    # windows of one example share its guid (see run_ner.convert_example_to_feature)
+    return '{}@{}'.format(feature._id, feature.window_start)
+
+
+def save_soft_labels(path, key2logits, model_fingerprint, features_key):
+    """Writes {feature key: [num labelled positions, num labels] logits} to path."""
+    keys = list(key2logits.keys())
+    lengths = [len(key2logits[key]) for key in keys]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    logits = np.concatenate([np.asarray(key2logits[key], dtype=np.float16) for key in keys]) if keys \
+        else np.zeros((0, 0), dtype=np.float16)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        np.savez(fout, keys=np.asarray(keys, dtype=str), offsets=offsets, logits=logits,
+                 model_fingerprint=np.asarray(model_fingerprint), features_key=np.asarray(features_key))
+    os.replace(tmp_path, path)
+
+
+def load_soft_labels(path, model_fingerprint, features_key):
+    """Reads the cache written by ``save_soft_labels``.
+
+    Returns an empty dict if the file does not exist or was written for another
+    teacher checkpoint or other training features.
+    """
+    if not os.path.exists(path):
+        return dict()
+    with np.load(path) as data:
+        if 'features_key' not in data or str(data['model_fingerprint']) != model_fingerprint \
+                or str(data['features_key']) != features_key:
+            return dict()
+        keys, offsets, logits = data['keys'], data['offsets'], data['logits']
+    return {str(key): logits[offsets[i]:offsets[i + 1]] for i, key in enumerate(keys)}
@@ -0,0 +1,114 @@
+"""
+Per-stage timing and throughput telemetry of run_ner.py training and evaluation.
+
+Training steps are sampled: every sample_every-th step, the time of each stage
+(data-loading wait, host-to-device copy, forward, backward, optimizer step) is
+measured and written, together with the examples/s and non-pad tokens/s since the
+previous sampled step, as one record to a JSONL file and as scalars to TensorBoard.
+On the other steps the timers are no-ops, so the overhead stays low. Evaluation and
+featurization are recorded once per call.
+
+Records look like:
+
+    {"phase": "train", "step": 120, "epoch": 0, "time": ..., "data_wait_s": 0.002, "h2d_s": 0.0004,
+     "forward_s": 0.31, "backward_s": 0.52, "optimizer_s": 0.04, "examples_per_s": 12.3, "tokens_per_s": 2950.1}
+    {"phase": "eval", "epoch": 1, "featurize_s": 1.2, "predict_s": 20.5, "decode_s": 0.3, "metrics_s": 0.01, ...}
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import json
+import time
+
+import torch
+
+
+class Telemetry(object):
+
+    def __init__(self, path=None, writer=None, sample_every=10, sync_cuda=False):
+        # path: JSONL file (appended to); writer: tensorboardX SummaryWriter; both optional
+        # sync_cuda: synchronize before reading the clock, so GPU stages are timed correctly
+        self.path = path
+        self.writer = writer
+        self.sample_every = sample_every
+        self.sync_cuda = sync_cuda
+        self._fout = open(path, 'a') if path else None
+
+        self.step = 0
+        self.epoch = 0
+        self.sampled = False
+        self._stages = dict()
+        self._num_examples = 0
+        self._interval_start = time.perf_counter()
+
+    def _clock(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start_epoch(self, epoch):
+        """Starts a training epoch; throughput is measured from here."""
+        self.epoch = epoch
+        self._num_examples = 0
+        self._interval_start = time.perf_counter()
+
+    def begin_step(self):
+        """Starts a training step; returns whether it is sampled."""
+        self.step += 1
+        self.sampled = self.sample_every > 0 and self.step % self.sample_every == 0
+        self._stages = dict()
+        return self.sampled
+
+    def add(self, stage, seconds):
+        """Adds a duration measured by the caller (only kept on sampled steps)."""
+        if self.sampled:
+            self._stages[stage] = self._stages.get(stage, 0.) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        if not self.sampled:
+            yield
+            return
+        s_time = self._clock()
+        try:
+            yield
+        finally:
+            self.add(stage, self._clock() - s_time)
+
+    def end_step(self, num_examples, input_mask=None):
+        """Ends a training step of num_examples examples. On sampled steps, writes the stage times and the
+        throughput since the previous sampled step (tokens/s uses the non-pad tokens of this step's batch)."""
+        self._num_examples += num_examples
+        if not self.sampled:
+            return
+        now = time.perf_counter()
+        examples_per_s = self._num_examples / max(now - self._interval_start, 1e-12)
+        values = {'{}_s'.format(stage): seconds for stage, seconds in self._stages.items()}
+        values['examples_per_s'] = examples_per_s
+        if input_mask is not None and num_examples:
+            values['tokens_per_s'] = examples_per_s * float(input_mask.sum()) / num_examples
+        self.record('train', step=self.step, **values)
+        self._num_examples = 0
+        self._interval_start = now
+
+    def record(self, phase, step=None, **values):
+        """Writes one record (and its numeric values to TensorBoard under <phase>/<name>)."""
+        if self._fout is not None:
+            record = dict(phase=phase, step=step if step is not None else self.step, epoch=self.epoch,
+                          time=time.time())
+            record.update(values)
+            self._fout.write(json.dumps(record) + '\n')
+            self._fout.flush()
+        if self.writer is not None:
+            for name, value in values.items():
+                if isinstance(value, (int, float)):
+                    self.writer.add_scalar('{}/{}'.format(phase, name), value,
+                                           step if step is not None else self.step)
+
+    def close(self):
+        if self._fout is not None:
+            self._fout.close()
+            self._fout = None
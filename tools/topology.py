@@ -0,0 +1,141 @@
+"""
+CPU inference topology: how many processes, threads per process and which cores.
+
+A host profile (written by benchmarks/autotune.py) stores, per host, model config,
+precision and max_seq_length, the fastest measured combination of worker processes,
+threads per worker and batch size:
+
+    {"<host key>|<model config hash>|<precision>": {"<max_seq_length>": {"num_workers": 4,
+        "num_threads": 8, "batch_size": 32, "pin": true, "examples_per_s": ..., "p95_ms": ...}}}
+
+With pinning, every worker gets its own set of physical cores (hyper-threading
+siblings are only used when there are not enough physical cores), so that the
+workers do not compete for cores and their memory stays close to them.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import os
+import platform
+import socket
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def usable_cpus():
+    """The CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _read_int(path):
+    try:
+        with open(path) as fin:
+            return int(fin.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def physical_cores(cpus=None):
+    """The CPUs grouped by physical core: [[cpu, its hyper-threading siblings...]], ordered by socket."""
+    cores = dict()
+    for cpu in cpus if cpus is not None else usable_cpus():
+        topology_dir = '/sys/devices/system/cpu/cpu{}/topology'.format(cpu)
+        package = _read_int(os.path.join(topology_dir, 'physical_package_id'))
+        core = _read_int(os.path.join(topology_dir, 'core_id'))
+        key = (package, core) if package is not None and core is not None else (0, cpu)
+        cores.setdefault(key, []).append(cpu)
+    return [sorted(cores[key]) for key in sorted(cores, key=lambda k: (k[0], min(cores[k])))]
+
+
+def worker_cpus(num_workers, num_threads, cpus=None):
+    """Disjoint CPU lists of num_threads CPUs for num_workers workers (fewer CPUs if there are not enough):
+    first one CPU per physical core, then their siblings."""
+    cores = physical_cores(cpus)
+    ordered = [core[0] for core in cores] + [cpu for core in cores for cpu in core[1:]]
+    if num_workers * num_threads > len(ordered):
+        logger.warning('{} workers x {} threads > {} CPUs: workers share CPUs'.format(
+            num_workers, num_threads, len(ordered)))
+        return [sorted(set(ordered[(i * num_threads + j) % len(ordered)] for j in range(num_threads)))
+                for i in range(num_workers)]
+    # neighbouring physical cores for every worker
+    return [sorted(ordered[i * num_threads:(i + 1) * num_threads]) for i in range(num_workers)]
+
+
+def apply_topology(num_threads, cpus=None):
+    """Limits this process to num_threads intra-op threads (and its child processes through OMP/MKL_NUM_THREADS)
+    and, if cpus is given, pins it to them."""
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    os.environ['MKL_NUM_THREADS'] = str(num_threads)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # only possible before the first parallel work
+        pass
+
+
+def host_key():
+    """Host name, CPU model and number of usable CPUs."""
+    cpu_model = platform.processor() or platform.machine()
+    try:
+        with open('/proc/cpuinfo') as fin:
+            for line in fin:
+                if line.startswith('model name'):
+                    cpu_model = line.split(':', 1)[1].strip()
+                    break
+    except (IOError, OSError):
+        pass
+    return '{}/{}/{}cpu'.format(socket.gethostname(), cpu_model, len(usable_cpus()))
+
+
+def model_config_hash(config):
+    return hashlib.sha1(config.to_json_string().encode('utf-8')).hexdigest()[:16]
+
+
+class HostProfile(object):
+    """The best inference topologies in a json file (see the module docstring)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return dict()
+        with open(self.path) as fin:
+            return json.load(fin)
+
+    @staticmethod
+    def key(config, precision):
+        return '{}|{}|{}'.format(host_key(), model_config_hash(config), precision)
+
+    def lookup(self, config, max_seq_length, precision='fp32'):
+        """The entry of the smallest profiled max_seq_length >= max_seq_length (else of the largest one), or None."""
+        entries = self._read().get(self.key(config, precision))
+        if not entries:
+            return None
+        seq_lengths = sorted(int(seq_length) for seq_length in entries)
+        longer = [seq_length for seq_length in seq_lengths if seq_length >= max_seq_length]
+        return entries[str(longer[0] if longer else seq_lengths[-1])]
+
+    def put(self, config, max_seq_length, precision, entry):
+        profile = self._read()
+        profile.setdefault(self.key(config, precision), dict())[str(max_seq_length)] = dict(entry, time=time.time())
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.tmp{}'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fout:
+            json.dump(profile, fout, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
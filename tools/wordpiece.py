@@ -0,0 +1,208 @@
+"""
+Trie-based WordPiece tokenization of example words for feature conversion.
+
+`BertTokenizer.tokenize` finds every word piece by trying ever shorter substrings
+against the vocabulary, and run_ner.py then converts the piece strings to ids.
+`TrieWordPieceTokenizer` wraps a `BertTokenizer` and returns the ids of every word
+directly. It walks two prefix tries over the vocabulary, one for word-initial pieces
+and one for "##" continuations, once per piece. It also remembers the ids of the
+words it has seen, since the history of a conversation is repeated in every later
+turn. The result is the same as `BertTokenizer` by construction: words containing
+special or added tokens, and the basic tokenization of non-ASCII words, go through
+the wrapped tokenizer. All other attributes (vocab, save_pretrained,
+convert_ids_to_tokens, ...) are those of the wrapped tokenizer.
+
+The differential check compares both tokenizers on every distinct word of the given
+splits and on the vocabulary itself, and times them on the example word lists:
+
+    python -m tools.wordpiece --model_dir ./models/$MODEL_ID --data_dir ./data/quac --splits train dev
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+# the key of the vocabulary id in a trie node (the other keys are single characters)
+_ID = ''
+
+
+def _is_ascii_punctuation(cp):
+    return 33 <= cp <= 47 or 58 <= cp <= 64 or 91 <= cp <= 96 or 123 <= cp <= 126
+
+
+class TrieWordPieceTokenizer(object):
+
+    def __init__(self, tokenizer, max_cached_words=1 << 20):
+        self.tokenizer = tokenizer
+        self.unk_id = tokenizer.vocab.get(tokenizer.unk_token)
+        self.max_input_chars_per_word = tokenizer.wordpiece_tokenizer.max_input_chars_per_word
+        self.do_basic_tokenize = tokenizer.do_basic_tokenize
+        self.do_lower_case = self.do_basic_tokenize and tokenizer.basic_tokenizer.do_lower_case
+        self.never_split = set(tokenizer.basic_tokenizer.never_split) if self.do_basic_tokenize else set()
+        self.special_tokens = list(tokenizer.added_tokens_encoder) + tokenizer.all_special_tokens
+        self.max_cached_words = max_cached_words
+        self._cache = dict()
+
+        self._root = dict()
+        self._continuation_root = dict()
+        for token, token_id in tokenizer.vocab.items():
+            self._insert(self._root, token, token_id)
+            if token.startswith('##'):
+                self._insert(self._continuation_root, token[2:], token_id)
+
+    @staticmethod
+    def _insert(root, token, token_id):
+        node = root
+        for char in token:
+            node = node.setdefault(char, dict())
+        node[_ID] = token_id
+
+    def __getattr__(self, name):
+        # only called for attributes not found on self
+        if name == 'tokenizer' or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def _wordpiece_ids(self, piece, ids):
+        """Appends the ids of the greedy longest-match word pieces of piece to ids."""
+        if len(piece) > self.max_input_chars_per_word:
+            ids.append(self.unk_id)
+            return
+        piece_ids = []
+        start = 0
+        length = len(piece)
+        root = self._root
+        while start < length:
+            node = root
+            match_id = None
+            match_end = start
+            i = start
+            while i < length:
+                node = node.get(piece[i])
+                if node is None:
+                    break
+                i += 1
+                if _ID in node:
+                    match_id = node[_ID]
+                    match_end = i
+            if match_id is None:
+                ids.append(self.unk_id)
+                return
+            piece_ids.append(match_id)
+            start = match_end
+            root = self._continuation_root
+        ids.extend(piece_ids)
+
+    def _basic_pieces(self, word):
+        """The basic tokenization of word (punctuation splitting, lower casing, ...)."""
+        if not self.do_basic_tokenize:
+            return word.split()
+        if word and all(33 <= ord(char) <= 126 for char in word) and word not in self.never_split:
+            # printable ASCII without spaces: only lower casing and punctuation splitting apply
+            if self.do_lower_case:
+                word = word.lower()
+            pieces = []
+            start = 0
+            for i, char in enumerate(word):
+                if _is_ascii_punctuation(ord(char)):
+                    if start < i:
+                        pieces.append(word[start:i])
+                    pieces.append(char)
+                    start = i + 1
+            if start < len(word):
+                pieces.append(word[start:])
+            return pieces
+        return self.tokenizer.basic_tokenizer.tokenize(word, never_split=self.tokenizer.all_special_tokens)
+
+    def encode_word(self, word):
+        """The token ids of word (as BertTokenizer.convert_tokens_to_ids(BertTokenizer.tokenize(word)))."""
+        ids = self._cache.get(word)
+        if ids is not None:
+            return ids
+        # PreTrainedTokenizer.tokenize splits on special tokens (and turns blank words into one)
+        if not word.strip() or any(token in word for token in self.special_tokens):
+            ids = [self.tokenizer._convert_token_to_id_with_added_voc(token)
+                   for token in self.tokenizer.tokenize(word)]
+        else:
+            ids = []
+            for piece in self._basic_pieces(word):
+                self._wordpiece_ids(piece, ids)
+        if len(self._cache) >= self.max_cached_words:
+            self._cache.clear()
+        self._cache[word] = ids
+        return ids
+
+    def encode_words(self, words):
+        """The token ids of every word of words (callers must not modify them)."""
+        return [self.encode_word(word) for word in words]
+
+
+def _bert_ids(tokenizer, word):
+    return tokenizer.convert_tokens_to_ids(tokenizer.tokenize(word))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Differential check of TrieWordPieceTokenizer against BertTokenizer.')
+
+    parser.add_argument("--model_dir", type=str, required=True,
+                        help="Directory (or name) of the BERT model whose vocab.txt is used.")
+    parser.add_argument("--do_lower_case", action='store_true')
+    parser.add_argument("--data_dir", type=str, default=None)
+    parser.add_argument("--splits", type=str, nargs='*', default=[],
+                        help="Splits of data_dir (as --train_on / --dev_on) whose words are checked.")
+    parser.add_argument("--max_mismatches", type=int, default=20,
+                        help="Number of mismatching words to print.")
+
+    args = parser.parse_args()
+
+    from pytorch_transformers import BertTokenizer
+    from run_ner import ConvSearchProcessor
+
+    tokenizer = BertTokenizer.from_pretrained(args.model_dir, do_lower_case=args.do_lower_case)
+    trie_tokenizer = TrieWordPieceTokenizer(tokenizer)
+
+    word_lists = []
+    for split in args.splits:
+        processor = ConvSearchProcessor(train_on=split, dev_on=split)
+        # the words of InputExample.text_a
+        word_lists.extend(' '.join(tokens).split(' ') for _, tokens, _ in processor.read_split(args.data_dir, split))
+    words = {word for word_list in word_lists for word in word_list}
+    # the vocabulary itself, with and without the continuation marker, and some casing variants
+    for token in tokenizer.vocab:
+        words.update([token, token[2:] if token.startswith('##') else '##' + token, token.upper(), token.title()])
+    words = sorted(words)
+
+    mismatches = 0
+    for word in words:
+        expected = _bert_ids(tokenizer, word)
+        found = trie_tokenizer.encode_word(word)
+        if found != expected:
+            mismatches += 1
+            if mismatches <= args.max_mismatches:
+                print('MISMATCH {!r}: BertTokenizer {} vs trie {}'.format(word, expected, found))
+    print('{} distinct words: {} mismatches'.format(len(words), mismatches))
+
+    if word_lists:
+        num_words = sum(len(word_list) for word_list in word_lists)
+        s_time = time.perf_counter()
+        for word_list in word_lists:
+            [_bert_ids(tokenizer, word) for word in word_list]
+        bert_time = time.perf_counter() - s_time
+        trie_tokenizer = TrieWordPieceTokenizer(tokenizer)
+        s_time = time.perf_counter()
+        for word_list in word_lists:
+            trie_tokenizer.encode_words(word_list)
+        trie_time = time.perf_counter() - s_time
+        print('{} example words: BertTokenizer {:.2f} s ({:.0f} words/s), trie {:.2f} s ({:.0f} words/s), '
+              '{:.1f}x'.format(num_words, bert_time, num_words / max(bert_time, 1e-12), trie_time,
+                                num_words / max(trie_time, 1e-12), bert_time / max(trie_time, 1e-12)))
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()